@@ -64,3 +64,20 @@ def dot2tex(dotsource, **kwargs):
   
 
 
+async def dot2tex_async(dotsource, timeout=None, **kwargs):
+    """Process dotsource without blocking the event loop
+
+    Coroutine returning the LaTeX code. Graphviz and LaTeX are run as
+    asyncio subprocesses, and are killed if the conversion takes more than
+    timeout seconds or is cancelled. Takes the same options as dot2tex.
+    """
+    return await d2t.convert_graph_async(dotsource, timeout=timeout, **kwargs)
+
+
+def dot2tex_graphs(fileobj, **kwargs):
+    """Process every graph in the file object fileobj
+
+    Returns a generator yielding the LaTeX code for each graph. Takes the
+    same options as dot2tex.
+    """
+    return d2t.convert_graphs(fileobj, **kwargs)
@@ -1,12 +1,20 @@
+import ctypes
+import hashlib
+import io
+import json
 import logging
 import os
 import re
+import shlex
 import sys
 import tempfile
+import threading
+import time
 from subprocess import Popen, PIPE
 
 from . import dotparsing
-from .utils import nsplit, chunks, escape_texchars, smart_float, replace_tags, is_multiline_label
+from .utils import chunks, escape_texchars, smart_float, fixed_float, format_points, replace_tags, \
+    is_multiline_label
 
 # initialize logging module
 log = logging.getLogger("dot2tex")
@@ -20,102 +28,704 @@ DEFAULT_EDGELABEL_XMARGIN = 0.01
 DEFAULT_EDGELABEL_YMARGIN = 0.01
 
 
-def create_xdot(dotdata, prog='dot', options=''):
-    """Run a graph through Graphviz and return an xdot-version of the graph"""
-    # The following code is from the pydot module written by Ero Carrera
-    progs = dotparsing.find_graphviz()
+class LayoutStats(object):
+    """Wall time and bytes transferred for the Graphviz runs in this process
 
-    # prog = 'dot'
-    if progs is None:
+    The numbers for the latest run are kept in last as a dictionary with
+    the keys prog, time, bytes_in and bytes_out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.time = 0.0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.last = None
+
+    def add(self, prog, elapsed, bytes_in, bytes_out):
+        with self._lock:
+            self.calls += 1
+            self.time += elapsed
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.last = dict(prog=prog, time=elapsed, bytes_in=bytes_in, bytes_out=bytes_out)
+
+
+# Process-wide Graphviz statistics
+layout_stats = LayoutStats()
+
+
+class _HashWriter(object):
+    """File-like object that feeds text written to it into a hash"""
+
+    def __init__(self, hashobj, encoding='utf8'):
+        self.hashobj = hashobj
+        self.encoding = encoding
+
+    def write(self, s):
+        self.hashobj.update(s.encode(self.encoding))
+
+
+class LayoutCache(object):
+    """Content-addressed on-disk cache for Graphviz layouts
+
+    The layouts are stored in directory, one file per layout named by a hash
+    of the dot source, the program, its options, the output format and the
+    Graphviz version. Files are written atomically, so several processes
+    can share the directory. When the total size exceeds max_size bytes, the
+    least recently used layouts are removed.
+    """
+
+    suffix = '.layout'
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def make_key(self, dotdata, prog, options, output_format, version):
+        m = hashlib.sha256()
+        m.update(repr((prog, options, output_format, version)).encode('utf8'))
+        m.update(b'\0')
+        if isinstance(dotdata, dotparsing.DotGraph):
+            dotdata.write(_HashWriter(m))
+        else:
+            m.update(dotdata.encode('utf8'))
+        return m.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the cached layout for key, or None"""
+        filename = self._path(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            # the modification time is used for finding the least recently
+            # used layouts
+            os.utime(filename, None)
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        log.debug('Layout cache %s for %s. %s', 'miss' if data is None else 'hit', key, self.stats())
+        return data
+
+    def put(self, key, data):
+        """Store the layout data for key"""
+        try:
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, self._path(key))
+        except OSError as err:
+            log.warning('Failed to write to the layout cache %s: %s', self.directory, err)
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            if self._size is None or self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used layouts until the cache fits"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        entries.sort()
+        for mtime, filesize, name in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            size -= filesize
+            self.evictions += 1
+            log.debug('Removed %s from the layout cache', name)
+        self._size = size
+
+    def stats(self):
+        """Return the hit, miss and eviction counters as a dictionary"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+_layout_caches = {}
+_layout_caches_lock = threading.Lock()
+
+
+def get_layout_cache(directory, max_size=100 * 1024 * 1024):
+    """Return the process-wide LayoutCache for directory"""
+    directory = os.path.abspath(directory)
+    with _layout_caches_lock:
+        cache = _layout_caches.get(directory)
+        if cache is None:
+            cache = _layout_caches[directory] = LayoutCache(directory, max_size)
+        cache.max_size = max_size
+    return cache
+
+
+class _PipeWriter(object):
+    """Encode text written to a binary pipe and count the bytes"""
+
+    def __init__(self, pipe, encoding='utf8'):
+        self.pipe = pipe
+        self.encoding = encoding
+        self.count = 0
+
+    def write(self, s):
+        data = s.encode(self.encoding)
+        self.pipe.write(data)
+        self.count += len(data)
+
+
+# Holds the AsyncProgramRunner for conversions started by
+# convert_graph_async in the thread running them
+_program_runner = threading.local()
+
+
+def _get_program_runner():
+    return getattr(_program_runner, 'runner', None)
+
+
+def _write_graphs(writer, dotdata):
+    """Write dotdata, a string, a DotGraph or a list of them, to writer"""
+    if isinstance(dotdata, (list, tuple)):
+        graphs = dotdata
+    else:
+        graphs = [dotdata]
+    for i, graph in enumerate(graphs):
+        if i:
+            writer.write('\n')
+        if isinstance(graph, dotparsing.DotGraph):
+            graph.write(writer)
+        else:
+            writer.write(graph)
+
+
+def run_graphviz(args, dotdata):
+    """Run the Graphviz command args with dotdata on stdin
+
+    The program is executed directly, without a shell. dotdata, a string, a
+    DotGraph instance or a list of them, is written to stdin from a separate
+    thread while stderr is drained concurrently, so a program producing a
+    lot of warnings can not block on a full pipe. Returns a (stdout data,
+    stderr data) tuple of bytes and records the run in layout_stats.
+    """
+    start = time.perf_counter()
+    runner = _get_program_runner()
+    if runner is not None:
+        writer = _PipeWriter(io.BytesIO())
+        _write_graphs(writer, dotdata)
+        data, error_data = runner(args, writer.pipe.getvalue())
+    else:
+        p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
+        writer = _PipeWriter(p.stdin)
+        stderr_chunks = []
+
+        def feed():
+            try:
+                _write_graphs(writer, dotdata)
+            except (BrokenPipeError, OSError) as err:
+                # Graphviz stopped reading. The reason is reported on stderr.
+                log.debug('Graphviz closed stdin early: %s', err)
+            finally:
+                try:
+                    p.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+
+        def drain():
+            stderr_chunks.append(p.stderr.read())
+
+        threads = [threading.Thread(target=feed), threading.Thread(target=drain)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            data = p.stdout.read()
+        finally:
+            p.stdout.close()
+            for thread in threads:
+                thread.join()
+            p.stderr.close()
+            p.wait()
+        error_data = b''.join(stderr_chunks)
+    elapsed = time.perf_counter() - start
+    layout_stats.add(os.path.basename(args[0]), elapsed, writer.count, len(data))
+    log.debug('Graphviz run took %.1f ms, %d bytes in, %d bytes out',
+              elapsed * 1000, writer.count, len(data))
+    return data, error_data
+
+
+def run_latex(args, cwd):
+    """Run the LaTeX command args in the directory cwd
+
+    Returns a (stdout data, stderr data) tuple of bytes.
+    """
+    runner = _get_program_runner()
+    if runner is not None:
+        return runner(args, b'', cwd)
+    p = Popen(args, cwd=cwd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+              close_fds=(sys.platform != 'win32'))
+    return p.communicate(b'')
+
+
+async def run_program_async(args, input_data=b'', cwd=None):
+    """Run args with input_data on stdin without blocking the event loop
+
+    Returns a (stdout data, stderr data) tuple of bytes. The program is
+    killed if the call is cancelled.
+    """
+    import asyncio
+
+    p = await asyncio.create_subprocess_exec(*args, stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=cwd)
+    try:
+        return await p.communicate(input_data)
+    except asyncio.CancelledError:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+        raise
+
+
+class AsyncProgramRunner(object):
+    """Run the programs needed by a conversion on an event loop
+
+    A conversion running in a worker thread calls the runner, which runs
+    the program with run_program_async on loop and waits for the result.
+    cancel kills the running programs and makes later calls fail, so the
+    conversion stops.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.cancelled = False
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, args, input_data=b'', cwd=None):
+        import asyncio
+        import concurrent.futures
+
+        with self._lock:
+            if self.cancelled:
+                raise concurrent.futures.CancelledError()
+            future = asyncio.run_coroutine_threadsafe(
+                run_program_async(args, input_data, cwd), self.loop)
+            self._futures.add(future)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for future in self._futures:
+                future.cancel()
+
+    def run(self, func, *args):
+        """Call func with args in the current thread using this runner"""
+        _program_runner.runner = self
+        try:
+            return func(*args)
+        finally:
+            _program_runner.runner = None
+
+
+class GraphvizLibrary(object):
+    """Lay out graphs in-process with the Graphviz C library
+
+    gvc and cgraph are the libgvc and libcgraph libraries loaded with
+    ctypes. The library is not thread-safe, so calls are serialized. The
+    layout method returns None when a graph can not be laid out. The caller
+    should then run the Graphviz programs, which report the errors.
+    """
+
+    def __init__(self, gvc, cgraph):
+        self._lock = threading.Lock()
+        self.gvc = gvc
+        self.cgraph = cgraph
+        gvc.gvcVersion.restype = ctypes.c_char_p
+        gvc.gvcVersion.argtypes = [ctypes.c_void_p]
+        gvc.gvContext.restype = ctypes.c_void_p
+        gvc.gvContext.argtypes = []
+        gvc.gvLayout.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p]
+        gvc.gvRenderData.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+                                     ctypes.c_void_p, ctypes.c_void_p]
+        gvc.gvFreeRenderData.argtypes = [ctypes.c_void_p]
+        gvc.gvFreeLayout.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        cgraph.agmemread.restype = ctypes.c_void_p
+        cgraph.agmemread.argtypes = [ctypes.c_char_p]
+        cgraph.agclose.argtypes = [ctypes.c_void_p]
+        self.context = gvc.gvContext()
+        if not self.context:
+            raise OSError('Could not create a Graphviz context')
+        m = re.match(br'\d+(?:\.\d+)*', gvc.gvcVersion(self.context) or b'')
+        self.version = tuple(int(v) for v in m.group(0).split(b'.')) if m else None
+        # The length argument of gvRenderData was changed from unsigned int
+        # to size_t in Graphviz 3.0
+        if self.version and self.version < (3, 0):
+            self._length_type = ctypes.c_uint
+        else:
+            self._length_type = ctypes.c_size_t
+
+    def layout(self, dotdata, prog='dot', output_format='xdot'):
+        """Lay out dotdata with the engine prog and return the output
+
+        dotdata is either a string or a DotGraph instance. Only the first
+        graph in dotdata is laid out.
+        """
+        if isinstance(dotdata, dotparsing.DotGraph):
+            dotdata = str(dotdata)
+        source = dotdata.encode('utf8')
+        gvc = self.gvc
+        start = time.perf_counter()
+        with self._lock:
+            graph = self.cgraph.agmemread(source)
+            if not graph:
+                return None
+            try:
+                if gvc.gvLayout(self.context, graph, prog.encode('ascii')) != 0:
+                    return None
+                try:
+                    result = ctypes.c_void_p()
+                    length = self._length_type(0)
+                    if gvc.gvRenderData(self.context, graph, output_format.encode('ascii'),
+                                        ctypes.byref(result), ctypes.byref(length)) != 0:
+                        return None
+                    data = ctypes.string_at(result, length.value)
+                    gvc.gvFreeRenderData(result)
+                finally:
+                    gvc.gvFreeLayout(self.context, graph)
+            finally:
+                self.cgraph.agclose(graph)
+        elapsed = time.perf_counter() - start
+        layout_stats.add('libgvc:' + prog, elapsed, len(source), len(data))
+        log.debug('Graphviz library layout took %.1f ms, %d bytes in, %d bytes out',
+                  elapsed * 1000, len(source), len(data))
+        return data
+
+
+_graphviz_library = None
+_graphviz_library_lock = threading.Lock()
+
+
+def get_graphviz_library():
+    """Return a process-wide GraphvizLibrary, or None if libgvc is missing"""
+    import ctypes.util
+
+    global _graphviz_library
+    with _graphviz_library_lock:
+        if _graphviz_library is None:
+            _graphviz_library = False
+            gvc_name = ctypes.util.find_library('gvc')
+            cgraph_name = ctypes.util.find_library('cgraph')
+            if gvc_name and cgraph_name:
+                try:
+                    _graphviz_library = GraphvizLibrary(ctypes.CDLL(gvc_name),
+                                                        ctypes.CDLL(cgraph_name))
+                except (OSError, AttributeError) as err:
+                    log.debug('Failed to load the Graphviz library. %s', err)
+            else:
+                log.debug('The Graphviz library was not found')
+        return _graphviz_library or None
+
+
+def create_xdot(dotdata, prog='dot', options='', output_format='xdot', cache=None,
+                backend='process'):
+    """Run a graph through Graphviz and return an xdot-version of the graph
+
+    dotdata is either a string or a DotGraph instance. It is piped to
+    Graphviz, and a DotGraph is written without creating the dot source
+    first. Set output_format to 'json' to get the layout as JSON data
+    instead. If cache is a LayoutCache, the layout is looked up there
+    first. Set backend to 'library' to lay out the graph in-process with
+    libgvc. The Graphviz programs are used if the library is not available,
+    if options are given or if the library fails.
+    """
+    library = None
+    if backend == 'library':
+        if options:
+            log.debug('Program options are not supported by the library backend')
+        else:
+            library = get_graphviz_library()
+    tools = dotparsing.get_graphviz()
+    if tools is None and library is None:
         log.error('Could not locate Graphviz binaries')
         return None
+    if tools is not None:
+        args = _graphviz_args(tools, prog, options, output_format)
+
+    if cache is not None:
+        version = tools.version if tools is not None else library.version
+        key = cache.make_key(dotdata, prog, options, output_format, version)
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    data = library.layout(dotdata, prog, output_format) if library is not None else None
+    if data is not None:
+        failed = False
+    elif tools is None:
+        log.error('Failed to lay out the graph with the Graphviz library')
+        return None
+    else:
+        data, error_data = run_graphviz(args, dotdata)
+        failed = _log_graphviz_errors(error_data) or not data.strip()
+    if cache is not None and not failed:
+        cache.put(key, data)
+    return data
+
+
+def get_layout_format(options):
+    """Return the layout format to request from Graphviz given options"""
+    layoutformat = options.get('layoutformat') or 'xdot'
+    if layoutformat == 'auto':
+        tools = dotparsing.get_graphviz()
+        layoutformat = tools.best_layout_format() if tools else 'xdot'
+        log.debug('Using the %s layout format', layoutformat)
+    return layoutformat
+
+
+def get_layout_cache_from_options(options):
+    """Return the layout cache given by the layoutcache option or None"""
+    if not options.get('layoutcache'):
+        return None
+    return get_layout_cache(options['layoutcache'],
+                            int(options.get('layoutcachesize') or 100) * 1024 * 1024)
+
+
+def _graphviz_args(tools, prog, options, output_format):
+    """Return the command line for running prog"""
+    progs = tools.progs
     if not prog in progs:
         log.error('Invalid prog=%s', prog)
         raise NameError('The %s program is not recognized. Valid values are %s' % (prog, list(progs)))
+    args = [progs[prog].strip(), '-T' + output_format]
+    args.extend(shlex.split(options or '', posix=(sys.platform != 'win32')))
+    log.debug('Creating %s data with: %s', output_format, args)
+    return args
 
-    tmp_fd, tmp_name = tempfile.mkstemp()
-    os.close(tmp_fd)
-    if os.sys.version_info[0] >= 3:
-        with open(tmp_name, 'w', encoding="utf8") as f:
-            f.write(dotdata)
-    else:
-        with open(tmp_name, 'w') as f:
-            f.write(dotdata)
-    output_format = 'xdot'
-    progpath = '"%s"' % progs[prog].strip()
-    cmd = progpath + ' -T' + output_format + ' ' + options + ' ' + tmp_name
-    log.debug('Creating xdot data with: %s', cmd)
-    p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
-    (stdout, stderr) = (p.stdout, p.stderr)
-    try:
-        data = stdout.read()
-    finally:
-        stdout.close()
 
-    try:
-        error_data = stderr.read()
-        if error_data:
-            if b'Error:' in error_data:
-                log.error("Graphviz returned with the following message: %s", error_data)
-            else:
-                # Graphviz raises a lot of warnings about too small labels,
-                # we therefore log them using log.debug to "hide" them
-                log.debug('Graphviz STDERR %s', error_data)
-    finally:
-        stderr.close()
-    p.kill()
-    p.wait()
-
-    os.unlink(tmp_name)
-    return data
+def _log_graphviz_errors(error_data):
+    """Log the stderr output from Graphviz. Returns True on errors"""
+    if error_data:
+        if b'Error:' in error_data:
+            log.error("Graphviz returned with the following message: %s", error_data)
+            return True
+        else:
+            # Graphviz raises a lot of warnings about too small labels,
+            # we therefore log them using log.debug to "hide" them
+            log.debug('Graphviz STDERR %s', error_data)
+    return False
+
 
+def split_layouts(data, output_format='xdot'):
+    """Split the output from a Graphviz run on several graphs
 
-def parse_dot_data(dotdata):
+    Returns a list with the layout data for each graph as bytes.
+    """
+    if output_format == 'json':
+        text = data.decode('utf8')
+        decoder = json.JSONDecoder()
+        layouts = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos >= len(text):
+                break
+            end = decoder.raw_decode(text, pos)[1]
+            layouts.append(text[pos:end].encode('utf8'))
+            pos = end
+        return layouts
+    return [layout.encode('utf8')
+            for layout in dotparsing.split_dot_graphs(io.BytesIO(data))]
+
+
+def create_xdot_batch(graphs, prog='dot', options='', output_format='xdot', cache=None,
+                      backend='process'):
+    """Lay out several graphs with a single Graphviz process
+
+    graphs is a list of strings or DotGraph instances. The graphs are
+    written one after the other to the same Graphviz process and the output
+    is split up again. Returns a list with the layout data for each graph,
+    the same as create_xdot would return. If the output can not be split
+    up, for instance because Graphviz stopped at a syntax error, the graphs
+    are laid out one at a time instead. With the library backend, the graphs
+    are laid out in-process one at a time.
+    """
+    if backend == 'library' and not options and get_graphviz_library() is not None:
+        return [create_xdot(graph, prog, options, output_format, cache, backend)
+                for graph in graphs]
+    tools = dotparsing.get_graphviz()
+    if tools is None:
+        log.error('Could not locate Graphviz binaries')
+        return [None] * len(graphs)
+    args = _graphviz_args(tools, prog, options, output_format)
+
+    layouts = [None] * len(graphs)
+    keys = [None] * len(graphs)
+    todo = []
+    for i, graph in enumerate(graphs):
+        if cache is not None:
+            keys[i] = cache.make_key(graph, prog, options, output_format, tools.version)
+            layouts[i] = cache.get(keys[i])
+        if layouts[i] is None:
+            todo.append(i)
+    if not todo:
+        return layouts
+
+    data, error_data = run_graphviz(args, [graphs[i] for i in todo])
+    failed = _log_graphviz_errors(error_data)
+    results = [] if failed else split_layouts(data, output_format)
+    if len(results) != len(todo):
+        log.warning('Could not split the output from Graphviz. Laying out the graphs one at a time')
+        # create_xdot only caches layouts when Graphviz reported no errors
+        for i in todo:
+            layouts[i] = create_xdot(graphs[i], prog, options, output_format, cache, backend)
+        return layouts
+    for i, layout in zip(todo, results):
+        layouts[i] = layout
+        if cache is not None and layout and layout.strip():
+            cache.put(keys[i], layout)
+    return layouts
+
+
+def has_draw_attrs(graph):
+    """Return True if the graph or any of its elements has xdot draw attributes"""
+    for items in (graph.allgraphs, graph.allnodes, graph.alledges):
+        for item in items:
+            if '_draw_' in item.attr or '_ldraw_' in item.attr:
+                return True
+    return False
+
+
+def parse_dot_data(dotdata, engine='pyparsing', xdot=False):
     """Wrapper for pydot.graph_from_dot_data
 
+    The engine argument selects the parser implementation. Valid values are
+    the keys of dotparsing.parser_engines. Parser instances are taken from
+    the process-wide dotparsing.parser_pool and reused between calls.
+
+    Set xdot to True for data generated by Graphviz. The data is then read
+    with the fast xdot reader, falling back to engine if necessary.
+
     Redirects error messages to the log.
     """
-    parser = dotparsing.DotDataParser()
-    try:
-        graph = parser.parse_dot_data(dotdata)
-    except dotparsing.ParseException:
-        raise
-    finally:
-        del parser
+    if xdot:
+        graph = dotparsing.parse_xdot_data(dotdata, engine or 'pyparsing')
+    else:
+        graph = dotparsing.parser_pool.parse_dot_data(dotdata, engine or 'pyparsing')
     log.debug('Parsed graph:\n%s', str(graph))
     return graph
 
 
+# A token in a drawstring. Matches the same whitespace as str.split
+_drawstring_token_re = re.compile(r'\S+')
+
+
+_drawstring_tokens_res = {}
+
+
+def _drawstring_tokens_re(n):
+    """Return a regular expression matching up to n drawstring tokens"""
+    pattern = _drawstring_tokens_res.get(n)
+    if pattern is None:
+        pattern = re.compile(r'(?:\s*\S+(?!\S)){0,%d}' % n)
+        if n <= 64:
+            # Keep the patterns for the counts used by most operations
+            _drawstring_tokens_res[n] = pattern
+    return pattern
+
+
 def parse_drawstring(drawstring):
-    """Parse drawstring and returns a list of draw operations"""
+    """Parse drawstring and returns a list of draw operations
+
+    Each operation is a tuple starting with the xdot operation code:
+
+        (op, x, y, w, h)        ellipse, op is e or E
+        (op, points)            polygon (p, P), polyline (L) or B-spline (b, B)
+        (op, color)             pen or fill color, op is c or C
+        ('S', style)
+        ('F', size, fontname)
+        ('T', x, y, align, width, text, valign)
+
+    Coordinates and sizes are floats, and points is a tuple of (x, y)
+    tuples. align is -1, 0 or 1 for left aligned, centered or right aligned
+    text. valign is the vertical alignment used by the PSTricks format.
+    Also returns a dictionary with the number of each operation.
+
+    The drawstring is scanned once with a cursor. Each operation reads only
+    the tokens it needs, so the time used is linear in the length of the
+    drawstring.
+    """
+    s = drawstring.strip().replace('\\', '')
+    find_token = _drawstring_token_re.search
+
+    def tokens(pos, n):
+        """Return the first n tokens of s[pos:].split()"""
+        return _drawstring_tokens_re(n).match(s, pos).group().split()
 
-    # The draw string parser is a bit clumsy and slow
-    def doeE(c, s):
+    def count(token):
+        n = int(token)
+        if n < 0:
+            raise ValueError('Negative count %s' % token)
+        return n
+
+    def doeE(c, pos):
         """Parse ellipse"""
         # E x0 y0 w h  Filled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
         # e x0 y0 w h  Unfilled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
-        tokens = s.split()[0:4]
-        if not tokens:
+        toks = tokens(pos, 4)
+        if not toks:
             return None
-        points = [float(t) for t in tokens]
-        didx = sum(len(t) for t in tokens) + len(points) + 1
+        points = [float(t) for t in toks]
+        didx = sum(len(t) for t in toks) + len(points) + 1
         return didx, (c, points[0], points[1], points[2], points[3])
 
-    def doPLB(c, s):
+    def doPLB(c, pos):
         """Parse polygon, polyline og B-spline"""
         # P n x1 y1 ... xn yn  Filled polygon using the given n points
         # p n x1 y1 ... xn yn  Unfilled polygon using the given n points
         # L n x1 y1 ... xn yn  Polyline using the given n points
         # B n x1 y1 ... xn yn  B-spline using the given n control points
         # b n x1 y1 ... xn yn  Filled B-spline using the given n control points
-        tokens = s.split()
-        n = int(tokens[0])
-        points = [float(t) for t in tokens[1:n * 2 + 1]]
-        didx = sum(len(t) for t in tokens[1:n * 2 + 1]) + n * 2 + 2
-        npoints = nsplit(points, 2)
+        token = find_token(s, pos)
+        n = count(token.group())
+        toks = tokens(token.end(), n * 2)
+        points = list(map(float, toks))
+        didx = sum(map(len, toks)) + n * 2 + 2
+        npoints = tuple(zip(points[::2], points[1::2]))
         return didx, (c, npoints)
 
-    def doCS(c, s):
+    def doCS(c, pos):
         """Parse fill or pen color"""
         # C n -c1c2...cn  Set fill color.
         # c n -c1c2...cn  Set pen color.
@@ -124,62 +734,61 @@ def parse_drawstring(drawstring):
         #   "#%2x%2x%2x%2x" Red-Green-Blue-Alpha (RGBA)
         #   H[, ]+S[, ]+V   Hue-Saturation-Value (HSV) 0.0 <= H,S,V <= 1.0
         #   string  color name
-        tokens = s.split()
-        n = int(tokens[0])
-        tmp = len(tokens[0]) + 3
-        d = s[tmp:tmp + n]
+        token = find_token(s, pos).group()
+        n = count(token)
+        tmp = len(token) + 3
+        d = s[pos + tmp:pos + tmp + n]
         didx = len(d) + tmp + 1
         return didx, (c, d)
 
-    def doFont(c, s):
+    def doFont(c, pos):
         # F s n -c1c2...cn
         # Set font. The font size is s points. The font name consists of
         # the n characters following '-'.
-        tokens = s.split()
-        size = tokens[0]
-        n = int(tokens[1])
-        tmp = len(size) + len(tokens[1]) + 4
-        d = s[tmp:tmp + n]
+        toks = tokens(pos, 2)
+        size = toks[0]
+        n = count(toks[1])
+        tmp = len(size) + len(toks[1]) + 4
+        d = s[pos + tmp:pos + tmp + n]
         didx = len(d) + tmp
-        return didx, (c, size, d)
+        return didx, (c, float(size), d)
 
-    def doText(c, s):
+    def doText(c, pos):
         # T x y j w n -c1c2...cn
         # Text drawn using the baseline point (x,y). The text consists of the
         # n characters following '-'. The text should be left-aligned
         # (centered, right-aligned) on the point if j is -1 (0, 1), respectively.
         # The value w gives the width of the text as computed by the library.
-        tokens = s.split()
-        x, y, j, w = tokens[0:4]
-        n = int(tokens[4])
-        tmp = sum(len(t) for t in tokens[0:5]) + 7
-        text = s[tmp:tmp + n]
+        toks = tokens(pos, 5)
+        x, y, j, w = toks[0:4]
+        n = count(toks[4])
+        tmp = sum(len(t) for t in toks[0:5]) + 7
+        text = s[pos + tmp:pos + tmp + n]
         didx = len(text) + tmp
-        return didx, [c, x, y, j, w, text]
+        return didx, (c, float(x), float(y), int(j), float(w), text, '')
 
     cmdlist = []
     stat = {}
     idx = 0
-    s = drawstring.strip().replace('\\', '')
     while idx < len(s) - 1:
         didx = 1
         c = s[idx]
         stat[c] = stat.get(c, 0) + 1
         try:
             if c in ('e', 'E'):
-                didx, cmd = doeE(c, s[idx + 1:])
+                didx, cmd = doeE(c, idx + 1)
                 cmdlist.append(cmd)
             elif c in ('p', 'P', 'L', 'b', 'B'):
-                didx, cmd = doPLB(c, s[idx + 1:])
+                didx, cmd = doPLB(c, idx + 1)
                 cmdlist.append(cmd)
             elif c in ('c', 'C', 'S'):
-                didx, cmd = doCS(c, s[idx + 1:])
+                didx, cmd = doCS(c, idx + 1)
                 cmdlist.append(cmd)
             elif c == 'F':
-                didx, cmd = doFont(c, s[idx + 1:])
+                didx, cmd = doFont(c, idx + 1)
                 cmdlist.append(cmd)
             elif c == 'T':
-                didx, cmd = doText(c, s[idx + 1:])
+                didx, cmd = doText(c, idx + 1)
                 cmdlist.append(cmd)
         except Exception as err:
             log.debug("Failed to parse drawstring %s\n%s", s, str(err))
@@ -188,6 +797,88 @@ def parse_drawstring(drawstring):
     return cmdlist, stat
 
 
+_json_text_align = {'l': -1, 'c': 0, 'r': 1}
+
+
+def parse_draw_records(records):
+    """Convert JSON draw records to the format returned by parse_drawstring
+
+    The records are the draw operations found in the output of dot -Tjson.
+    """
+    cmdlist = []
+    stat = {}
+    for record in records:
+        c = record.get('op')
+        try:
+            if c in ('e', 'E'):
+                x, y, w, h = record['rect']
+                cmd = (c, float(x), float(y), float(w), float(h))
+            elif c in ('p', 'P', 'L', 'b', 'B'):
+                cmd = (c, tuple((float(x), float(y)) for x, y in record['points']))
+            elif c in ('c', 'C'):
+                color = record.get('color')
+                if color is None:
+                    # Gradients are not supported. Use the first color stop
+                    color = record['stops'][0]['color']
+                cmd = (c, color)
+            elif c == 'S':
+                cmd = (c, record['style'])
+            elif c == 'F':
+                cmd = (c, float(record['size']), record['face'])
+            elif c == 'T':
+                x, y = record['pt']
+                cmd = (c, float(x), float(y), _json_text_align.get(record.get('align'), 0),
+                       float(record['width']), record['text'], '')
+            else:
+                continue
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            log.debug("Failed to convert draw record %s\n%s", record, str(err))
+            continue
+        stat[c] = stat.get(c, 0) + 1
+        cmdlist.append(cmd)
+    return cmdlist, stat
+
+
+def get_draw_records(drawobj, attrname):
+    """Return the JSON draw records of drawobj for the attrname draw attribute"""
+    draw_records = getattr(drawobj, 'draw_records', None)
+    if draw_records:
+        return draw_records.get(attrname)
+    return None
+
+
+def get_drawattr_ops(drawobj, attrname):
+    """Return the draw operations in the attrname attribute of drawobj
+
+    The operations are read from JSON draw records or from an xdot
+    drawstring. Returns a tuple with the operations as returned by
+    parse_drawstring, and a tuple with the (operation, count) items of the
+    statistics. They are parsed once and cached on drawobj under attrname.
+    Returns None if drawobj has no draw data for attrname.
+    """
+    records = get_draw_records(drawobj, attrname)
+    if records:
+        return drawobj.get_cached(attrname, records, _parse_draw_records)
+    drawstring = drawobj.attr.get(attrname, "")
+    if not drawstring.strip():
+        return None
+    return drawobj.get_cached(attrname, drawstring, _parse_drawstring)
+
+
+# The cached operations are kept in plain tuples. Unlike lists, dicts and
+# tuple subclasses, tuples are no longer tracked by the garbage collector
+# once they are found to only contain numbers and strings. Tracked objects
+# kept alive for every element in large graphs make the collections slow.
+def _parse_drawstring(drawstring):
+    ops, stat = parse_drawstring(drawstring)
+    return tuple(ops), tuple(stat.items())
+
+
+def _parse_draw_records(records):
+    ops, stat = parse_draw_records(records)
+    return tuple(ops), tuple(stat.items())
+
+
 def get_graphlist(gg, l=None):
     """Traverse a graph with subgraphs and return them as a list"""
     if not l:
@@ -216,6 +907,77 @@ def get_drawobj_lblstyle(drawobj, extra_styles=None):
     ])) or None
 
 
+# Template tags replaced by the figure code
+_body_tags_re = re.compile('<<figcode>>|<<drawcommands>>')
+
+
+def write_pieces(outfile, pieces):
+    """Write the strings in pieces to outfile, a file name or a file object
+
+    The pieces are collected before a file named outfile is opened, so the
+    file is left as it was if producing them fails. Only references to
+    the pieces are kept, not a joined copy of the output.
+    """
+    if isinstance(outfile, str):
+        pieces = list(pieces)
+        with open(outfile, 'w') as f:
+            f.writelines(pieces)
+    else:
+        outfile.writelines(pieces)
+
+
+def preproc_graphcode(graph):
+    """Return the dot source for a graph from the preprocessing"""
+    graphcode = str(graph)
+    graphcode = graphcode.replace('<<<', '<<')
+    graphcode = graphcode.replace('>>>', '>>')
+    return graphcode
+
+
+class ColorPalette(object):
+    """The colors used in a figure
+
+    Each Graphviz color is converted once by convert, a function like
+    DotConvBase.convert_color that returns the converted color, or a
+    (color, opacity) tuple. Converted colors that must be defined before
+    they are used, like RGB and HSB values in the form {model}{values},
+    are named prefix1, prefix2, ... in the order they are first used.
+    The same value always gets the same name.
+    """
+
+    def __init__(self, convert, prefix='d2tcol'):
+        self.convert = convert
+        self.prefix = prefix
+        self.colors = {}
+        self.names = {}
+        self.definitions = []
+
+    def get(self, color):
+        """Return (name, opacity) for color
+
+        opacity is None unless convert returned one.
+        """
+        try:
+            return self.colors[color]
+        except KeyError:
+            pass
+        converted = self.convert(color)
+        if isinstance(converted, tuple):
+            converted, opacity = converted
+        else:
+            opacity = None
+        if converted.startswith('{'):
+            name = self.names.get(converted)
+            if name is None:
+                name = "%s%d" % (self.prefix, len(self.definitions) + 1)
+                self.names[converted] = name
+                self.definitions.append((name, converted))
+        else:
+            name = converted
+        self.colors[color] = name, opacity
+        return name, opacity
+
+
 class DotConvBase(object):
     """Dot2TeX converter base"""
 
@@ -228,7 +990,7 @@ class DotConvBase(object):
             self.template = options.get('template', '')
         self.textencoding = options.get('encoding', DEFAULT_TEXTENCODING)
         self.templatevars = {}
-        self.body = ""
+        self.chunks = []
         if options.get('templatefile', ''):
             self.load_template(options['templatefile'])
         if options.get('template', ''):
@@ -239,6 +1001,36 @@ class DotConvBase(object):
             self.dopreproc = True
         else:
             self.dopreproc = False
+        self.precision = options.get('precision')
+        if self.precision is not None:
+            self.precision = max(0, int(self.precision))
+
+    @property
+    def body(self):
+        """The figure code written so far, as a single string"""
+        return "".join(self.chunks)
+
+    @body.setter
+    def body(self, code):
+        self.chunks = [code]
+
+    def write(self, code):
+        """Add code to the figure code
+
+        The code is kept as a list of chunks, which are only joined when the
+        output is returned as a string.
+        """
+        self.chunks.append(code)
+
+    def format_float(self, number):
+        """Format a coordinate or size using the precision option"""
+        if self.precision is None:
+            return smart_float(number)
+        return fixed_float(number, self.precision)
+
+    def format_points(self, points):
+        """Format a list of (x, y) points as (xbp,ybp) coordinates"""
+        return format_points(points, precision=self.precision)
 
     def load_template(self, templatefile):
         try:
@@ -257,6 +1049,14 @@ class DotConvBase(object):
     def end_fig(self):
         return ""
 
+    def define_colors(self):
+        """Return code defining the colors used in the figure
+
+        The code is inserted before the rest of the figure code when the
+        conversion is done, so every color is only defined once.
+        """
+        return ""
+
     def draw_ellipse(self, drawop, style=None):
         return ""
 
@@ -361,6 +1161,43 @@ class DotConvBase(object):
         drawoperations, stat = parse_drawstring(drawstring)
         return self.do_draw_op(drawoperations, drawobj, stat, texlbl_name, use_drawstring_pos)
 
+    def get_drawops(self, drawobj, *attrnames):
+        """Return the draw operations stored in the attrnames attributes
+
+        The operations are read from xdot draw strings or from JSON draw
+        records, see get_drawattr_ops. Returns new lists that may be
+        changed, or (None, None) if drawobj has no draw data.
+        """
+        drawoperations = []
+        stat = {}
+        found = False
+        for attrname in attrnames:
+            parsed = get_drawattr_ops(drawobj, attrname)
+            if parsed is None:
+                continue
+            ops, opstat = parsed
+            found = True
+            drawoperations.extend(ops)
+            for c, count in opstat:
+                stat[c] = stat.get(c, 0) + count
+        if not found:
+            return None, None
+        return drawoperations, stat
+
+    def has_drawops(self, drawobj, *attrnames):
+        """Return True if drawobj has draw data in the attrnames attributes"""
+        for attrname in attrnames:
+            if get_draw_records(drawobj, attrname) or drawobj.attr.get(attrname, "").strip():
+                return True
+        return False
+
+    def do_drawattr(self, drawobj, attrname, texlbl_name="texlbl", use_drawstring_pos=False):
+        """Draw the operations stored in the attrname attribute of drawobj"""
+        drawoperations, stat = self.get_drawops(drawobj, attrname)
+        if drawoperations is None:
+            return ""
+        return self.do_draw_op(drawoperations, drawobj, stat, texlbl_name, use_drawstring_pos)
+
     def do_draw_op(self, drawoperations, drawobj, stat, texlbl_name="texlbl", use_drawstring_pos=False):
         """Excecute the operations in drawoperations"""
         s = ""
@@ -396,7 +1233,6 @@ class DotConvBase(object):
                 # string. Use \\ instead
                 # Todo: Use text from node|edge.label or name
                 # Todo: What about multiline labels?
-                text = drawop[5]
                 # head and tail label
                 texmode = self.options.get('texmode', 'verbatim')
                 label = text = drawobj.attr.get('label', '')
@@ -415,63 +1251,47 @@ class DotConvBase(object):
                 elif label and len(drawoperations) == 1:
                     text = label
 
-                drawop[5] = text
-                if self.options.get('alignstr', ''):
-                    drawop.append(self.options.get('alignstr'))
+                drawop = drawop[:5] + (text, self.options.get('alignstr', '') or '')
                 if stat['T'] == 1 and \
                         self.options.get('valignmode', 'center') == 'center':
                     # do this for single line only
                     # force centered alignment
-                    drawop[3] = '0'
+                    drawop = drawop[:3] + (0,) + drawop[4:]
                     if not use_drawstring_pos:
                         if texlbl_name == "tailtexlbl":
-                            pos = drawobj.attr.get('tail_lp') or \
-                                  drawobj.attr.get('pos')
+                            lp_name = 'tail_lp'
                         elif texlbl_name == "headtexlbl":
-                            pos = drawobj.attr.get('head_lp') or \
-                                  drawobj.attr.get('pos')
+                            lp_name = 'head_lp'
+                        else:
+                            lp_name = 'lp'
+                        if drawobj.attr.get(lp_name):
+                            pos = drawobj.get_point(lp_name)
                         else:
-                            pos = drawobj.attr.get('lp') or \
-                                  drawobj.attr.get('pos')
+                            pos = drawobj.get_point('pos')
 
                         if pos:
-                            coord = pos.split(',')
-                            if len(coord) == 2:
-                                drawop[1] = coord[0]
-                                drawop[2] = coord[1]
-                            pass
+                            drawop = (op, pos[0], pos[1]) + drawop[3:]
 
                 lblstyle = get_drawobj_lblstyle(drawobj, extra_styles=drawobj.attr.get('exstyle'))
                 s += self.draw_text(drawop, lblstyle)
         return s
 
     def do_nodes(self):
-        s = ""
+        write = self.write
         for node in self.nodes:
             self.currentnode = node
-            general_draw_string = node.attr.get('_draw_', "")
-            label_string = node.attr.get('_ldraw_', "")
-
-            drawstring = general_draw_string + " " + label_string
-
-            if not drawstring.strip():
+            drawoperations, stat = self.get_drawops(node, '_draw_', '_ldraw_')
+            if drawoperations is None:
                 continue
             # detect node type
             shape = node.attr.get('shape', '')
             if not shape:
                 shape = 'ellipse'  # default
-                # extract size information
-            x, y = node.attr.get('pos', '').split(',')
 
-            # width and height are in inches. Convert to bp units
-            # w = float(node.attr['width']) * INCH2BP
-            # h = float(node.attr['height']) * INCH2BP
-
-            s += self.output_node_comment(node)
-            s += self.start_node(node)
-            s += self.do_drawstring(drawstring, node)
-            s += self.end_node(node)
-        self.body += s
+            write(self.output_node_comment(node))
+            write(self.start_node(node))
+            write(self.do_draw_op(drawoperations, node, stat))
+            write(self.end_node(node))
 
     def get_edge_points(self, edge):
         # edge BNF
@@ -486,37 +1306,19 @@ class DotConvBase(object):
         ##and endp  =   "e,%d,%d"
         ##and startp    =   "s,%d,%d"
         ##If a spline has points p1 p2 p3 ... pn, (n = 1 (mod 3)), the points correspond to the control points of a B-spline from p1 to pn. If startp is given, it touches one node of the edge, and the arrowhead goes from p1 to startp. If startp is not given, p1 touches a node. Similarly for pn and endp.
-        pos = edge.attr.get('pos')
-        if pos:
-            segments = pos.split(';')
-        else:
-            return []
-
         return_segments = []
-        for pos in segments:
-            points = pos.split(' ')
+        for startp, endp, points in edge.get_spline():
+            points = list(points)
             # check direction
             arrow_style = '--'
-            i = 0
-            if points[i].startswith('s'):
-                p = points[0].split(',')
-                tmp = "%s,%s" % (p[1], p[2])
-                if points[1].startswith('e'):
-                    points[2] = tmp
-                else:
-                    points[1] = tmp
-                del points[0]
+            if startp:
+                points[0] = startp
                 arrow_style = '<-'
-                i += 1
-            if points[0].startswith('e'):
-                p = points[0].split(',')
-                points.pop()
-                points.append("%s,%s" % (p[1], p[2]))
-                del points[0]
+            if endp:
+                points[-1] = endp
                 arrow_style = '->'
-                i += 1
-            if i > 1:
-                arrow_style = '<->'
+                if startp:
+                    arrow_style = '<->'
 
             arrow_style = self.get_output_arrow_styles(arrow_style, edge)
 
@@ -525,55 +1327,57 @@ class DotConvBase(object):
         return return_segments
 
     def do_edges(self):
-        s = ""
-        s += self.set_color(('cC', "black"))
+        write = self.write
+        write(self.set_color(('cC', "black")))
         for edge in self.edges:
-            general_draw_string = edge.attr.get('_draw_', "")
-            label_string = edge.attr.get('_ldraw_', "")
-            head_arrow_string = edge.attr.get('_hdraw_', "")
-            tail_arrow_string = edge.attr.get('_tdraw_', "")
-            tail_label_string = edge.attr.get('_tldraw_', "")
-            head_label_string = edge.attr.get('_hldraw_', "")
-
-            # Note that the order of the draw strings should be the same
+            # Note that the order of the draw attributes should be the same
             # as in the xdot output.
-            drawstring = general_draw_string + " " + head_arrow_string + " " + tail_arrow_string \
-                         + " " + label_string
-            drawop, stat = parse_drawstring(drawstring)
-            if not drawstring.strip():
+            drawattrs = ('_draw_', '_hdraw_', '_tdraw_', '_ldraw_')
+            if not self.has_drawops(edge, *drawattrs):
                 continue
-            s += self.output_edge_comment(edge)
+            write(self.output_edge_comment(edge))
             if self.options.get('duplicate'):
-                s += self.start_edge()
-                s += self.do_draw_op(drawop, edge, stat)
-                s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-                s += self.end_edge()
+                drawop, stat = self.get_drawops(edge, *drawattrs)
+                write(self.start_edge())
+                write(self.do_draw_op(drawop, edge, stat))
+                write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
+                write(self.end_edge())
             else:
-                s += self.draw_edge(edge)
-                s += self.do_drawstring(label_string, edge)
-                s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-        self.body += s
+                write(self.draw_edge(edge))
+                write(self.do_drawattr(edge, '_ldraw_'))
+                write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
 
     def do_graph(self):
         general_draw_string = self.graph.attr.get('_draw_', "")
-        label_string = self.graph.attr.get('_ldraw_', "")
+        general_draw_records = get_draw_records(self.graph, '_draw_')
         # Avoid filling background of graphs with white
-        if general_draw_string.startswith('c 5 -white C 5 -white') \
-                and not self.graph.attr.get('style'):
-            general_draw_string = ''
-        if getattr(self.graph, '_draw_', None):
+        if not self.graph.attr.get('style'):
+            if general_draw_string.startswith('c 5 -white C 5 -white'):
+                general_draw_string = ''
+            if general_draw_records and \
+                    [(r.get('op'), r.get('color')) for r in general_draw_records[:2]] == \
+                    [('c', 'white'), ('C', 'white')]:
+                general_draw_records = None
+        drawoperations = []
+        stat = {}
+        if general_draw_records or general_draw_string.strip():
+            drawoperations, stat = self.get_drawops(self.graph, '_draw_')
+        if getattr(self.graph, '_draw_', None) or get_draw_records(self.graph, '_draw_'):
             # bug
-            general_draw_string = "c 5 -black " + general_draw_string  # self.graph._draw_
-            pass
-        drawstring = general_draw_string + " " + label_string
-        if drawstring.strip():
+            drawoperations.insert(0, ('c', 'black'))
+        label_ops, label_stat = self.get_drawops(self.graph, '_ldraw_')
+        if label_ops:
+            drawoperations.extend(label_ops)
+            for c, count in label_stat.items():
+                stat[c] = stat.get(c, 0) + count
+        if drawoperations:
             s = self.start_graph(self.graph)
-            g = self.do_drawstring(drawstring, self.graph)
+            g = self.do_draw_op(drawoperations, self.graph, stat)
             e = self.end_graph(self.graph)
             if g.strip():
-                self.body += s + g + e
+                self.write(s + g + e)
 
     def set_options(self):
         # process options
@@ -587,26 +1391,59 @@ class DotConvBase(object):
         self.options['valignmode'] = getattr(self.main_graph, 'd2tvalignmode', '') \
                                      or self.options.get('valignmode', 'center')
 
-    def convert(self, dotdata):
+    def convert(self, dotdata, layout=None, outfile=None):
+        """Convert dotdata and return the result
+
+        dotdata is either dot source or a DotGraph instance, like the
+        preprocessed graph returned when the autosize option is set.
+        layout is the output from Graphviz for dotdata, as returned by
+        create_xdot_batch. It is used instead of running Graphviz.
+        If outfile is given, the result is written piece by piece to
+        outfile, a file name or a file object, and None is returned.
+        """
         # parse data processed by dot.
         log.debug('Start conversion')
-        main_graph = parse_dot_data(dotdata)
+        if isinstance(dotdata, dotparsing.DotGraph):
+            main_graph = dotdata
+        else:
+            main_graph = parse_dot_data(dotdata, self.options.get('parser'))
+        columns = None
 
         if not self.dopreproc and not hasattr(main_graph, 'xdotversion'):
             # Older versions of Graphviz does not include the xdotversion
             # attribute
-            if not (dotdata.find('_draw_') > 0 or dotdata.find('_ldraw_') > 0):
+            if isinstance(dotdata, dotparsing.DotGraph):
+                has_xdot = has_draw_attrs(dotdata)
+            else:
+                has_xdot = dotdata.find('_draw_') > 0 or dotdata.find('_ldraw_') > 0
+            if not has_xdot:
                 # need to convert to xdot format
                 # Warning. Pydot will not include custom attributes
                 log.info('Trying to create xdotdata')
 
-                tmpdata = create_xdot(dotdata, self.options.get('prog', 'dot'),
-                                      options=self.options.get('progoptions', ''))
+                layoutformat = get_layout_format(self.options)
+                if layout is not None:
+                    tmpdata = layout
+                else:
+                    tmpdata = create_xdot(dotdata, self.options.get('prog', 'dot'),
+                                          options=self.options.get('progoptions', ''),
+                                          output_format=layoutformat,
+                                          cache=get_layout_cache_from_options(self.options),
+                                          backend=self.options.get('layoutbackend') or 'process')
                 if tmpdata is None or not tmpdata.strip():
                     log.error('Failed to create xdotdata. Is Graphviz installed?')
                     sys.exit(1)
                 log.debug('xdotdata:\n' + str(tmpdata))
-                main_graph = parse_dot_data(tmpdata)
+                if layoutformat == 'json':
+                    main_graph = dotparsing.graph_from_json(tmpdata)
+                elif self.options.get('columnar'):
+                    try:
+                        main_graph, columns = dotparsing.read_xdot_columns(tmpdata)
+                    except (dotparsing.XDotFormatError, dotparsing.ParseException) as err:
+                        log.debug('Failed to read xdot data into columns. %s', err)
+                        main_graph = parse_dot_data(tmpdata, self.options.get('parser'), xdot=True)
+                else:
+                    main_graph = parse_dot_data(tmpdata, self.options.get('parser'), xdot=True)
                 log.debug('dotparsing graph:\n' + str(main_graph))
             else:
                 # old version
@@ -620,20 +1457,28 @@ class DotConvBase(object):
         self.directedgraph = main_graph.directed
 
         if self.dopreproc:
-            return self.do_preview_preproc()
+            code = self.do_preview_preproc()
+            if outfile is not None:
+                if isinstance(code, dotparsing.DotGraph):
+                    code = preproc_graphcode(code)
+                write_pieces(outfile, [code])
+                return None
+            return code
 
         # Remove annoying square
         # Todo: Remove squares from subgraphs. See pgram.dot
         dstring = self.main_graph.attr.get('_draw_', "")
         if dstring:
             self.main_graph.attr['_draw_'] = ""
+        if get_draw_records(self.main_graph, '_draw_'):
+            del self.main_graph.draw_records['_draw_']
 
         self.set_options()
 
         # A graph can consists of nested graph. Extract all graphs
         graphlist = get_graphlist(self.main_graph, [])
 
-        self.body += self.start_fig()
+        self.write(self.start_fig())
 
         # To get correct drawing order we need to iterate over the graphs
         # multiple times. First we draw the graph graphics, then nodes and
@@ -645,8 +1490,15 @@ class DotConvBase(object):
             self.do_graph()
 
         if True:
-            self.nodes = list(main_graph.allnodes)
-            self.edges = list(main_graph.alledges)
+            if self.options.get('columnar'):
+                # Iterate over the elements without an object for each
+                if columns is None:
+                    columns = dotparsing.DotColumns.from_graph(main_graph)
+                self.nodes = columns.nodes
+                self.edges = columns.edges
+            else:
+                self.nodes = list(main_graph.allnodes)
+                self.edges = list(main_graph.alledges)
             if not self.options.get('switchdraworder'):
                 self.do_edges()  # tmp
                 self.do_nodes()
@@ -654,7 +1506,11 @@ class DotConvBase(object):
                 self.do_nodes()
                 self.do_edges()
 
-        self.body += self.end_fig()
+        self.write(self.end_fig())
+        self.chunks.insert(0, self.define_colors())
+        if outfile is not None:
+            self.write_output(outfile)
+            return None
         return self.output()
 
     def clean_template(self, template):
@@ -695,17 +1551,16 @@ class DotConvBase(object):
     def init_template_vars(self):
         variables = {}
         # get bounding box
-        bbstr = self.main_graph.attr.get('bb', '')
-        if bbstr:
-            bb = bbstr.split(',')
-            variables['<<bbox>>'] = "(%sbp,%sbp)(%sbp,%sbp)\n" % (
-                smart_float(bb[0]), smart_float(bb[1]), smart_float(bb[2]), smart_float(bb[3]))
+        bb = self.main_graph.get_rect('bb')
+        if bb:
+            bb = [self.format_float(c) for c in bb]
+            variables['<<bbox>>'] = "(%sbp,%sbp)(%sbp,%sbp)\n" % tuple(bb)
             variables['<<bbox.x0>>'] = bb[0]
             variables['<<bbox.y0>>'] = bb[1]
             variables['<<bbox.x1>>'] = bb[2]
             variables['<<bbox.y1>>'] = bb[3]
-        variables['<<figcode>>'] = self.body.strip()
-        variables['<<drawcommands>>'] = self.body.strip()
+        # The figure code is inserted by iter_output
+        variables['<<figcode>>'] = variables['<<drawcommands>>'] = ''
         variables['<<textencoding>>'] = self.textencoding
         docpreamble = (self.options.get('docpreamble', '')
                        or getattr(self.main_graph, 'd2tdocpreamble', ''))
@@ -725,12 +1580,42 @@ class DotConvBase(object):
             variables['<<gvcols>>'] = ""
         self.templatevars = variables
 
-    def output(self):
+    def iter_body(self):
+        """Yield the chunks of the figure code, stripped of whitespace"""
+        chunks = self.chunks
+        start, end = 0, len(chunks)
+        while start < end and not chunks[start].strip():
+            start += 1
+        while end > start and not chunks[end - 1].strip():
+            end -= 1
+        if end - start == 1:
+            yield chunks[start].strip()
+        elif end - start > 1:
+            yield chunks[start].lstrip()
+            for i in range(start + 1, end - 1):
+                yield chunks[i]
+            yield chunks[end - 1].rstrip()
+
+    def iter_output(self):
+        """Yield the output in pieces
+
+        The template is filled in around the figure code, which is yielded
+        chunk by chunk instead of being joined into one string first.
+        """
         self.init_template_vars()
         template = self.clean_template(self.template)
-        code = replace_tags(template, self.templatevars,
-                            self.templatevars)
-        return code
+        for i, part in enumerate(_body_tags_re.split(template)):
+            if i:
+                for chunk in self.iter_body():
+                    yield chunk
+            yield replace_tags(part, self.templatevars, self.templatevars)
+
+    def write_output(self, outfile):
+        """Write the output to outfile, a file name or a file object"""
+        write_pieces(outfile, self.iter_output())
+
+    def output(self):
+        return "".join(self.iter_output())
 
     def get_label(self, drawobj, label_attribute="label", tex_label_attribute="texlbl"):
         text = ""
@@ -958,10 +1843,12 @@ To see what happened, run dot2tex with the --debug option.
 
         self.main_graph.attr['d2toutputformat'] = self.options.get('format',
                                                                    DEFAULT_OUTPUT_FORMAT)
-        graphcode = str(self.main_graph)
-        graphcode = graphcode.replace('<<<', '<<')
-        graphcode = graphcode.replace('>>>', '>>')
-        return graphcode
+        if self.options.get('autosize') and not hasattr(self.main_graph, 'xdotversion') \
+                and not has_draw_attrs(self.main_graph):
+            # The graph is passed on to the next conversion and written
+            # directly to Graphviz from there.
+            return self.main_graph
+        return preproc_graphcode(self.main_graph)
 
     def get_output_arrow_styles(self, arrow_style, edge):
         return arrow_style
@@ -1038,35 +1925,22 @@ class TeXDimProc:
 
     def parse_log_file(self):
         logfilename = os.path.splitext(self.tempfilename)[0] + '.log'
-        tmpdir = os.getcwd()
-        os.chdir(os.path.split(logfilename)[0])
         if self.options.get('usepdflatex'):
-            command = 'pdflatex -interaction=nonstopmode %s' % self.tempfilename
+            command = ['pdflatex', '-interaction=nonstopmode', self.tempfilename]
         else:
-            command = 'latex -interaction=nonstopmode %s' % self.tempfilename
+            command = ['latex', '-interaction=nonstopmode', self.tempfilename]
         log.debug('Running command: %s' % command)
 
-        p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
-        (stdout, stderr) = (p.stdout, p.stderr)
-        try:
-            data = stdout.read()
-            log.debug("stdout from latex\n %s", data)
-        finally:
-            stdout.close()
-
-        try:
-            error_data = stderr.read()
-            if error_data:
-                log.debug('latex STDERR %s', error_data)
-        finally:
-            stderr.close()
-        p.kill()
-        p.wait()
+        # The working directory is passed to latex instead of changed with
+        # os.chdir, so several graphs can be converted at the same time.
+        data, error_data = run_latex(command, os.path.dirname(logfilename))
+        log.debug("stdout from latex\n %s", data)
+        if error_data:
+            log.debug('latex STDERR %s', error_data)
 
         with open(logfilename, 'r') as f:
             logdata = f.read()
         log.debug('Logfile from LaTeX run: \n' + logdata)
-        os.chdir(tmpdir)
 
         texdimdata = self.dimext_re.findall(logdata)
         log.debug('Texdimdata: ' + str(texdimdata))
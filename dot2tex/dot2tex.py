@@ -28,6 +28,7 @@ Copyright (c) 2006-2019, Kjell Magne Fauske
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 from .base import DEFAULT_TEXTENCODING, DEFAULT_OUTPUT_FORMAT
+from . import base
 from .pgfformat import Dot2PGFConv, Dot2TikZConv, PositionsDotConv
 from .pstricksformat import Dot2PSTricksConv, Dot2PSTricksNConv
 
@@ -39,6 +40,7 @@ import argparse
 import os.path as path
 import sys, os, re
 import logging
+import time
 
 from . import dotparsing
 
@@ -70,6 +72,11 @@ dot2tex in debug mode using the --debug option:
 A file dot2tex.log will be written to the current directory with detailed
 information useful for debugging."""
 
+# A line in the input containing an \input{filename}
+input_re = re.compile(r"^\s*\\input\{(?P<filename>.+?)\}", re.MULTILINE)
+# Options given in the graph with d2toptions="..."
+d2toptions_re = re.compile(r'^\s*d2toptions\s*=\s*"(.*?)"\s*;?', re.MULTILINE)
+
 
 def create_options_parser():
     """Create and and return an options parser."""
@@ -96,6 +103,10 @@ def create_options_parser():
         '-s', '--straightedges', dest='straightedges', action='store_true',
         default=False, help='Force straight edges'
     )
+    parser.add_argument(
+        '--precision', dest='precision', action='store', type=int, default=None,
+        help='Number of decimals used for coordinates and sizes', metavar='N'
+    )
     parser.add_argument(
         '--template', dest='templatefile', action='store',
         metavar='FILE'
@@ -208,6 +219,41 @@ def create_options_parser():
         default='', help='Pass options to graph layout engine',
         metavar='OPTIONS'
     )
+    parser.add_argument(
+        '--parser', action='store', dest='parser', default='pyparsing',
+        choices=('pyparsing', 'recursive'),
+        help='Use parser engine v to parse dot data (pyparsing, recursive)',
+        metavar='v'
+    )
+    parser.add_argument(
+        '--packrat', dest='packrat', action='store_true', default=False,
+        help='Enable packrat memoization in the pyparsing parser'
+    )
+    parser.add_argument(
+        '--columnar', dest='columnar', action='store_true', default=False,
+        help='Store nodes and edges in arrays. Uses less memory for very large graphs'
+    )
+    parser.add_argument(
+        '--layoutformat', action='store', dest='layoutformat', default='xdot',
+        choices=('xdot', 'json', 'auto'),
+        help='Read layout data from Graphviz in format v (xdot, json, auto)',
+        metavar='v'
+    )
+    parser.add_argument(
+        '--layoutbackend', action='store', dest='layoutbackend', default='process',
+        choices=('process', 'library'),
+        help='Run the Graphviz programs (process) or lay out graphs in-process '
+             'with the Graphviz library when it is available (library)',
+        metavar='v'
+    )
+    parser.add_argument(
+        '--layoutcache', action='store', dest='layoutcache', default=None,
+        help='Cache Graphviz layouts in directory DIR', metavar='DIR'
+    )
+    parser.add_argument(
+        '--layoutcachesize', action='store', dest='layoutcachesize', type=int,
+        default=100, help='Maximum size of the layout cache in megabytes', metavar='MB'
+    )
     parser.add_argument(
         '--autosize', dest='autosize',
         help='Preprocess graph and then run Graphviz',
@@ -224,6 +270,37 @@ def create_options_parser():
         '--pgf210', dest='pgf210', action='store_true',
         help='Generate code compatible with PGF 2.10', default=False
     )
+    parser.add_argument(
+        '--batch', dest='batch', action='store', nargs='+', default=None,
+        help='Convert several input files, each to a .tex file', metavar='FILE'
+    )
+    parser.add_argument(
+        '--manifest', dest='manifest', action='store', default=None,
+        help='Convert the input files listed in FILE, one per line', metavar='FILE'
+    )
+    parser.add_argument(
+        '--outputdir', dest='outputdir', action='store', default=None,
+        help='Write the output files from batch mode to DIR', metavar='DIR'
+    )
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', action='store', type=int, default=None,
+        help='Number of processes used in batch mode. Defaults to the number of CPUs',
+        metavar='N'
+    )
+    parser.add_argument(
+        '--watch', dest='watch', action='store', default=None,
+        help='Convert the dot files in DIR whenever they change', metavar='DIR'
+    )
+    parser.add_argument(
+        '--serve', dest='serve', action='store', default=None,
+        help='Run a conversion server on ADDRESS, a Unix socket path or host:port',
+        metavar='ADDRESS'
+    )
+    parser.add_argument(
+        '--server', dest='server', action='store', default=None,
+        help='Let the conversion server on ADDRESS convert the graph',
+        metavar='ADDRESS'
+    )
     parser.add_argument(
         'inputfile', action='store',
         nargs='?', default=None, help='Input dot file'
@@ -250,6 +327,243 @@ def print_version_info():
     print("Dot2tex version % s" % __version__)
 
 
+def output_is_newer(inputfile, outputfile):
+    """Return True if outputfile exists and is newer than inputfile"""
+    input_exists = os.access(inputfile, os.F_OK)
+    output_exists = os.access(outputfile, os.F_OK)
+
+    if input_exists and output_exists:
+        input_modified_time = os.stat(inputfile)[8]
+        output_modified_time = os.stat(outputfile)[8]
+        return input_modified_time < output_modified_time
+    return False
+
+
+def get_batch_files(options):
+    """Return a list of (input file, output file) pairs for batch mode
+
+    The input files are given by the batch option and listed in the manifest
+    file, where blank lines and lines starting with # are ignored. Relative
+    paths in the manifest are relative to its directory. Output files are
+    named after the input files with a .tex extension, and are written to
+    the outputdir directory or next to the input files.
+    """
+    inputfiles = list(options.batch or [])
+    if options.inputfile:
+        inputfiles.append(options.inputfile)
+    if options.manifest:
+        manifest_dir = path.dirname(options.manifest)
+        with open(options.manifest, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    inputfiles.append(path.join(manifest_dir, line))
+    return [(inputfile, get_output_file(inputfile, options.outputdir))
+            for inputfile in inputfiles]
+
+
+def get_output_file(inputfile, outputdir=None):
+    """Return the .tex file in outputdir, or next to inputfile, for inputfile"""
+    outputname = path.splitext(path.basename(inputfile))[0] + '.tex'
+    return path.join(outputdir or path.dirname(inputfile), outputname)
+
+
+def _convert_file(inputfile, outputfile, options):
+    """Convert inputfile to outputfile. Returns an error message on failure"""
+    options = argparse.Namespace(**vars(options))
+    options.inputfile = inputfile
+    options.outputfile = outputfile
+    options.batch = options.manifest = None
+    options.streamoutput = True
+    try:
+        main(True, "".join(load_dot_file(inputfile)), options)
+    except SystemExit:
+        return '%s: conversion failed' % inputfile
+    except Exception as err:
+        return '%s: %s' % (inputfile, str(err).strip() or err.__class__.__name__)
+    return None
+
+
+def run_batch(options):
+    """Convert the files given in batch mode in parallel
+
+    The files are converted by a pool of options.jobs processes. Files with
+    an output file newer than the input are skipped unless options.force is
+    set. Returns the exit code for dot2tex, and lists the files that could
+    not be converted on stderr.
+    """
+    files = get_batch_files(options)
+    seen = set()
+    todo = []
+    failures = []
+    for inputfile, outputfile in files:
+        if outputfile in seen:
+            failures.append('%s: output file %s is used twice' % (inputfile, outputfile))
+        elif not options.force and output_is_newer(inputfile, outputfile):
+            log.info('skip: %s older than %s', inputfile, outputfile)
+        else:
+            todo.append((inputfile, outputfile))
+        seen.add(outputfile)
+    if options.outputdir and not path.isdir(options.outputdir):
+        os.makedirs(options.outputdir)
+
+    jobs = min(options.jobs or os.cpu_count() or 1, len(todo))
+    log.info('Converting %d of %d files with %d processes', len(todo), len(files), jobs)
+    inputfiles = [inputfile for inputfile, outputfile in todo]
+    outputfiles = [outputfile for inputfile, outputfile in todo]
+    if jobs > 1:
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(_convert_file, inputfiles, outputfiles,
+                                        [options] * len(todo)))
+    else:
+        results = [_convert_file(inputfile, outputfile, options)
+                   for inputfile, outputfile in todo]
+    failures.extend(result for result in results if result)
+    if failures:
+        sys.stderr.write('dot2tex: %d of %d files failed:\n' % (len(failures), len(files)))
+        for failure in failures:
+            sys.stderr.write('  %s\n' % failure)
+        return 1
+    return 0
+
+
+def _get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class DotFileWatcher(object):
+    """Convert the dot files in a directory when they change
+
+    The directory is polled for files with the extensions in
+    dot_extensions. A file is converted when it, the file given by its
+    \input line or the template file changes, and no further changes are
+    seen for debounce seconds. Files with an output newer than the input
+    are not converted at startup unless options.force is set. All
+    conversions run in this process, so parsers and the location of
+    Graphviz are reused.
+    """
+
+    dot_extensions = ('.dot', '.gv')
+
+    def __init__(self, directory, options, debounce=0.3):
+        self.directory = directory
+        self.options = argparse.Namespace(**vars(options))
+        self.options.watch = None
+        self.debounce = debounce
+        self.signatures = {}
+        self.input_files = {}
+        self.mtimes = {}
+        self.pending = {}
+        self.template_mtime = None
+        self.first_scan = True
+
+    def find_dot_files(self):
+        dotfiles = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dotfiles.extend(path.join(dirpath, filename) for filename in filenames
+                            if path.splitext(filename)[1] in self.dot_extensions)
+        return dotfiles
+
+    def load_template(self):
+        """Read the template file once instead of once per conversion"""
+        templatefile = self.options.templatefile
+        if not templatefile:
+            return False
+        mtime = _get_mtime(templatefile)
+        if mtime == self.template_mtime:
+            return False
+        self.template_mtime = mtime
+        try:
+            with open(templatefile) as f:
+                self.options.template = f.read()
+        except IOError:
+            log.warning('Failed to read the template file %s', templatefile)
+        return True
+
+    def scan(self, now):
+        """Mark the files that have changed since the last scan"""
+        template_changed = self.load_template() and not self.first_scan
+        dotfiles = self.find_dot_files()
+        for dotfile in set(self.signatures) - set(dotfiles):
+            del self.signatures[dotfile]
+            self.pending.pop(dotfile, None)
+        for dotfile in dotfiles:
+            mtime = _get_mtime(dotfile)
+            if mtime is None:
+                continue
+            if mtime != self.mtimes.get(dotfile):
+                self.mtimes[dotfile] = mtime
+                try:
+                    with open(dotfile, 'r') as f:
+                        m = input_re.search(f.read())
+                except (IOError, UnicodeDecodeError):
+                    m = None
+                self.input_files[dotfile] = m.group('filename') if m else None
+            input_file = self.input_files[dotfile]
+            signature = (mtime, _get_mtime(input_file) if input_file else None)
+            if signature != self.signatures.get(dotfile):
+                outputfile = self.output_file(dotfile)
+                up_to_date = output_is_newer(dotfile, outputfile) and \
+                    (input_file is None or output_is_newer(input_file, outputfile))
+                if self.first_scan and up_to_date and not self.options.force:
+                    log.debug('skip: %s is up to date', dotfile)
+                else:
+                    self.pending[dotfile] = now
+                self.signatures[dotfile] = signature
+            elif template_changed:
+                self.pending[dotfile] = now
+        self.first_scan = False
+
+    def output_file(self, dotfile):
+        return get_output_file(dotfile, self.options.outputdir)
+
+    def convert(self, dotfile):
+        """Convert dotfile and print the time used"""
+        outputfile = self.output_file(dotfile)
+        start = time.perf_counter()
+        error = _convert_file(dotfile, outputfile, self.options)
+        elapsed = time.perf_counter() - start
+        if error:
+            sys.stderr.write('%s (%.1f ms)\n' % (error, elapsed * 1000))
+        else:
+            print('%s -> %s (%.1f ms)' % (dotfile, outputfile, elapsed * 1000))
+        sys.stdout.flush()
+        return error is None
+
+    def poll(self, now=None):
+        """Scan for changes and convert the files that are ready
+
+        Returns the list of converted files.
+        """
+        if now is None:
+            now = time.time()
+        self.scan(now)
+        ready = sorted(dotfile for dotfile, changed in self.pending.items()
+                       if now - changed >= self.debounce)
+        for dotfile in ready:
+            del self.pending[dotfile]
+            self.convert(dotfile)
+        return ready
+
+
+def watch(options, interval=0.2):
+    """Convert the dot files in options.watch as they change until interrupted"""
+    watcher = DotFileWatcher(options.watch, options)
+    print('Watching %s for changes. Press Ctrl-C to stop.' % options.watch)
+    try:
+        while True:
+            watcher.poll()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
 def load_dot_file(filename):
     with open(filename, 'r') as f:
         dotdata = f.readlines()
@@ -308,6 +622,20 @@ def main(run_as_module=False, dotdata=None, options=None):
             print_version_info()
             sys.exit(0)
 
+        if options.batch or options.manifest:
+            sys.exit(run_batch(options))
+
+        if options.watch:
+            sys.exit(watch(options))
+
+        if options.serve:
+            from .server import serve
+            sys.exit(serve(options.serve))
+
+        if options.server:
+            from .server import run_client
+            sys.exit(run_client(options.server, sys.argv[1:]))
+
         if options.inputfile is None:
             log.info('Data read from standard input')
             dotdata = sys.stdin.readlines()
@@ -317,16 +645,9 @@ def main(run_as_module=False, dotdata=None, options=None):
             outputfile = options.outputfile
 
             if outputfile is not None and options.force is False:
-                input_exists = os.access(inputfile, os.F_OK)
-                output_exists = os.access(outputfile, os.F_OK)
-
-                if input_exists and output_exists:
-                    input_modified_time = os.stat(inputfile)[8]
-                    output_modified_time = os.stat(outputfile)[8]
-
-                    if input_modified_time < output_modified_time:
-                        print('skip: input file older than output file.')
-                        sys.exit(0)
+                if output_is_newer(inputfile, outputfile):
+                    print('skip: input file older than output file.')
+                    sys.exit(0)
             try:
                 log.debug('Attempting to read data from %s', options.inputfile)
                 dotdata = load_dot_file(options.inputfile)
@@ -342,8 +663,7 @@ def main(run_as_module=False, dotdata=None, options=None):
 
     s = ""
     # look for a line containing an \input
-    m = re.search(r"^\s*\\input\{(?P<filename>.+?)\}",
-                  "".join(dotdata), re.MULTILINE)
+    m = input_re.search("".join(dotdata))
     if m:
         filename = m.group(1)
         log.info('Found \\input{%s}', filename)
@@ -406,7 +726,7 @@ def main(run_as_module=False, dotdata=None, options=None):
 
     # check for output format attribute
     fmtattr = re.findall(r'd2toutputformat=([a-z]*)', dotdata)
-    extraoptions = re.findall(r'^\s*d2toptions\s*=\s*"(.*?)"\s*;?', dotdata, re.MULTILINE)
+    extraoptions = d2toptions_re.findall(dotdata)
     if fmtattr:
         log.info('Found outputformat attribute: %s', fmtattr[0])
         gfmt = fmtattr[0]
@@ -427,6 +747,9 @@ def main(run_as_module=False, dotdata=None, options=None):
             log.setLevel(logging.DEBUG)
             nodebug = False
 
+    if options.packrat:
+        dotparsing.enable_packrat()
+
     output_format = options.format or gfmt or DEFAULT_OUTPUT_FORMAT
     options.format = output_format
 
@@ -443,19 +766,28 @@ def main(run_as_module=False, dotdata=None, options=None):
     else:
         log.error("Unknown output format %s" % options.format)
         sys.exit(1)
+    # Write the output piece by piece instead of returning it when the
+    # caller does not need it
+    stream = not run_as_module or getattr(options, 'streamoutput', False)
     try:
-        s = conv.convert(dotdata)
-        log.debug('Output:\n%s', s)
+        layout = getattr(options, 'layout', None)
         if options.autosize:
+            s = conv.convert(dotdata, layout)
+            log.debug('Output:\n%s', s)
             conv.dopreproc = False
-            s = conv.convert(s)
-            log.debug('Output after preprocessing:\n%s', s)
-        if options.outputfile:
-            with open(options.outputfile, 'w') as f:
-                f.write(s)
+            dotdata, layout = s, None
+        if stream and options.outputfile:
+            conv.convert(dotdata, layout, outfile=options.outputfile)
+            log.debug('Output written to %s', options.outputfile)
+        elif stream:
+            conv.convert(dotdata, layout, outfile=sys.stdout)
+            sys.stdout.write('\n')
         else:
-            if not run_as_module:
-                print(s)
+            s = conv.convert(dotdata, layout)
+            log.debug('Output:\n%s', s)
+            if options.outputfile:
+                with open(options.outputfile, 'w') as f:
+                    f.write(s)
     except dotparsing.ParseException as err:
         errmsg = "Parse error:\n%s\n" % err.line + " " * (err.column - 1) + "^\n" + str(err)
         log.error(errmsg)
@@ -485,6 +817,8 @@ def convert_graph(dotsource, **kwargs):
     Conversion options can be specified as keyword options. Example:
         convert_graph(data,format='tikz',crop=True)
 
+    The layout option can be set to output from Graphviz for dotsource, like
+    the data returned by create_xdot_batch, to avoid running Graphviz.
     """
     parser = create_options_parser()
 
@@ -497,3 +831,79 @@ def convert_graph(dotsource, **kwargs):
     tex = main(True, dotsource, options)
     return tex
 
+
+def _convert_graph_in_thread(dotsource, kwargs):
+    try:
+        return convert_graph(dotsource, **kwargs)
+    except SystemExit as err:
+        # Do not stop the event loop
+        raise RuntimeError('Failed to convert the graph') from err
+
+
+async def convert_graph_async(dotsource, timeout=None, executor=None, **kwargs):
+    """Process dotsource without blocking the event loop
+
+    The conversion runs in executor, by default the default executor of the
+    event loop, while Graphviz and LaTeX are run as asyncio subprocesses.
+    If the conversion takes more than timeout seconds, the programs are
+    killed and asyncio.TimeoutError is raised. They are also killed when the
+    task is cancelled. Conversion options are the same as for convert_graph.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    runner = base.AsyncProgramRunner(loop)
+    future = loop.run_in_executor(executor, runner.run, _convert_graph_in_thread,
+                                  dotsource, kwargs)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        runner.cancel()
+        raise
+
+
+def convert_graphs(fileobj, batch_size=50, **kwargs):
+    """Convert each graph in fileobj and yield the LaTeX code
+
+    The file may contain several graphs. They are read and converted
+    batch_size graphs at a time, so the whole file is never kept in memory.
+    The graphs in a batch that need a layout are laid out by a single
+    Graphviz process. Conversion options are the same as for convert_graph.
+    """
+    batch = []
+    for dotsource in dotparsing.split_dot_graphs(fileobj):
+        batch.append(dotsource)
+        if len(batch) >= batch_size:
+            for tex in _convert_batch(batch, kwargs):
+                yield tex
+            batch = []
+    for tex in _convert_batch(batch, kwargs):
+        yield tex
+
+
+def _convert_batch(graphs, kwargs):
+    """Lay out graphs with one Graphviz process and convert them"""
+    options = create_options_parser().parse_args([])
+    options.__dict__.update(kwargs)
+    layouts = [None] * len(graphs)
+    if not (options.texpreproc or options.autosize or kwargs.get('preproc')):
+        # Graphs with d2toptions may set the layout program or its options
+        # and graphs with _draw_ attributes are already laid out.
+        todo = [i for i, dotsource in enumerate(graphs)
+                if not re.search(r'^\s*d2toptions\s*=', dotsource, re.MULTILINE)
+                and '_draw_' not in dotsource and '_ldraw_' not in dotsource]
+        if len(todo) > 1:
+            results = base.create_xdot_batch(
+                [graphs[i] for i in todo], options.prog,
+                options=options.progoptions or '',
+                output_format=base.get_layout_format(options.__dict__),
+                cache=base.get_layout_cache_from_options(options.__dict__),
+                backend=options.layoutbackend)
+            for i, layout in zip(todo, results):
+                if layout and layout.strip():
+                    layouts[i] = layout
+    for dotsource, layout in zip(graphs, layouts):
+        if layout is not None:
+            yield convert_graph(dotsource, layout=layout, **kwargs)
+        else:
+            yield convert_graph(dotsource, **kwargs)
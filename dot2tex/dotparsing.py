@@ -13,10 +13,19 @@ __author__ = ['Michael Krause', 'Ero Carrera', 'Kjell Magne Fauske']
 __license__ = 'MIT'
 
 import re
+import codecs
 import itertools
+import json
 import os
 import logging
 import string
+import sys
+import tempfile
+import threading
+from array import array
+from contextlib import contextmanager
+from io import StringIO
+from subprocess import Popen, PIPE
 
 import pyparsing
 from pyparsing import __version__ as pyparsing_version
@@ -25,6 +34,10 @@ from pyparsing import (Literal, CaselessLiteral, Word, OneOrMore, Forward, Group
                        ParseException, CharsNotIn, Suppress, Regex, removeQuotes)
 
 from collections import OrderedDict
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 
 dot_keywords = ['graph', 'subgraph', 'digraph', 'node', 'edge', 'strict']
 
@@ -33,6 +46,7 @@ id_re_num = re.compile('^-?(\.[0-9]+|[0-9]+(\.[0-9]*)?)$')
 id_re_with_port = re.compile('^.*:([^"]+|[^"]*\"[^"]*\"[^"]*)$')
 id_re_dbl_quoted = re.compile('^\".*\"$', re.S)
 id_re_html = re.compile('^<<.*>>$', re.S)
+non_ascii_or_nul_re = re.compile(r'[^\x01-\x7f]')
 
 log = logging.getLogger("dot2tex")
 
@@ -49,8 +63,7 @@ def needs_quotes(s):
     if s in dot_keywords:
         return True
 
-    chars = [ord(c) for c in s if ord(c) > 0x7f or ord(c) == 0]
-    if chars:
+    if non_ascii_or_nul_re.search(s):
         return True
 
     res = id_re_alpha_nums.match(s)
@@ -71,17 +84,38 @@ def needs_quotes(s):
     return False
 
 
+# Memoized results of quote_if_necessary for short strings. Attribute keys
+# and values like colors and shapes are quoted over and over again when a
+# graph is written.
+_quote_table = {}
+_quote_table_max_size = 65536
+
+
 def quote_if_necessary(s):
     if not isinstance(s, str):
         return s
+    try:
+        return _quote_table[s]
+    except KeyError:
+        pass
     tmp = s
     if needs_quotes(tmp):
         tmp = '"%s"' % s  # .replace('"','\\"')
     tmp = tmp.replace('<<', '<')
     tmp = tmp.replace('>>', '>')
+    if len(s) <= _intern_max_len:
+        if len(_quote_table) >= _quote_table_max_size:
+            _quote_table.clear()
+        _quote_table[s] = tmp
     return tmp
 
 
+def format_attr_list(attr):
+    """Return attr as a comma separated list of quoted key=value pairs"""
+    quote = quote_if_necessary
+    return ",".join(["%s=%s" % (quote(key), quote(val)) for key, val in attr.items()])
+
+
 def flatten(lst):
     for elem in lst:
         if type(elem) in (tuple, list):
@@ -274,6 +308,145 @@ def find_graphviz():
     return None
 
 
+class GraphvizTools(object):
+    """The Graphviz programs found on the system
+
+    progs is a dictionary with the program names as keys and their paths as
+    values. The version of dot and the output formats it supports are probed
+    on first use, and saved to cache_file if one is given.
+    """
+
+    def __init__(self, progs, version=None, formats=None, cache_file=None):
+        self.progs = progs
+        self._version = version
+        self._formats = formats
+        self.cache_file = cache_file
+
+    def _run_dot(self, *args):
+        """Run dot with args and return the output as text"""
+        prog = self.progs.get('dot') or list(self.progs.values())[0]
+        try:
+            p = Popen([prog] + list(args), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate(b'')
+        except OSError as err:
+            log.warning('Failed to run %s: %s', prog, err)
+            return ''
+        return (stdout + stderr).decode('utf8', 'replace')
+
+    @property
+    def version(self):
+        """Version of Graphviz as a tuple of ints, or None if unknown"""
+        if self._version is None:
+            m = re.search(r'version\s+(\d+(?:\.\d+)*)', self._run_dot('-V'))
+            self._version = tuple(int(v) for v in m.group(1).split('.')) if m else ()
+            log.debug('Graphviz version %s', self._version)
+            self.save()
+        return self._version or None
+
+    @property
+    def formats(self):
+        """Set of output formats supported by dot"""
+        if self._formats is None:
+            output = self._run_dot('-T?')
+            formats = output.split('Use one of:', 1)[1].split() if 'Use one of:' in output else []
+            self._formats = frozenset(formats)
+            log.debug('Graphviz output formats %s', sorted(self._formats))
+            self.save()
+        return self._formats
+
+    def best_layout_format(self):
+        """Return the layout format that is fastest to read
+
+        JSON is read with the json module, which is faster than parsing xdot
+        data. The json format is available from Graphviz 2.40.
+        """
+        if 'json' in self.formats:
+            return 'json'
+        return 'xdot'
+
+    def _mtimes(self):
+        return dict((prog, os.stat(path).st_mtime) for prog, path in self.progs.items())
+
+    @classmethod
+    def load(cls, cache_file):
+        """Return the tools saved in cache_file, or None if outdated"""
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)[os.environ.get('PATH', '')]
+            tools = cls(entry['progs'], entry['version'], entry['formats'], cache_file)
+            if tools._mtimes() != entry['mtimes']:
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if tools._version is not None:
+            tools._version = tuple(tools._version)
+        if tools._formats is not None:
+            tools._formats = frozenset(tools._formats)
+        return tools
+
+    def save(self):
+        """Save to cache_file, keyed by the current PATH"""
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        try:
+            entries[os.environ.get('PATH', '')] = dict(
+                progs=self.progs, mtimes=self._mtimes(),
+                version=self._version,
+                formats=sorted(self._formats) if self._formats is not None else None)
+            # write to a temporary file first, so that other processes
+            # never read a partially written file
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_file)))
+            with os.fdopen(tmp_fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_name, self.cache_file)
+        except (OSError, TypeError) as err:
+            log.warning('Failed to write Graphviz cache %s: %s', self.cache_file, err)
+
+
+_graphviz_lock = threading.Lock()
+_graphviz_tools = {}
+
+
+def get_graphviz(cache_file=None, refresh=False):
+    """Return a GraphvizTools instance, or None if Graphviz is not found
+
+    The programs are located with find_graphviz once per process and value
+    of PATH. If cache_file is given, or set in the DOT2TEX_GRAPHVIZ_CACHE
+    environment variable, the result is also saved there and reused by later
+    processes as long as PATH and the modification times of the programs
+    stay the same. Set refresh to True to search again.
+    """
+    if cache_file is None:
+        cache_file = os.environ.get('DOT2TEX_GRAPHVIZ_CACHE')
+    key = (os.environ.get('PATH', ''), cache_file)
+    with _graphviz_lock:
+        tools = _graphviz_tools.get(key)
+    if tools is not None and not refresh:
+        return tools
+    tools = None
+    if cache_file and not refresh:
+        tools = GraphvizTools.load(cache_file)
+        if tools is not None:
+            log.debug('Loaded Graphviz location from %s', cache_file)
+    if tools is None:
+        progs = find_graphviz()
+        if progs is None:
+            return None
+        # skip programs that were not found and remove quotes added for
+        # paths with spaces
+        progs = dict((prog, path.strip().strip('"')) for prog, path in progs.items() if path)
+        tools = GraphvizTools(progs, cache_file=cache_file)
+        tools.save()
+    with _graphviz_lock:
+        _graphviz_tools[key] = tools
+    return tools
+
+
 ADD_NODE = 'add_node'
 ADD_EDGE = 'add_edge'
 ADD_GRAPH_TO_NODE_EDGE = 'add_graph_to_node_edge'
@@ -290,8 +463,11 @@ class DotDataParser(object):
     """Container class for parsing Graphviz dot data"""
 
     def __init__(self):
-        pass
         self.dotparser = self.define_dot_parser()
+        try:
+            self.dotparser.parseWithTabs()
+        except:
+            log.warning('Old version of pyparsing. Parser may not work correctly')
 
     # parse actions
     def _proc_node_id(self, toks):
@@ -587,10 +763,6 @@ class DotDataParser(object):
     def parse_dot_data(self, data):
         """Parse dot data and return a DotGraph instance"""
         try:
-            try:
-                self.dotparser.parseWithTabs()
-            except:
-                log.warning('Old version of pyparsing. Parser may not work correctly')
             if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
                 data = data.decode()
             ndata = data.replace('\\\n', '')
@@ -610,11 +782,6 @@ class DotDataParser(object):
     def parse_dot_data_debug(self, data):
         """Parse dot data"""
         try:
-            try:
-                self.dotparser.parseWithTabs()
-            except:
-                log.warning('Old version of pyparsing. Parser may not work correctly')
-
             tokens = self.dotparser.parseString(data)
             self.build_top_graph(tokens[0])
 
@@ -627,15 +794,922 @@ class DotDataParser(object):
             return None
 
 
+# Token types produced by tokenize_dot
+TOK_ID = 'id'
+TOK_STRING = 'string'
+TOK_HTML = 'html'
+TOK_EDGEOP = 'edgeop'
+TOK_PUNCT = 'punct'
+TOK_EOF = 'eof'
+
+# Characters that can not be part of an unquoted ID. Mirrors the
+# punctuation_ set used by the pyparsing grammar.
+_id_stop_chars = re.escape("".join([c for c in string.punctuation if c not in '_']))
+
+dot_token_re = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<comment>//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\"|\\\\|[^"])*")
+  | (?P<edgeop>->|--)
+  | (?P<number>-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?)(?![^\s%(stop)s]))
+  | (?P<id>[^\s%(stop)s]+)
+  | (?P<html><)
+  | (?P<punct>[{}\[\];=,:@()+])
+""" % {'stop': _id_stop_chars}, re.VERBOSE | re.DOTALL)
+
+
+def _scan_html(data, pos):
+    """Return the end position of the HTML string starting at pos"""
+    depth = 0
+    for idx in range(pos, len(data)):
+        c = data[idx]
+        if c == '<':
+            depth += 1
+        elif c == '>':
+            depth -= 1
+            if depth == 0:
+                return idx + 1
+    raise ParseException(data, pos, "Unterminated HTML string")
+
+
+def tokenize_dot(data):
+    """Split dot data into a list of (type, value, location) tokens
+
+    Comments and whitespace are skipped. Quoted strings are returned
+    without the enclosing quotes and HTML strings are wrapped in double
+    angle brackets, the same way the pyparsing grammar returns them.
+    """
+    tokens = []
+    append = tokens.append
+    match = dot_token_re.match
+    pos = 0
+    end = len(data)
+    while pos < end:
+        m = match(data, pos)
+        if m is None:
+            raise ParseException(data, pos, "Unexpected character %r" % data[pos])
+        kind = m.lastgroup
+        if kind == 'ws' or kind == 'comment':
+            pass
+        elif kind == 'string':
+            append((TOK_STRING, m.group()[1:-1], pos))
+        elif kind == 'number' or kind == 'id':
+            append((TOK_ID, m.group(), pos))
+        elif kind == 'html':
+            html_end = _scan_html(data, pos)
+            append((TOK_HTML, '<%s>' % data[pos:html_end], pos))
+            pos = html_end
+            continue
+        else:
+            append((TOK_EDGEOP if kind == 'edgeop' else TOK_PUNCT, m.group(), pos))
+        pos = m.end()
+    append((TOK_EOF, '', end))
+    return tokens
+
+
+class RecursiveDotParser(DotDataParser):
+    """Hand-written recursive-descent parser for Graphviz dot data
+
+    An alternative to the pyparsing grammar in DotDataParser. The data is
+    split into tokens in a single pass and the statements are then parsed by
+    recursive descent. The statements are turned into the same intermediate
+    representation as the pyparsing parse actions produce, so the resulting
+    DotGraph is built by the same code.
+    """
+
+    def __init__(self):
+        self.dotparser = None
+
+    def _error(self, msg):
+        raise ParseException(self.data, self.tokens[self.pos][2], msg)
+
+    def _peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def _next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def _at(self, value, offset=0):
+        tok = self.tokens[self.pos + offset]
+        return tok[0] == TOK_PUNCT and tok[1] == value
+
+    def _accept(self, value):
+        if self._at(value):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, value):
+        if not self._accept(value):
+            self._error("Expected '%s'" % value)
+
+    def _is_id(self, offset=0):
+        return self.tokens[self.pos + offset][0] in (TOK_ID, TOK_STRING, TOK_HTML)
+
+    def _is_keyword(self, keyword, offset=0):
+        tok = self.tokens[self.pos + offset]
+        return tok[0] == TOK_ID and tok[1].lower() == keyword
+
+    def _parse_id(self):
+        tok = self._next()
+        if tok[0] == TOK_STRING:
+            # concatenated strings "a" + "b"
+            value = tok[1]
+            while self._at('+') and self._peek(1)[0] == TOK_STRING:
+                self.pos += 1
+                value += self._next()[1]
+            return value
+        if tok[0] in (TOK_ID, TOK_HTML):
+            return tok[1]
+        self.pos -= 1
+        self._error("Expected ID")
+
+    def _parse_attr_list(self):
+        attr = {}
+        while self._accept('['):
+            while not self._accept(']'):
+                key = self._parse_id()
+                if self._accept('='):
+                    attr[key] = self._parse_id()
+                self._accept(',') or self._accept(';')
+        return attr
+
+    def _parse_port(self):
+        port = ""
+        if self._accept(':'):
+            if self._accept('('):
+                x = self._parse_id()
+                self._expect(',')
+                y = self._parse_id()
+                self._expect(')')
+                port = ":(%s,%s)" % (x, y)
+            else:
+                port = ':' + self._parse_id()
+                while self._accept(':'):
+                    port += ':' + self._parse_id()
+            if self._accept('@'):
+                port += '@' + self._parse_id()
+        elif self._accept('@'):
+            port = '@' + self._parse_id()
+            while self._accept(':'):
+                port += ':' + self._parse_id()
+        return port
+
+    def _parse_subgraph(self):
+        name = ''
+        if self._is_keyword('subgraph'):
+            self.pos += 1
+            if self._is_id():
+                name = self._parse_id()
+        self._expect('{')
+        stmts = self._parse_stmt_list()
+        self._expect('}')
+        return ADD_SUBGRAPH, name, stmts
+
+    def _parse_edge_point(self):
+        if self._is_keyword('subgraph') or self._at('{'):
+            return self._parse_subgraph()
+        name = self._parse_id()
+        port = self._parse_port()
+        if port:
+            return name, port
+        return name
+
+    def _parse_stmt(self, stmts):
+        if self._is_id() and self._at('=', 1):
+            key = self._parse_id()
+            self.pos += 1
+            stmts.append(self._proc_attr_assignment([key, self._parse_id()]))
+            return
+        for keyword in ('graph', 'node', 'edge'):
+            if self._is_keyword(keyword) and self._at('[', 1):
+                self.pos += 1
+                stmts.append(self._proc_default_attr_stmt([keyword, self._parse_attr_list()]))
+                return
+        point = self._parse_edge_point()
+        if self._peek()[0] == TOK_EDGEOP:
+            toks = [point]
+            while self._peek()[0] == TOK_EDGEOP:
+                toks.append(self._next()[1])
+                toks.append(self._parse_edge_point())
+            if self._at('['):
+                toks.append(self._parse_attr_list())
+            stmts.extend(self._proc_edge_stmt(toks))
+        elif isinstance(point, tuple) and point[0] == ADD_SUBGRAPH:
+            stmts.append(point)
+        else:
+            if isinstance(point, tuple):
+                # ports have no meaning in a node statement
+                point = point[0]
+            stmts.append((ADD_NODE, point, self._parse_attr_list()))
+
+    def _parse_stmt_list(self):
+        stmts = []
+        while True:
+            tok = self._peek()
+            if tok[0] == TOK_EOF or self._at('}'):
+                return stmts
+            if not self._accept(';'):
+                self._parse_stmt(stmts)
+
+    def _parse_graph(self):
+        strict = 'notstrict'
+        if self._is_keyword('strict'):
+            self.pos += 1
+            strict = 'strict'
+        if self._is_keyword('graph'):
+            graphtype = 'graph'
+        elif self._is_keyword('digraph'):
+            graphtype = 'digraph'
+        else:
+            self._error("Expected 'graph' or 'digraph'")
+        self.pos += 1
+        name = ''
+        if self._is_id():
+            name = self._parse_id()
+        self._expect('{')
+        stmts = self._parse_stmt_list()
+        self._expect('}')
+        return strict, graphtype, name, stmts
+
+    def parse_dot_data(self, data):
+        """Parse dot data and return a DotGraph instance"""
+        if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
+            data = data.decode()
+        self.data = data.replace('\\\n', '')
+        self.tokens = tokenize_dot(self.data)
+        self.pos = 0
+        try:
+            self.build_top_graph(self._parse_graph())
+        finally:
+            self.tokens = None
+        return self.graph
+
+
+class XDotFormatError(Exception):
+    """Raised by XDotReader when the data is not in the expected layout"""
+
+
+# An unquoted ID is a letter, _ or non-ASCII character followed by any of
+# those or digits. The classes are written as negated ASCII ranges, which
+# compile much faster than large non-ASCII ranges.
+_xdot_id = r'''(?:"(?:\\"|\\\\|[^"])*"|[^\x00-@\[-^`{-\x7f][^\x00-/:-@\[-^`{-\x7f]*|-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?))'''
+
+xdot_header_re = re.compile(r'''\s*(?P<strict>strict\s+)?(?P<type>digraph|graph)\s*(?P<name>%(id)s)?\s*\{'''
+                            % {'id': _xdot_id})
+
+xdot_stmt_re = re.compile(r'''\s*(?:
+    (?P<close>\})
+  | (?P<subgraph>(?:subgraph(?:\s+(?P<subgraph_name>%(id)s))?\s*)?\{)
+  | (?P<attr_stmt>graph|node|edge)\s*\[
+  | (?P<src>%(id)s)(?P<src_port>(?::%(id)s)*)\s*(?P<edgeop>->|--)\s*
+    (?P<dst>%(id)s)(?P<dst_port>(?::%(id)s)*)\s*(?P<edge_attr>\[)?
+  | (?P<key>%(id)s)\s*=\s*(?P<value>%(id)s)
+  | (?P<node>%(id)s)\s*(?P<node_attr>\[)?
+  )\s*;?''' % {'id': _xdot_id}, re.VERBOSE)
+
+xdot_attr_re = re.compile(r'''\s*(?P<key>%(id)s)\s*=\s*(?:(?P<value>%(id)s)|(?=<))'''
+                          % {'id': _xdot_id})
+xdot_attr_sep_re = re.compile(r'\s*(?:(?P<close>\])|,)')
+xdot_port_re = re.compile(r':(%s)' % _xdot_id)
+
+
+def _xdot_unquote(s):
+    if s.startswith('"'):
+        return s[1:-1]
+    return s
+
+
+class XDotReader(DotDataParser):
+    """Fast reader for xdot data generated by Graphviz
+
+    The output from dot -Txdot is machine-written and very regular: there
+    is one statement per line, no comments, no edge chains and edges only
+    connect nodes. This reader recognizes that layout with a handful of
+    regular expressions and builds the graph in linear time.
+
+    An XDotFormatError is raised if the data does not match the expected
+    layout. Use parse_xdot_data to fall back to a general parser.
+    """
+
+    def __init__(self):
+        self.dotparser = None
+
+    def _mismatch(self, pos):
+        raise XDotFormatError("Unexpected data at position %s: %r"
+                              % (pos, self.data[pos:pos + 30]))
+
+    def _parse_port(self, port):
+        if not port:
+            return ''
+        return ''.join(':' + _xdot_unquote(p) for p in xdot_port_re.findall(port))
+
+    def _parse_attr_list(self, pos):
+        """Parse the attributes following a [. Returns (attr, pos)"""
+        data = self.data
+        attr = {}
+        m = xdot_attr_sep_re.match(data, pos)
+        if m and m.group('close'):
+            return attr, m.end()
+        while True:
+            m = xdot_attr_re.match(data, pos)
+            if m is None:
+                self._mismatch(pos)
+            pos = m.end()
+            value = m.group('value')
+            if value is None:
+                html_end = _scan_html(data, pos)
+                value = '<%s>' % data[pos:html_end]
+                pos = html_end
+            attr[_xdot_unquote(m.group('key'))] = _xdot_unquote(value)
+            m = xdot_attr_sep_re.match(data, pos)
+            if m is None:
+                self._mismatch(pos)
+            pos = m.end()
+            if m.group('close'):
+                return attr, pos
+            # allow a trailing comma
+            m = xdot_attr_sep_re.match(data, pos)
+            if m and m.group('close'):
+                return attr, m.end()
+
+    def _read(self):
+        data = self.data
+        m = xdot_header_re.match(data)
+        if m is None:
+            self._mismatch(0)
+        strict = 'strict' if m.group('strict') else 'notstrict'
+        name = _xdot_unquote(m.group('name') or '')
+        toplevel = (strict, m.group('type'), name, [])
+        # stack of statement lists for the (sub)graphs being read
+        stack = [toplevel[3]]
+        match = xdot_stmt_re.match
+        pos = m.end()
+        while stack:
+            m = match(data, pos)
+            if m is None:
+                self._mismatch(pos)
+            pos = m.end()
+            stmts = stack[-1]
+            if m.group('close'):
+                stack.pop()
+            elif m.group('subgraph'):
+                substmts = []
+                stmts.append((ADD_SUBGRAPH, _xdot_unquote(m.group('subgraph_name') or ''), substmts))
+                stack.append(substmts)
+            elif m.group('attr_stmt'):
+                attr, pos = self._parse_attr_list(pos)
+                stmts.append(self._proc_default_attr_stmt([m.group('attr_stmt'), attr]))
+            elif m.group('edgeop'):
+                attr = {}
+                if m.group('edge_attr'):
+                    attr, pos = self._parse_attr_list(pos)
+                src = _xdot_unquote(m.group('src'))
+                src_port = self._parse_port(m.group('src_port'))
+                if src_port:
+                    src = (src, src_port)
+                dst = _xdot_unquote(m.group('dst'))
+                dst_port = self._parse_port(m.group('dst_port'))
+                if dst_port:
+                    dst = (dst, dst_port)
+                stmts.append((ADD_EDGE, src, dst, attr))
+            elif m.group('key'):
+                stmts.append((SET_GRAPH_ATTR, {_xdot_unquote(m.group('key')):
+                                                   _xdot_unquote(m.group('value'))}))
+            elif m.group('node'):
+                attr = {}
+                if m.group('node_attr'):
+                    attr, pos = self._parse_attr_list(pos)
+                stmts.append((ADD_NODE, _xdot_unquote(m.group('node')), attr))
+            # statements may be terminated by a semicolon
+            if data.startswith(';', pos):
+                pos += 1
+        return toplevel
+
+    def parse_dot_data(self, data):
+        """Parse xdot data and return a DotGraph instance"""
+        if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
+            data = data.decode()
+        self.data = data.replace('\\\n', '')
+        try:
+            self.build_top_graph(self._read())
+        finally:
+            self.data = None
+        return self.graph
+
+
+def parse_xdot_data(data, engine='pyparsing'):
+    """Parse xdot data generated by Graphviz and return a DotGraph instance
+
+    Uses the fast XDotReader and falls back to the general parser given by
+    engine if the data is not in the layout Graphviz produces.
+    """
+    try:
+        return XDotReader().parse_dot_data(data)
+    except (XDotFormatError, ParseException) as err:
+        log.debug('Fast xdot reader failed, using the %s parser. %s', engine, err)
+    return parser_pool.parse_dot_data(data, engine)
+
+
+# Keys in Graphviz' JSON output that are not graph, node or edge attributes
+_json_structure_keys = frozenset(['name', 'directed', 'strict', '_gvid', '_subgraph_cnt',
+                                  'objects', 'subgraphs', 'nodes', 'edges', 'tail', 'head'])
+
+
+def _json_attributes(jobj):
+    """Split a JSON object into (attributes, draw_records)
+
+    xdot draw operations are lists of records in the JSON output. They are
+    kept as they are, all other attributes are strings.
+    """
+    attr = {}
+    draw_records = {}
+    for key, value in jobj.items():
+        if key in _json_structure_keys:
+            continue
+        if isinstance(value, list):
+            draw_records[key] = value
+        elif isinstance(value, str):
+            attr[key] = value
+        else:
+            attr[key] = str(value)
+    return attr, draw_records
+
+
+def graph_from_json(data):
+    """Build a DotGraph from the JSON output of Graphviz (dot -Tjson)
+
+    The draw operations are not converted to xdot draw strings. They are
+    stored in the draw_records dictionary of each element, keyed on the
+    draw attribute name (_draw_, _ldraw_ etc.).
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf8')
+    if isinstance(data, str):
+        data = json.loads(data)
+    subgraph_cnt = data.get('_subgraph_cnt', 0)
+    objects = data.get('objects', [])
+    jsubgraphs = objects[:subgraph_cnt]
+    jnodes = objects[subgraph_cnt:]
+    jedges = data.get('edges', [])
+
+    graph = DotGraph(data.get('name', ''), data.get('strict', False), data.get('directed', False))
+    attr, graph.draw_records = _json_attributes(data)
+    graph.set_attr(**attr)
+
+    # Top level subgraphs are not always listed in the root object
+    top_subgraphs = data.get('subgraphs')
+    if top_subgraphs is None:
+        children = set()
+        for jsubgraph in jsubgraphs:
+            children.update(jsubgraph.get('subgraphs', []))
+        top_subgraphs = [i for i in range(len(jsubgraphs)) if i not in children]
+
+    added_nodes = set()
+    added_edges = set()
+
+    def add_items(g, subgraph_ids, node_ids, edge_ids):
+        # Elements are added to the innermost subgraph they belong to
+        for subgraph_id in subgraph_ids:
+            jsubgraph = jsubgraphs[subgraph_id]
+            subgraph = g.add_subgraph(jsubgraph.get('name', ''))
+            attr, subgraph.draw_records = _json_attributes(jsubgraph)
+            subgraph.set_attr(**attr)
+            g.allitems.append(subgraph)
+            add_items(subgraph, jsubgraph.get('subgraphs', []),
+                      jsubgraph.get('nodes', []), jsubgraph.get('edges', []))
+        for node_id in node_ids:
+            if node_id in added_nodes:
+                continue
+            added_nodes.add(node_id)
+            jnode = jnodes[node_id]
+            attr, draw_records = _json_attributes(jnode)
+            node = g.add_node(jnode['name'], **attr)
+            node.draw_records = draw_records
+            g.allitems.append(node)
+        for edge_id in edge_ids:
+            if edge_id in added_edges:
+                continue
+            added_edges.add(edge_id)
+            jedge = jedges[edge_id]
+            attr, draw_records = _json_attributes(jedge)
+            srcport = attr.pop('tailport', '')
+            dstport = attr.pop('headport', '')
+            edge = g.add_edge(jnodes[jedge['tail']]['name'], jnodes[jedge['head']]['name'],
+                              srcport and ':' + srcport, dstport and ':' + dstport, **attr)
+            edge.draw_records = draw_records
+            g.allitems.append(edge)
+
+    add_items(graph, top_subgraphs, range(len(jnodes)), range(len(jedges)))
+    return graph
+
+
+# Available parser engines. See base.parse_dot_data
+parser_engines = {
+    'pyparsing': DotDataParser,
+    'recursive': RecursiveDotParser,
+}
+
+
+class DotParserPool(object):
+    """Thread-safe pool of reusable parser instances
+
+    Creating a DotDataParser builds the complete pyparsing grammar, which is
+    expensive compared to parsing a small graph. The pool keeps idle parsers
+    around so that the grammar is only built once per engine and thread.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self, engine='pyparsing'):
+        """Return an idle parser or create a new one"""
+        with self._lock:
+            idle = self._idle.get(engine)
+            if idle:
+                return idle.pop()
+        try:
+            parser_cls = parser_engines[engine]
+        except KeyError:
+            raise NameError('Unknown parser engine %s. Valid values are %s'
+                            % (engine, list(parser_engines)))
+        parser = parser_cls()
+        with self._lock:
+            self.created += 1
+        log.debug('Created new %s parser instance', engine)
+        return parser
+
+    def release(self, parser, engine='pyparsing'):
+        """Return a parser to the pool"""
+        # do not keep the last parsed graph alive
+        parser.graph = None
+        with self._lock:
+            self._idle.setdefault(engine, []).append(parser)
+
+    @contextmanager
+    def parser(self, engine='pyparsing'):
+        parser = self.acquire(engine)
+        try:
+            yield parser
+        finally:
+            self.release(parser, engine)
+
+    def parse_dot_data(self, data, engine='pyparsing'):
+        """Parse dot data using a pooled parser and return a DotGraph"""
+        with self.parser(engine) as parser:
+            return parser.parse_dot_data(data)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+
+# Process-wide parser pool
+parser_pool = DotParserPool()
+
+# Lexical elements that matter when looking for the end of a top-level graph.
+# Braces inside strings, comments and HTML strings are skipped. The partial
+# group matches elements that may continue in the next chunk of data. The
+# string pattern can not backtrack, so a string is never ended early by an
+# escaped quote at the end of a chunk.
+_graph_split_re = re.compile(r"""
+    (?P<string>"(?:\\.|[^"\\])*")
+  | (?P<comment>//[^\n]*\n|\#[^\n]*\n|/\*.*?\*/)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<html><)
+  | (?P<partial>"|//|\#|/\*|/\Z)
+""", re.VERBOSE | re.DOTALL)
+
+
+_angle_brackets_re = re.compile('[<>]')
+
+
+def _find_html_end(data, pos):
+    """Return the end position of the HTML string at pos or -1"""
+    depth = 0
+    for m in _angle_brackets_re.finditer(data, pos):
+        if m.group() == '<':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    return -1
+
+
+def split_dot_graphs(fileobj, chunk_size=65536):
+    """Yield the dot source of each top-level graph in fileobj
+
+    Graphviz accepts files with several graphs. The file is read in chunks
+    of chunk_size characters, and only the data of the current graph is kept
+    in memory. Bytes are decoded as UTF-8. Comments and whitespace between
+    the graphs are passed on with the next graph.
+    """
+    decoder = None
+    buf = ''
+    pos = 0
+    depth = 0
+    eof = False
+    while True:
+        if not eof:
+            chunk = fileobj.read(chunk_size)
+            eof = not chunk
+            if isinstance(chunk, bytes):
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder('utf8')('replace')
+                chunk = decoder.decode(chunk, final=eof)
+            buf += chunk
+        while True:
+            m = _graph_split_re.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            kind = m.lastgroup
+            if not eof and (kind == 'partial' or m.end() == len(buf)):
+                # wait for more data
+                pos = m.start()
+                break
+            pos = m.end()
+            if kind == 'open':
+                depth += 1
+            elif kind == 'close':
+                depth -= 1
+                if depth == 0:
+                    yield buf[:pos]
+                    buf = buf[pos:]
+                    pos = 0
+            elif kind == 'html':
+                html_end = _find_html_end(buf, m.start())
+                if html_end < 0:
+                    if eof:
+                        pos = len(buf)
+                        break
+                    pos = m.start()
+                    break
+                pos = html_end
+            elif kind == 'partial':
+                # unterminated string or comment at the end of the data
+                pos = len(buf)
+                break
+        if eof:
+            break
+    # Trailing comments and whitespace are fine, anything else is passed on
+    # so that the parser can report the error.
+    if buf.strip() and len(tokenize_dot(buf)) > 1:
+        yield buf
+
+
+def iter_dot_graphs(fileobj, engine='pyparsing', chunk_size=65536):
+    """Parse the graphs in fileobj and yield one DotGraph at a time
+
+    See split_dot_graphs.
+    """
+    for data in split_dot_graphs(fileobj, chunk_size):
+        yield parser_pool.parse_dot_data(data, engine)
+
+
+def enable_packrat(cache_size_limit=128):
+    """Enable packrat memoization in pyparsing
+
+    Packrat parsing speeds up the pyparsing grammar considerably for graphs
+    with many similar statements, at the cost of memory. Note that this
+    setting is global for all pyparsing grammars in the process.
+    """
+    try:
+        pyparsing.ParserElement.enablePackrat(cache_size_limit)
+    except TypeError:
+        # older versions of pyparsing do not support a cache size limit
+        pyparsing.ParserElement.enablePackrat()
+
+
+# Attributes with values that are unique to each element. Interning them
+# would only fill up the intern table.
+_uninterned_attrs = frozenset(['pos', 'lp', 'xlp', 'head_lp', 'tail_lp', 'bb'])
+_intern_max_len = 64
+
+
+def intern_attr(key, value):
+    """Return interned versions of an attribute key and value
+
+    Keys are always interned. Values are interned when they are short and
+    likely to be repeated across elements, like colors, shapes and styles.
+    """
+    if isinstance(key, str):
+        key = sys.intern(key)
+        if isinstance(value, str) and len(value) <= _intern_max_len \
+                and key not in _uninterned_attrs and not key.startswith('_'):
+            value = sys.intern(value)
+    return key, value
+
+
+class DotAttributes(MutableMapping):
+    """Attribute mapping for nodes and edges
+
+    The default attributes are shared between all elements created with the
+    same defaults and are never changed. Only the attributes set on the
+    element itself are stored per element. The defaults come first when
+    iterating, like for a dict updated with the defaults and then with the
+    element attributes.
+    """
+    __slots__ = ('own', 'defaults')
+
+    _empty = {}
+
+    def __init__(self, defaults=None, **kwds):
+        self.own = {}
+        self.defaults = defaults or self._empty
+        if kwds:
+            self.update(kwds)
+
+    def __getitem__(self, key):
+        try:
+            return self.own[key]
+        except KeyError:
+            return self.defaults[key]
+
+    def __setitem__(self, key, value):
+        key, value = intern_attr(key, value)
+        self.own[key] = value
+
+    def __delitem__(self, key):
+        if key in self.defaults:
+            # Copy the defaults before changing them
+            self.own = dict(self.defaults, **self.own)
+            self.defaults = self._empty
+        del self.own[key]
+
+    def __contains__(self, key):
+        return key in self.own or key in self.defaults
+
+    def __iter__(self):
+        for key in self.defaults:
+            yield key
+        for key in self.own:
+            if key not in self.defaults:
+                yield key
+
+    def __len__(self):
+        if not self.defaults:
+            return len(self.own)
+        return len(self.defaults) + sum(1 for key in self.own if key not in self.defaults)
+
+    def get(self, key, default=None):
+        try:
+            return self.own[key]
+        except KeyError:
+            return self.defaults.get(key, default)
+
+    def update(self, *args, **kwds):
+        own = self.own
+        for key, value in dict(*args, **kwds).items():
+            key, value = intern_attr(key, value)
+            own[key] = value
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class DotNodeAttributes(DotAttributes):
+    """Attribute mapping for nodes. The node attributes come first when iterating"""
+    __slots__ = ()
+
+    def __iter__(self):
+        for key in self.own:
+            yield key
+        for key in self.defaults:
+            if key not in self.own:
+                yield key
+
+
+def _shared_defaults(defaults, kwds):
+    """Return a new defaults dict. The old one may be shared and is not changed"""
+    attr = dict(defaults)
+    for key, value in kwds.items():
+        key, value = intern_attr(key, value)
+        attr[key] = value
+    return attr
+
+
+def _join_lines(s):
+    """Remove the line continuations Graphviz inserts in long attribute values"""
+    return s.replace('\\\r\n', '').replace('\\\n', '')
+
+
+def decode_point(s):
+    """Decode a "x,y" point into a (x, y) tuple of floats
+
+    Returns None if s is not a valid point.
+    """
+    coords = _join_lines(s).split(',')
+    if len(coords) != 2:
+        return None
+    try:
+        return float(coords[0]), float(coords[1])
+    except ValueError:
+        return None
+
+
+def decode_rect(s):
+    """Decode a "llx,lly,urx,ury" rectangle into a tuple of floats
+
+    Returns None if s is not a valid rectangle.
+    """
+    coords = _join_lines(s).split(',')
+    if len(coords) != 4:
+        return None
+    try:
+        return tuple(float(c) for c in coords)
+    except ValueError:
+        return None
+
+
+def decode_spline(s):
+    """Decode the pos attribute of an edge
+
+    Returns a list of (startp, endp, points) tuples, one for each spline.
+    startp and endp are the arrow end points, or None if the spline has no
+    arrow at that end. points is a list of (x, y) control points.
+    """
+    splines = []
+    for spline in _join_lines(s).split(';'):
+        startp = endp = None
+        tokens = spline.split()
+        # The end points come first, so the control points can be converted
+        # in one go
+        while tokens and tokens[0][:2] in ('s,', 'e,'):
+            coords = tokens.pop(0).split(',')
+            if coords[0] == 's':
+                startp = float(coords[1]), float(coords[2])
+            else:
+                endp = float(coords[1]), float(coords[2])
+        coords = list(map(float, ",".join(tokens).split(','))) if tokens else []
+        points = list(zip(coords[::2], coords[1::2]))
+        splines.append((startp, endp, points))
+    return splines
+
+
+class DotGeometry(object):
+    """Access to decoded geometry attributes like pos, lp and bb
+
+    The attribute values are decoded on first access and cached until the
+    attribute is changed.
+    """
+    __slots__ = ()
+
+    def _decoded(self, key, decode):
+        raw = self.attr.get(key)
+        if not raw:
+            return None
+        return self.get_cached((key, decode), raw, decode)
+
+    def get_cached(self, key, raw, decode):
+        """Return decode(raw), where raw is the current value of an attribute
+
+        The result is cached under key until raw is changed, and must not
+        be modified.
+        """
+        if self._geometry is None:
+            self._geometry = {}
+        cached = self._geometry.get(key)
+        if cached is None or cached[0] is not raw:
+            cached = self._geometry[key] = (raw, decode(raw))
+        return cached[1]
+
+    def get_point(self, key='pos'):
+        """Return the key attribute as a (x, y) tuple or None"""
+        return self._decoded(key, decode_point)
+
+    def get_rect(self, key='bb'):
+        """Return the key attribute as a (llx, lly, urx, ury) tuple or None"""
+        return self._decoded(key, decode_rect)
+
+    def get_spline(self, key='pos'):
+        """Return the splines in the key attribute. See decode_spline"""
+        return self._decoded(key, decode_spline) or []
+
+
 class DotDefaultAttr(object):
     def __init__(self, element_type, **kwds):
         self.element_type = element_type
         self.attr = kwds
 
     def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
+        attrstr = format_attr_list(self.attr)
         if attrstr:
             attrstr = "[%s]" % attrstr
             return "%s%s;\n" % (self.element_type, attrstr)
@@ -647,26 +1721,27 @@ class DotParsingException(Exception):
     """Base class for dotparsing exceptions."""
 
 
-class DotNode(object):
+class DotNode(DotGeometry):
     """Class representing a DOT node"""
+    __slots__ = ('name', 'attr', 'parent', 'draw_records', '_geometry')
 
-    def __init__(self, name, **kwds):
+    def __init__(self, name, _defaults=None, **kwds):
         """Create a Node instance
 
         Input:
             name - name of node. Have to be a string
+            _defaults - shared default attributes. Not copied
             **kwds node attributes
 
         """
         self.name = name
-        self.attr = {}
+        self.attr = DotNodeAttributes(_defaults, **kwds)
         self.parent = None
-        self.attr.update(kwds)
+        self.draw_records = None
+        self._geometry = None
 
     def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
+        attrstr = format_attr_list(self.attr)
         if attrstr:
             attrstr = "[%s]" % attrstr
         return "%s%s;\n" % (quote_if_necessary(self.name), attrstr)
@@ -693,11 +1768,14 @@ class DotNode(object):
             raise AttributeError
 
 
-class DotGraph(object):
+class DotGraph(DotGeometry):
     """Class representing a DOT graph"""
 
     def __init__(self, name='G', strict=True, directed=False, **kwds):
+        self._geometry = None
         self._nodes = OrderedDict()
+        # Memoized result of get_all_nodes, see _nodes_changed
+        self._all_nodes = None
         self._allnodes = {}
         self._alledges = {}
         self._allgraphs = []
@@ -742,19 +1820,28 @@ class DotGraph(object):
 
     def add_node(self, node, **kwds):
         if not isinstance(node, DotNode):
-            node = DotNode(str(node), **kwds)
-        n = node.name
+            n = str(node)
+            if n in self._allnodes:
+                node = DotNode(n, **kwds)
+                self._allnodes[n].attr.update(kwds)
+            else:
+                # The default attributes are shared, not copied
+                node = DotNode(n, self.default_node_attr, **kwds)
+                self._allnodes[n] = node
+        else:
+            n = node.name
+            if n in self._allnodes:
+                self._allnodes[n].attr.update(kwds)
+            else:
+                node.attr.update(self.default_node_attr)
+                node.attr.update(kwds)
+                self._allnodes[n] = node
 
         ##        if n not in self.adj:
         ##            self.adj[n]={}
-        if n in self._allnodes:
-            self._allnodes[n].attr.update(kwds)
-        else:
-            node.attr.update(self.default_node_attr)
-            node.attr.update(kwds)
-            self._allnodes[n] = node
         if n not in self._nodes:
             self._nodes[n] = node
+            self._nodes_changed()
 
             # Todo: Adding a node to a subgraph should insert it in parent graphs
         ##        parent = self.parent
@@ -770,11 +1857,37 @@ class DotGraph(object):
 
         return node
 
+    def _edge_node(self, node):
+        """Return the node for an edge endpoint, adding it if necessary"""
+        if not isinstance(node, DotNode):
+            n = str(node)
+            if n in self._allnodes:
+                # Use the existing node instead of creating a new one
+                node = self._allnodes[n]
+                if n not in self._nodes:
+                    self._nodes[n] = node
+                    self._nodes_changed()
+                return node
+        return self.add_node(node)
+
+    def _nodes_changed(self):
+        """Clear the memoized node lists of this graph and its parents"""
+        graph = self
+        # A parent list is only memoized if the lists of all its subgraphs
+        # are, so we can stop at the first graph without one.
+        while graph is not None and graph._all_nodes is not None:
+            graph._all_nodes = None
+            graph = graph.parent
+
     def add_edge(self, src, dst, srcport="", dstport="", **kwds):
-        u = self.add_node(src)
-        v = self.add_node(dst)
-        edge = DotEdge(u, v, self.directed, srcport, dstport, **self.default_edge_attr)
-        edge.attr.update(kwds)
+        u = self._edge_node(src)
+        v = self._edge_node(dst)
+        edge = DotEdge(u, v, self.directed, srcport, dstport, self.default_edge_attr, **kwds)
+        return self._insert_edge(edge)
+
+    def _insert_edge(self, edge):
+        u = edge.src
+        v = edge.dst
 
         ##        if not self.strict:
         ##            self.adj[u][v]=self.adj[u].get(v,[])+ [edge]
@@ -806,31 +1919,50 @@ class DotGraph(object):
             self._edges[edgekey] = [edge]
         return edge
 
-    def add_special_edge(self, src, dst, srcport="", dstport="", **kwds):
-        src_is_graph = isinstance(src, DotSubGraph)
-        dst_is_graph = isinstance(dst, DotSubGraph)
+    def add_edges(self, src_nodes, dst_nodes, srcport="", dstport="", **kwds):
+        """Add an edge from every node in src_nodes to every node in dst_nodes
+
+        Gives the same result as calling add_edge for each pair, but every
+        endpoint is looked up once and the attributes are only interned once.
+        Returns the list of edges.
+        """
+        if not src_nodes or not dst_nodes:
+            return []
+        # Add the endpoints in the same order as the nested add_edge calls
+        first = self._edge_node(src_nodes[0])
+        dsts = [self._edge_node(node) for node in dst_nodes]
+        srcs = [first] + [self._edge_node(node) for node in src_nodes[1:]]
+        attr = dict(intern_attr(key, value) for key, value in kwds.items())
+        defaults = self.default_edge_attr
+        directed = self.directed
+        insert_edge = self._insert_edge
         edges = []
-        if src_is_graph:
-            src_nodes = src.get_all_nodes()
+        for u in srcs:
+            for v in dsts:
+                edge = DotEdge(u, v, directed, srcport, dstport, defaults)
+                if attr:
+                    edge.attr.own = attr.copy()
+                edges.append(insert_edge(edge))
+        return edges
+
+    def add_special_edge(self, src, dst, srcport="", dstport="", **kwds):
+        if isinstance(src, DotSubGraph):
+            src_nodes = src._get_all_nodes()
         else:
             src_nodes = [src]
-        if dst_is_graph:
-            dst_nodes = dst.get_all_nodes()
+        if isinstance(dst, DotSubGraph):
+            dst_nodes = dst._get_all_nodes()
         else:
             dst_nodes = [dst]
+        return self.add_edges(src_nodes, dst_nodes, srcport, dstport, **kwds)
 
-        for src_node in src_nodes:
-            for dst_node in dst_nodes:
-                edge = self.add_edge(src_node, dst_node, srcport, dstport, **kwds)
-                edges.append(edge)
-
-        return edges
-
+    # The default node and edge attributes are shared with nodes, edges and
+    # subgraphs. They are replaced, never changed in place.
     def add_default_node_attr(self, **kwds):
-        self.default_node_attr.update(kwds)
+        self.default_node_attr = _shared_defaults(self.default_node_attr, kwds)
 
     def add_default_edge_attr(self, **kwds):
-        self.default_edge_attr.update(kwds)
+        self.default_edge_attr = _shared_defaults(self.default_edge_attr, kwds)
 
     def add_default_graph_attr(self, **kwds):
         self.default_graph_attr.update(kwds)
@@ -871,6 +2003,7 @@ class DotGraph(object):
             del self._allnodes[name]
         except:
             raise DotParsingException("Node %s does not exists" % name)
+        self._nodes_changed()
 
     def get_node(self, nodename):
         """Return node with name=nodename
@@ -922,13 +2055,20 @@ class DotGraph(object):
         subgraphcls.parent = self
         subgraphcls.root = self.root
         subgraphcls.level = self.level + 1
-        subgraphcls.add_default_node_attr(**self.default_node_attr)
-        subgraphcls.add_default_edge_attr(**self.default_edge_attr)
+        if subgraphcls.default_node_attr:
+            subgraphcls.add_default_node_attr(**self.default_node_attr)
+        else:
+            subgraphcls.default_node_attr = self.default_node_attr
+        if subgraphcls.default_edge_attr:
+            subgraphcls.add_default_edge_attr(**self.default_edge_attr)
+        else:
+            subgraphcls.default_edge_attr = self.default_edge_attr
         subgraphcls.add_default_graph_attr(**self.attr)
         subgraphcls.attr.update(self.default_graph_attr)
         subgraphcls.padding += self.padding
         self.subgraphs.append(subgraphcls)
         self._allgraphs.append(subgraphcls)
+        self._nodes_changed()
         return subgraphcls
 
     def get_subgraphs(self):
@@ -938,10 +2078,18 @@ class DotGraph(object):
         return self._edges
 
     def get_all_nodes(self):
-        nodes = []
-        for subgraph in self.get_subgraphs():
-            nodes.extend(subgraph.get_all_nodes())
-        nodes.extend(self._nodes)
+        """Return the names of the nodes in the graph and its subgraphs"""
+        return list(self._get_all_nodes())
+
+    def _get_all_nodes(self):
+        # The list is memoized and must not be changed by the caller
+        nodes = self._all_nodes
+        if nodes is None:
+            nodes = []
+            for subgraph in self.subgraphs:
+                nodes.extend(subgraph._get_all_nodes())
+            nodes.extend(self._nodes)
+            self._all_nodes = nodes
         return nodes
 
     def set_attr(self, **kwds):
@@ -956,74 +2104,76 @@ class DotGraph(object):
     edges = property(get_edges)
 
     def __str__(self):
-        s = ""
-        padding = self.padding
-        if len(self.allitems) > 0:
-            grstr = "".join(["%s%s" % (padding, n) for n in map(str, flatten(self.allitems))])
-            attrstr = ",".join(["%s=%s" % \
-                                (quote_if_necessary(key), quote_if_necessary(val)) \
-                                for key, val in self.attr.items()])
-            if attrstr:
-                attrstr = "%sgraph [%s];" % (padding, attrstr)
-            if not isinstance(self, DotSubGraph):
-                s = ""
-                if self.strict:
-                    s += 'strict '
-                if self.directed:
-                    s += "digraph"
-                else:
-                    s += "graph"
-                return "%s %s{\n%s\n%s\n}" % (s, self.get_name(), grstr, attrstr)
-            else:
-                return "%s %s{\n%s\n%s\n%s}" % ('subgraph', self.get_name(), grstr, attrstr, padding)
-
-        subgraphstr = "\n".join(["%s%s" % (padding, n) for n in map(str, self.subgraphs)])
+        fp = StringIO()
+        self.write(fp)
+        return fp.getvalue()
 
-        nodestr = "".join(["%s%s" % (padding, n)
-                           for n in map(str, self._nodes.values())])
-        edgestr = "".join(["%s%s" % (padding, n)
-                           for n in map(str, flatten(self.edges.values()))])
+    def write(self, fp):
+        """Write the graph in the dot language to the file object fp
 
-        attrstr = ",".join(["%s=%s" %
-                            (quote_if_necessary(key), quote_if_necessary(val))
-                            for key, val in self.attr.items()])
+        The graph is written one element at a time, without building the
+        complete text in memory.
+        """
+        write = fp.write
+        padding = self.padding
+        is_subgraph = isinstance(self, DotSubGraph)
+        if is_subgraph:
+            write("subgraph %s{\n" % self.get_name())
+        else:
+            graphtype = "digraph" if self.directed else "graph"
+            if self.strict:
+                graphtype = 'strict ' + graphtype
+            write("%s %s{\n" % (graphtype, self.get_name()))
+        attrstr = format_attr_list(self.attr)
         if attrstr:
             attrstr = "%sgraph [%s];" % (padding, attrstr)
-        if not isinstance(self, DotSubGraph):
-            s = ""
-            if self.strict:
-                s += 'strict '
-            if self.directed:
-                s += "digraph"
-            else:
-                s += "graph"
-            return "%s %s{\n%s\n%s\n%s\n%s\n}" % (s, self.get_name(), subgraphstr, attrstr, nodestr, edgestr)
+        if len(self.allitems) > 0:
+            for item in flatten(self.allitems):
+                write(padding)
+                if isinstance(item, DotGraph):
+                    item.write(fp)
+                else:
+                    write(str(item))
+            write("\n%s\n" % attrstr)
+        else:
+            for i, subgraph in enumerate(self.subgraphs):
+                write("\n%s" % padding if i else padding)
+                subgraph.write(fp)
+            write("\n%s\n" % attrstr)
+            for node in self._nodes.values():
+                write(padding)
+                write(str(node))
+            write("\n")
+            for edge in flatten(self.edges.values()):
+                write(padding)
+                write(str(edge))
+            write("\n")
+        if is_subgraph:
+            write("%s}" % padding)
         else:
-            return "%s %s{\n%s\n%s\n%s\n%s\n%s}" % (
-                'subgraph', self.get_name(), subgraphstr, attrstr, nodestr, edgestr, padding)
+            write("}")
 
 
-class DotEdge(object):
+class DotEdge(DotGeometry):
     """Class representing a DOT edge"""
+    __slots__ = ('src', 'dst', 'src_port', 'dst_port', 'attr', 'conn', 'draw_records', '_geometry')
 
-    def __init__(self, src, dst, directed=False, src_port="", dst_port="", **kwds):
+    def __init__(self, src, dst, directed=False, src_port="", dst_port="", _defaults=None, **kwds):
         self.src = src
         self.dst = dst
         self.src_port = src_port
         self.dst_port = dst_port
         # self.parent = parent_graph
-        self.attr = {}
+        self.attr = DotAttributes(_defaults, **kwds)
         if directed:
             self.conn = "->"
         else:
             self.conn = "--"
-
-        self.attr.update(kwds)
+        self.draw_records = None
+        self._geometry = None
 
     def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
+        attrstr = format_attr_list(self.attr)
         if attrstr:
             attrstr = "[%s]" % attrstr
         return "%s%s %s %s%s %s;\n" % (quote_if_necessary(self.src.name), \
@@ -1050,6 +2200,422 @@ class DotSubGraph(DotGraph):
         DotGraph.__init__(self, name, strict, directed, **kwds)
 
 
+_unset = object()
+_nan = float('nan')
+
+
+class _ColumnAttributes(MutableMapping):
+    """Attribute mapping for the element a columnar cursor points at"""
+    __slots__ = ('columns', 'cursor')
+
+    def __init__(self, columns, cursor):
+        self.columns = columns
+        self.cursor = cursor
+
+    def __getitem__(self, key):
+        column = self.columns.get(key)
+        if column is not None:
+            value = column[self.cursor.index]
+            if value is not _unset:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.cursor.store.set_attr(self.columns, self.cursor.index, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        self.columns[key][self.cursor.index] = _unset
+
+    def __contains__(self, key):
+        column = self.columns.get(key)
+        return column is not None and column[self.cursor.index] is not _unset
+
+    def __iter__(self):
+        index = self.cursor.index
+        for key, column in self.columns.items():
+            if column[index] is not _unset:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def get(self, key, default=None):
+        column = self.columns.get(key)
+        if column is not None:
+            value = column[self.cursor.index]
+            if value is not _unset:
+                return value
+        return default
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class ColumnarNode(DotNode):
+    """Cursor over the nodes in a DotColumns store
+
+    The same instance is moved from node to node while iterating. Do not
+    keep references to it.
+    """
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index=0):
+        self.store = store
+        self.index = index
+        self.attr = _ColumnAttributes(store.node_attr, self)
+        self.parent = None
+        self._geometry = None
+
+    name = property(lambda self: self.store.node_names[self.index])
+
+    @property
+    def draw_records(self):
+        if self.store.node_draw_records is None:
+            return None
+        return self.store.node_draw_records[self.index]
+
+    def get_point(self, key='pos'):
+        if key == 'pos':
+            x = self.store.node_xy[2 * self.index]
+            if x != x:
+                # NaN, no position
+                return None
+            return x, self.store.node_xy[2 * self.index + 1]
+        value = self.attr.get(key)
+        return decode_point(value) if value else None
+
+    def get_rect(self, key='bb'):
+        value = self.attr.get(key)
+        return decode_rect(value) if value else None
+
+    def get_spline(self, key='pos'):
+        return []
+
+
+class ColumnarEdge(DotEdge):
+    """Cursor over the edges in a DotColumns store
+
+    The same instance is moved from edge to edge while iterating. Do not
+    keep references to it.
+    """
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index=0):
+        self.store = store
+        self.index = index
+        self.attr = _ColumnAttributes(store.edge_attr, self)
+        self.conn = "->" if store.directed else "--"
+        self._geometry = None
+
+    src = property(lambda self: ColumnarNode(self.store, self.store.edge_src[self.index]))
+    dst = property(lambda self: ColumnarNode(self.store, self.store.edge_dst[self.index]))
+    src_port = property(lambda self: self.store.ports[self.store.edge_src_port[self.index]])
+    dst_port = property(lambda self: self.store.ports[self.store.edge_dst_port[self.index]])
+
+    @property
+    def draw_records(self):
+        if self.store.edge_draw_records is None:
+            return None
+        return self.store.edge_draw_records[self.index]
+
+    def get_source(self):
+        return self.store.node_names[self.store.edge_src[self.index]]
+
+    def get_destination(self):
+        return self.store.node_names[self.store.edge_dst[self.index]]
+
+    def get_point(self, key='pos'):
+        value = self.attr.get(key)
+        return decode_point(value) if value else None
+
+    def get_rect(self, key='bb'):
+        value = self.attr.get(key)
+        return decode_rect(value) if value else None
+
+    def get_spline(self, key='pos'):
+        if key != 'pos':
+            value = self.attr.get(key)
+            return decode_spline(value) if value else []
+        store = self.store
+        coords = store.coords
+        ends = store.spline_ends
+        splines = []
+        for i in range(store.edge_splines[self.index], store.edge_splines[self.index + 1]):
+            startp = endp = None
+            if ends[4 * i] == ends[4 * i]:
+                startp = ends[4 * i], ends[4 * i + 1]
+            if ends[4 * i + 2] == ends[4 * i + 2]:
+                endp = ends[4 * i + 2], ends[4 * i + 3]
+            points = [(coords[j], coords[j + 1])
+                      for j in range(2 * store.spline_points[i], 2 * store.spline_points[i + 1], 2)]
+            splines.append((startp, endp, points))
+        return splines
+
+
+class _ColumnarElements(object):
+    """Iterable over the nodes or edges in a DotColumns store"""
+
+    def __init__(self, store, cursor_class, order):
+        self.store = store
+        self.cursor_class = cursor_class
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        cursor = self.cursor_class(self.store)
+        for index in self.order:
+            cursor.index = index
+            yield cursor
+
+
+class DotColumns(object):
+    """Array based storage for the nodes and edges of a graph
+
+    Intended for very large graphs. Attributes are stored in one list per
+    attribute name instead of one dict per element. Node positions and edge
+    splines are decoded into flat array('d') buffers. Node and edge
+    endpoints are indices into node_names.
+
+    The nodes and edges properties iterate over the elements using a single
+    ColumnarNode or ColumnarEdge cursor, so no objects are created for each
+    element.
+    """
+
+    def __init__(self, directed=False, strict=False):
+        self.directed = directed
+        self.strict = strict
+        self.node_names = []
+        self.node_index = {}
+        self.node_attr = {}
+        self.node_xy = array('d')
+        self.node_draw_records = None
+        self.ports = ['']
+        self.port_index = {'': 0}
+        self.edge_src = array('l')
+        self.edge_dst = array('l')
+        self.edge_src_port = array('l')
+        self.edge_dst_port = array('l')
+        self.edge_attr = {}
+        self.edge_draw_records = None
+        # The splines of edge i are edge_splines[i]:edge_splines[i + 1]. The
+        # control points of spline k are spline_points[k]:spline_points[k + 1]
+        # in coords. spline_ends has the start and end arrow points, NaN if
+        # not given.
+        self.edge_splines = array('l', [0])
+        self.spline_points = array('l', [0])
+        self.spline_ends = array('d')
+        self.coords = array('d')
+        # Edges are iterated grouped by endpoints, like DotGraph.alledges.
+        # _edge_last maps the endpoints to the last edge added between them.
+        self._edge_last = {}
+        self._edge_next = array('l')
+        self._edge_first = array('b')
+        self._edge_order = None
+
+    def __len__(self):
+        return len(self.node_names)
+
+    def set_attr(self, columns, index, key, value):
+        key, value = intern_attr(key, value)
+        column = columns.get(key)
+        if column is None:
+            if columns is self.node_attr:
+                count = len(self.node_names)
+            else:
+                count = len(self.edge_src)
+            column = columns[key] = [_unset] * count
+        column[index] = value
+
+    def _add_row(self, columns):
+        for column in columns.values():
+            column.append(_unset)
+
+    def add_node(self, name, defaults=None, **kwds):
+        """Add a node or update the attributes of an existing node
+
+        defaults are only used for new nodes. Returns the node index.
+        """
+        index = self.node_index.get(name)
+        if index is None:
+            index = self.node_index[name] = len(self.node_names)
+            self.node_names.append(name)
+            self._add_row(self.node_attr)
+            self.node_xy.extend((_nan, _nan))
+            if self.node_draw_records is not None:
+                self.node_draw_records.append(None)
+            if defaults:
+                for key, value in defaults.items():
+                    self._set_node_attr(index, key, value)
+        for key, value in kwds.items():
+            self._set_node_attr(index, key, value)
+        return index
+
+    def _set_node_attr(self, index, key, value):
+        if key == 'pos':
+            point = decode_point(value) if value else None
+            if point:
+                self.node_xy[2 * index], self.node_xy[2 * index + 1] = point
+                return
+        self.set_attr(self.node_attr, index, key, value)
+
+    def _port_id(self, port):
+        port_id = self.port_index.get(port)
+        if port_id is None:
+            port_id = self.port_index[port] = len(self.ports)
+            self.ports.append(port)
+        return port_id
+
+    def add_edge(self, src, dst, srcport="", dstport="", defaults=None, node_defaults=None, **kwds):
+        """Add an edge between the nodes named src and dst
+
+        Nodes are added with node_defaults if necessary. In strict graphs
+        an edge is not added if the nodes already have an edge. Returns the
+        edge index or None.
+        """
+        u = self.add_node(src, node_defaults)
+        v = self.add_node(dst, node_defaults)
+        key = (u << 32) | v
+        last = self._edge_last.get(key)
+        if last is not None and self.strict:
+            return None
+        index = len(self.edge_src)
+        if last is None:
+            self._edge_first.append(1)
+        else:
+            self._edge_first.append(0)
+            self._edge_next[last] = index
+        self._edge_last[key] = index
+        self._edge_next.append(-1)
+        self._edge_order = None
+        self.edge_src.append(u)
+        self.edge_dst.append(v)
+        self.edge_src_port.append(self._port_id(srcport))
+        self.edge_dst_port.append(self._port_id(dstport))
+        self._add_row(self.edge_attr)
+        if self.edge_draw_records is not None:
+            self.edge_draw_records.append(None)
+        attr = dict(defaults or ())
+        attr.update(kwds)
+        pos = attr.pop('pos', None)
+        splines = []
+        if pos:
+            try:
+                splines = decode_spline(pos)
+            except (ValueError, IndexError):
+                # Keep values that are not splines as they are
+                attr['pos'] = pos
+        for startp, endp, points in splines:
+            self.spline_ends.extend(startp or (_nan, _nan))
+            self.spline_ends.extend(endp or (_nan, _nan))
+            for point in points:
+                self.coords.extend(point)
+            self.spline_points.append(len(self.coords) // 2)
+        self.edge_splines.append(len(self.spline_points) - 1)
+        for key, value in attr.items():
+            self.set_attr(self.edge_attr, index, key, value)
+        return index
+
+    def set_draw_records(self, element, index, draw_records):
+        if element == 'node':
+            if self.node_draw_records is None:
+                self.node_draw_records = [None] * len(self.node_names)
+            self.node_draw_records[index] = draw_records
+        else:
+            if self.edge_draw_records is None:
+                self.edge_draw_records = [None] * len(self.edge_src)
+            self.edge_draw_records[index] = draw_records
+
+    def _get_edge_order(self):
+        if self._edge_order is None:
+            order = array('l')
+            edge_next = self._edge_next
+            for first in range(len(self.edge_src)):
+                if not self._edge_first[first]:
+                    continue
+                index = first
+                while index >= 0:
+                    order.append(index)
+                    index = edge_next[index]
+            self._edge_order = order
+        return self._edge_order
+
+    nodes = property(lambda self: _ColumnarElements(self, ColumnarNode, range(len(self.node_names))))
+    edges = property(lambda self: _ColumnarElements(self, ColumnarEdge, self._get_edge_order()))
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Create a DotColumns store with the nodes and edges of a DotGraph"""
+        store = cls(graph.directed, graph.strict)
+        for node in graph.allnodes:
+            index = store.add_node(node.name, **node.attr)
+            if node.draw_records:
+                store.set_draw_records('node', index, node.draw_records)
+        for edge in graph.alledges:
+            index = store.add_edge(edge.src.name, edge.dst.name, edge.src_port, edge.dst_port,
+                                   **edge.attr)
+            if edge.draw_records:
+                store.set_draw_records('edge', index, edge.draw_records)
+        return store
+
+    def build(self, graph, stmts):
+        """Add the statements of a (sub)graph parsed by XDotReader
+
+        Nodes and edges are added to the store. Subgraphs, graph attributes
+        and default attributes are added to graph.
+        """
+        for stmt in stmts:
+            cmd = stmt[0]
+            if cmd == ADD_NODE:
+                self.add_node(stmt[1], graph.default_node_attr, **stmt[2])
+            elif cmd == ADD_EDGE:
+                cmd, src, dst, opts = stmt
+                srcport = dstport = ""
+                if isinstance(src, tuple):
+                    src, srcport = src
+                if isinstance(dst, tuple):
+                    dst, dstport = dst
+                self.add_edge(src, dst, srcport, dstport, graph.default_edge_attr,
+                              graph.default_node_attr, **opts)
+            elif cmd == SET_GRAPH_ATTR:
+                graph.set_attr(**stmt[1])
+            elif cmd == SET_DEF_NODE_ATTR:
+                graph.add_default_node_attr(**stmt[1])
+            elif cmd == SET_DEF_EDGE_ATTR:
+                graph.add_default_edge_attr(**stmt[1])
+            elif cmd == SET_DEF_GRAPH_ATTR:
+                graph.add_default_graph_attr(**stmt[1])
+                graph.attr.update(**stmt[1])
+            elif cmd == ADD_SUBGRAPH:
+                subgraph = graph.add_subgraph(stmt[1])
+                self.build(subgraph, stmt[2])
+                graph.allitems.append(subgraph)
+        return graph
+
+
+def read_xdot_columns(data):
+    """Read xdot data generated by Graphviz into a DotColumns store
+
+    Returns (graph, store). The graph holds the graph attributes and the
+    subgraphs, but no nodes or edges. Raises XDotFormatError if the data
+    is not in the layout XDotReader expects.
+    """
+    reader = XDotReader()
+    if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
+        data = data.decode()
+    reader.data = data.replace('\\\n', '')
+    try:
+        strict, graphtype, name, stmts = reader._read()
+    finally:
+        reader.data = None
+    graph = DotGraph(name, strict == 'strict', graphtype == 'digraph')
+    store = DotColumns(graph.directed, graph.strict)
+    store.build(graph, stmts)
+    return graph, store
+
+
 testgraph = r"""
 /* Test that the various id types are parsed correctly */
 digraph G {
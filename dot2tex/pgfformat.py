@@ -1,7 +1,7 @@
 import logging
 
-from .base import DotConvBase, parse_drawstring, get_drawobj_lblstyle
-from .utils import smart_float, nsplit, getboolattr, tikzify
+from .base import DotConvBase, ColorPalette, get_drawobj_lblstyle
+from .utils import nsplit, getboolattr, tikzify
 
 log = logging.getLogger("dot2tex")
 
@@ -177,6 +177,17 @@ class Dot2PGFConv(DotConvBase):
             dotted='\pgfsetdash{{\pgflinewidth}{2pt}}{0pt}',
             bold='\pgfsetlinewidth{1.2pt}')
 
+    def start_fig(self):
+        self.palette = ColorPalette(self.palette_color)
+        return ""
+
+    def define_colors(self):
+        return "".join(["  \\definecolor{%s}%s\n" % definition
+                        for definition in self.palette.definitions])
+
+    def palette_color(self, color):
+        return self.convert_color(color, True)
+
     def start_node(self, node):
         # Todo: Should find a more elegant solution
         self.pencolor = ""
@@ -209,32 +220,20 @@ class Dot2PGFConv(DotConvBase):
 
     def set_color(self, drawop):
         c, color = drawop
-        res = self.convert_color(color, True)
-        opacity = None
-        if len(res) == 2:
-            ccolor, opacity = res
-        else:
-            ccolor = res
+        # rgb and hsb colors are defined by define_colors
+        ccolor, opacity = self.palette.get(color)
         s = ""
         if c == 'cC':
             if self.color != color:
                 self.color = color
                 self.pencolor = color
                 self.fillcolor = color
-                if ccolor.startswith('{'):
-                    # rgb or hsb
-                    s += "  \definecolor{newcol}%s\n" % ccolor
-                    ccolor = 'newcol'
                 s += "  \pgfsetcolor{%s}\n" % ccolor
         elif c == 'c':
             # set pen color
             if self.pencolor != color:
                 self.pencolor = color
                 self.color = ''
-                if ccolor.startswith('{'):
-                    # rgb or hsb
-                    s += "  \definecolor{strokecol}%s\n" % ccolor
-                    ccolor = 'strokecol'
                 s += "  \pgfsetstrokecolor{%s}\n" % ccolor
             else:
                 return ""
@@ -243,10 +242,6 @@ class Dot2PGFConv(DotConvBase):
             if self.fillcolor != color:
                 self.fillcolor = color
                 self.color = ''
-                if ccolor.startswith('{'):
-                    # rgb
-                    s += "  \definecolor{fillcol}%s\n" % ccolor
-                    ccolor = 'fillcol'
                 s += "  \pgfsetfillcolor{%s}\n" % ccolor
                 if not opacity is None:
                     self.opacity = opacity
@@ -291,14 +286,15 @@ class Dot2PGFConv(DotConvBase):
             stylestr = " [%s]" % style
         else:
             stylestr = ''
-        s += "  \%s%s (%sbp,%sbp) ellipse (%sbp and %sbp);\n" % (cmd, stylestr, smart_float(x), smart_float(y),
+        s += "  \%s%s (%sbp,%sbp) ellipse (%sbp and %sbp);\n" % (cmd, stylestr,
+                                                                 self.format_float(x), self.format_float(y),
                                                                  # w+self.linewidth,h+self.linewidth)
-                                                                 smart_float(w), smart_float(h))
+                                                                 self.format_float(w), self.format_float(h))
         return s
 
     def draw_polygon(self, drawop, style=None):
         op, points = drawop
-        pp = ['(%sbp,%sbp)' % (smart_float(p[0]), smart_float(p[1])) for p in points]
+        pp = self.format_points(points)
         cmd = "draw"
         if op == 'P':
             cmd = "filldraw"
@@ -312,7 +308,7 @@ class Dot2PGFConv(DotConvBase):
 
     def draw_polyline(self, drawop, style=None):
         op, points = drawop
-        pp = ['(%sbp,%sbp)' % (smart_float(p[0]), smart_float(p[1])) for p in points]
+        pp = self.format_points(points)
         stylestr = ''
         return "  \draw%s %s;\n" % (stylestr, " -- ".join(pp))
 
@@ -320,15 +316,12 @@ class Dot2PGFConv(DotConvBase):
         # The coordinates given by drawop are not the same as the node
         # coordinates! This may give som odd results if graphviz' and
         # LaTeX' fonts are very different.
-        if len(drawop) == 7:
-            c, x, y, align, w, text, valign = drawop
-        else:
-            c, x, y, align, w, text = drawop
+        c, x, y, align, w, text, valign = drawop
 
         styles = []
-        if align == "-1":
+        if align == -1:
             alignstr = 'right'  # left aligned
-        elif align == "1":
+        elif align == 1:
             alignstr = 'left'  # right aligned
         else:
             alignstr = ""  # centered (default)
@@ -337,15 +330,13 @@ class Dot2PGFConv(DotConvBase):
         lblstyle = ",".join([i for i in styles if i])
         if lblstyle:
             lblstyle = '[' + lblstyle + ']'
-        s = "  \draw (%sbp,%sbp) node%s {%s};\n" % (smart_float(x), smart_float(y), lblstyle, text)
+        s = "  \draw (%sbp,%sbp) node%s {%s};\n" % (self.format_float(x), self.format_float(y), lblstyle, text)
         return s
 
     def draw_bezier(self, drawop, style=None):
         s = ""
         c, points = drawop
-        pp = []
-        for point in points:
-            pp.append("(%sbp,%sbp)" % (smart_float(point[0]), smart_float(point[1])))
+        pp = self.format_points(points)
 
         pstrs = ["%s .. controls %s and %s " % p for p in nsplit(pp, 3)]
         stylestr = ''
@@ -353,42 +344,32 @@ class Dot2PGFConv(DotConvBase):
         return s
 
     def do_edges(self):
-        s = ""
-        s += self.set_color(('cC', "black"))
+        write = self.write
+        write(self.set_color(('cC', "black")))
         for edge in self.edges:
-            general_draw_string = getattr(edge, '_draw_', "")
-            label_string = getattr(edge, '_ldraw_', "")
-            head_arrow_string = getattr(edge, '_hdraw_', "")
-            tail_arrow_string = getattr(edge, '_tdraw_', "")
-            tail_label_string = getattr(edge, '_tldraw_', "")
-            head_label_string = getattr(edge, '_hldraw_', "")
-
-            # Note that the order of the draw strings should be the same
+            # Note that the order of the draw attributes should be the same
             # as in the xdot output.
-            drawstring = general_draw_string + " " + head_arrow_string + " " + tail_arrow_string \
-                         + " " + label_string
-            draw_operations, stat = parse_drawstring(drawstring)
-            if not drawstring.strip():
+            drawattrs = ('_draw_', '_hdraw_', '_tdraw_', '_ldraw_')
+            if not self.has_drawops(edge, *drawattrs):
                 continue
-            s += self.output_edge_comment(edge)
+            write(self.output_edge_comment(edge))
             if self.options.get('duplicate'):
-                s += self.start_edge()
-                s += self.do_draw_op(draw_operations, edge, stat)
-                s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-                s += self.end_edge()
+                draw_operations, stat = self.get_drawops(edge, *drawattrs)
+                write(self.start_edge())
+                write(self.do_draw_op(draw_operations, edge, stat))
+                write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
+                write(self.end_edge())
             else:
                 topath = getattr(edge, 'topath', None)
-                s += self.draw_edge(edge)
+                write(self.draw_edge(edge))
                 if not self.options.get('tikzedgelabels') and not topath:
-                    s += self.do_drawstring(label_string, edge)
-                    s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                    s += self.do_drawstring(head_label_string, edge, "headtexlbl")
+                    write(self.do_drawattr(edge, '_ldraw_'))
+                    write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                    write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
                 else:
-                    s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                    s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-
-        self.body += s
+                    write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                    write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
 
     def draw_edge(self, edge):
         s = ""
@@ -408,10 +389,7 @@ class Dot2PGFConv(DotConvBase):
                     # reset to default color
                     s += self.set_color(('cC', 'black'))
 
-            pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            pp = self.format_points(points)
 
             edgestyle = edge.attr.get('style', '')
 
@@ -707,23 +685,21 @@ class Dot2TikZConv(Dot2PGFConv):
         # With the node syntax comments are unnecessary
         return ""
 
-    def set_tikzcolor(self, color, colorname):
+    def palette_color(self, color):
         res = self.convert_color(color, True)
-        if len(res) == 2:
-            ccolor, opacity = res
-            if not (opacity == '1'):
-                log.warning('Opacity not supported yet: %s', res)
-        else:
-            ccolor = res
-        s = ""
-        if ccolor.startswith('{'):
-            # rgb or hsb
-            s += "  \definecolor{%s}%s\n" % (colorname, ccolor)
-            cname = colorname
-        else:
-            cname = color
+        if isinstance(res, tuple) or res.startswith('{'):
+            return res
+        # Use color names as given
+        return color
 
-        return s, cname
+    def set_tikzcolor(self, color, colorname):
+        # The color is defined by define_colors, so no code is needed and
+        # colorname is not used
+        cname, opacity = self.palette.get(color)
+        if not (opacity is None or opacity == '1'):
+            # Show the color value, not the name given by the palette
+            log.warning('Opacity not supported yet: %s', self.convert_color(color, True))
+        return "", cname
 
     def get_node_preproc_code(self, node):
         shape = node.attr.get('shape', 'ellipse')
@@ -748,10 +724,9 @@ class Dot2TikZConv(Dot2PGFConv):
         return sn
 
     def do_nodes(self):
-        s = ""
         nodeoptions = self.options.get('nodeoptions')
         if nodeoptions:
-            s += "\\begin{scope}[%s]\n" % nodeoptions
+            self.write("\\begin{scope}[%s]\n" % nodeoptions)
         for node in self.nodes:
             self.currentnode = node
             # detect node type
@@ -765,16 +740,16 @@ class Dot2TikZConv(Dot2PGFConv):
             if shape is None:
                 shape = 'ellipse'
 
-            pos = getattr(node, 'pos', None)
+            pos = node.get_point()
             if not pos:
                 continue
-            x, y = pos.split(',')
+            x, y = pos
             if dotshape != 'point':
                 label = self.get_label(node)
             else:
                 label = ''
 
-            pos = "%sbp,%sbp" % (smart_float(x), smart_float(y))
+            pos = "%sbp,%sbp" % (self.format_float(x), self.format_float(y))
             style = node.attr.get('style') or ""
             lblstyle = get_drawobj_lblstyle(node, extra_styles=node.attr.get('exstyle'))
             if lblstyle:
@@ -796,13 +771,12 @@ class Dot2TikZConv(Dot2PGFConv):
             #xlabel = node.attr['xlabel'] if 'xlabel' in node.attr else None
             if xlabel is not None:
                 #xlpos = "%sbp,%sbp" % (smart_float(str(float(x)+len(xlabel)*5)), smart_float(y))
-                xlp = getattr(node, 'xlp', None)
+                xlp = node.get_point('xlp')
                 if not xlp:
                     continue
-                xlpx, xlpy = xlp.split(',')
-                xlpx = str(abs(float(x)-float(xlpx))+float(x))
+                xlpx = abs(x - xlp[0]) + x
                 xlpy = y
-                xlpos = "%sbp,%sbp" % (smart_float(xlpx), smart_float(xlpy))
+                xlpos = "%sbp,%sbp" % (self.format_float(xlpx), self.format_float(xlpy))
                 sn += "  \\node (%s) at (%s) [%s] {%s};\n" % \
                       (tikzify(node.name+"xl"), xlpos, "", xlabel)
             if shape == "coordinate":
@@ -841,36 +815,28 @@ class Dot2TikZConv(Dot2PGFConv):
                           (tikzify(node.name), pos, drawstr, shape, label)
             sn += self.end_node(node)
 
-            s += sn
+            self.write(sn)
         if nodeoptions:
-            s += "\\end{scope}\n"
-        self.body += s
+            self.write("\\end{scope}\n")
 
     def do_edges(self):
-        s = ""
+        write = self.write
         edgeoptions = self.options.get('edgeoptions')
         if edgeoptions:
-            s += "\\begin{scope}[%s]\n" % edgeoptions
+            write("\\begin{scope}[%s]\n" % edgeoptions)
         for edge in self.edges:
-            # general_draw_string = getattr(edge, '_draw_', "")
-            label_string = getattr(edge, '_ldraw_', "")
-            # head_arrow_string = getattr(edge, '_hdraw_', "")
-            # tail_arrow_string = getattr(edge, '_tdraw_', "")
-            tail_label_string = getattr(edge, '_tldraw_', "")
-            head_label_string = getattr(edge, '_hldraw_', "")
             topath = getattr(edge, 'topath', None)
-            s += self.draw_edge(edge)
+            write(self.draw_edge(edge))
             if not self.options.get('tikzedgelabels') and not topath:
-                s += self.do_drawstring(label_string, edge)
-                s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                s += self.do_drawstring(head_label_string, edge, "headtexlbl")
+                write(self.do_drawattr(edge, '_ldraw_'))
+                write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
             else:
-                s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
-                s += self.do_drawstring(head_label_string, edge, "headtexlbl")
+                write(self.do_drawattr(edge, '_tldraw_', "tailtexlbl"))
+                write(self.do_drawattr(edge, '_hldraw_', "headtexlbl"))
 
         if edgeoptions:
-            s += "\\end{scope}\n"
-        self.body += s
+            write("\\end{scope}\n")
 
     def draw_edge(self, edge):
         s = ""
@@ -885,10 +851,7 @@ class Dot2TikZConv(Dot2PGFConv):
             # PGF uses the fill style when drawing some arrowheads. We have to
             # ensure that the fill color is the same as the pen color.
             color = edge.attr.get('color', '')
-            pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            pp = self.format_points(points)
 
             edgestyle = edge.attr.get('style')
 
@@ -958,13 +921,16 @@ class PositionsDotConv(Dot2PGFConv):
     Returns a dictionary with node name as key and a (x, y) tuple as value.
     """
 
+    def iter_output(self):
+        yield str(self.output())
+
     def output(self):
         positions = {}
         for node in self.nodes:
-            pos = getattr(node, 'pos', None)
+            pos = node.get_point()
             if pos:
-                try:
-                    positions[node.name] = [int(p) for p in pos.split(',')]
-                except ValueError:
-                    positions[node.name] = [float(p) for p in pos.split(',')]
+                if all(p.is_integer() for p in pos):
+                    positions[node.name] = [int(p) for p in pos]
+                else:
+                    positions[node.name] = list(pos)
         return positions
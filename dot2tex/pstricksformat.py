@@ -1,7 +1,7 @@
 import logging
 
 from .base import DotConvBase
-from .utils import smart_float, tikzify
+from .utils import tikzify
 
 log = logging.getLogger("dot2tex")
 
@@ -72,9 +72,9 @@ class Dot2PSTricksConv(DotConvBase):
         self.pencolor = ""
         self.fillcolor = ""
         self.color = ""
-        self.body += '{\n'
+        self.write('{\n')
         DotConvBase.do_graph(self)
-        self.body += '}\n'
+        self.write('}\n')
 
     def draw_ellipse(self, drawop, style=None):
         op, x, y, w, h = drawop
@@ -92,15 +92,16 @@ class Dot2PSTricksConv(DotConvBase):
             else:
                 stylestr = style
 
-        s += "  \psellipse[%s](%sbp,%sbp)(%sbp,%sbp)\n" % (stylestr, smart_float(x), smart_float(y),
+        s += "  \psellipse[%s](%sbp,%sbp)(%sbp,%sbp)\n" % (stylestr,
+                                                           self.format_float(x), self.format_float(y),
                                                            # w+self.linewidth,h+self.linewidth)
-                                                           smart_float(w), smart_float(h))
+                                                           self.format_float(w), self.format_float(h))
 
         return s
 
     def draw_polygon(self, drawop, style=None):
         op, points = drawop
-        pp = ['(%sbp,%sbp)' % (smart_float(p[0]), smart_float(p[1])) for p in points]
+        pp = self.format_points(points)
         stylestr = ""
         if op == 'P':
             if style:
@@ -117,34 +118,28 @@ class Dot2PSTricksConv(DotConvBase):
 
     def draw_polyline(self, drawop, style=None):
         op, points = drawop
-        pp = ['(%sbp,%sbp)' % (smart_float(p[0]), smart_float(p[1])) for p in points]
+        pp = self.format_points(points)
         s = "  \psline%s\n" % "".join(pp)
         return s
 
     def draw_bezier(self, drawop, style=None):
         op, points = drawop
-        pp = []
-        for point in points:
-            pp.append("(%sbp,%sbp)" % (smart_float(point[0]), smart_float(point[1])))
+        pp = self.format_points(points)
 
         arrowstyle = ""
         return "  \psbezier{%s}%s\n" % (arrowstyle, "".join(pp))
 
     def draw_text(self, drawop, style=None):
-        if len(drawop) == 7:
-            c, x, y, align, w, text, valign = drawop
-        else:
-            c, x, y, align, w, text = drawop
-            valign = ""
-        if align == "-1":
+        c, x, y, align, w, text, valign = drawop
+        if align == -1:
             alignstr = 'l'  # left aligned
-        elif align == "1":
+        elif align == 1:
             alignstr = 'r'  # right aligned
         else:
             alignstr = ""  # centered (default)
         if alignstr or valign:
             alignstr = '[' + alignstr + valign + ']'
-        s = "  \\rput%s(%sbp,%sbp){%s}\n" % (alignstr, smart_float(x), smart_float(y), text)
+        s = "  \\rput%s(%sbp,%sbp){%s}\n" % (alignstr, self.format_float(x), self.format_float(y), text)
         return s
 
     def set_color(self, drawop):
@@ -231,10 +226,7 @@ class Dot2PSTricksConv(DotConvBase):
                 else:
                     # reset to default color
                     s += self.set_color(('c', 'black'))
-            pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            pp = self.format_points(points)
 
             edgestyle = edge.attr.get('style', '')
             styles = []
@@ -336,7 +328,6 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
         return ""
 
     def do_nodes(self):
-        s = ""
         for node in self.nodes:
             self.currentnode = node
 
@@ -381,12 +372,12 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
                 if style == "bold":
                     psshadeoption = "linewidth=2pt," + psshadeoption
 
-            pos = getattr(node, 'pos')
+            pos = node.get_point()
             if not pos:
                 continue
-            x, y = pos.split(',')
+            x, y = pos
             label = self.get_label(node)
-            pos = "%sbp,%sbp" % (smart_float(x), smart_float(y))
+            pos = "%sbp,%sbp" % (self.format_float(x), self.format_float(y))
             # TODO style
 
             sn = ""
@@ -399,14 +390,11 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
                 sn += "\\rput(%s){\\rnode{%s}{\\%s[%s]{\parbox[c][%sin][c]{%sin}{\centering %s}}}}\n" % \
                       (pos, tikzify(node.name), psshape, psshadeoption, height, width, label)
             sn += self.end_node(node)
-            s += sn
-        self.body += s
+            self.write(sn)
 
     def do_edges(self):
-        s = ""
         for edge in self.edges:
-            s += self.draw_edge(edge)
-        self.body += s
+            self.write(self.draw_edge(edge))
 
     def draw_edge(self, edge):
         s = ""
@@ -0,0 +1,350 @@
+import http.client
+import http.server
+import ipaddress
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from . import base, dotparsing
+from .dot2tex import create_options_parser, d2toptions_re, input_re, load_dot_file, \
+    main, output_is_newer
+
+log = logging.getLogger("dot2tex")
+
+# Options the server does not accept, since they would make it read or
+# write files, run Graphviz with any options or change the logging of the
+# server process. --template and --debug are handled by the client.
+UNSUPPORTED_OPTIONS = [('templatefile', '--template'), ('layoutcache', '--layoutcache'),
+                       ('progoptions', '--progoptions'), ('debug', '--debug')]
+# Options that are reset by the server, since the files are read and written
+# by the client. They are not accepted in d2toptions in the graph either,
+# where main would set them again.
+SERVER_OPTIONS = [('inputfile', 'inputfile'), ('outputfile', '--output'),
+                  ('batch', '--batch'), ('manifest', '--manifest'), ('outputdir', '--outputdir'),
+                  ('watch', '--watch'), ('serve', '--serve'), ('server', '--server'),
+                  ('runtests', '--runtests'), ('cache', '--cache')]
+
+
+def parse_address(address):
+    """Parse a server address
+
+    Returns ('tcp', (host, port)) for addresses like host:port or :port,
+    where the host defaults to 127.0.0.1. Other addresses are paths to a
+    Unix socket, and ('unix', path) is returned.
+    """
+    m = re.match(r'^([\w.-]*):(\d+)$', address)
+    if m:
+        return 'tcp', (m.group(1) or '127.0.0.1', int(m.group(2)))
+    return 'unix', address
+
+
+def is_loopback(host):
+    """Return True if host is localhost or a loopback address"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def unsupported_options(options, unsupported=UNSUPPORTED_OPTIONS):
+    """Return the options in options that the server does not accept"""
+    return [option for name, option in unsupported if getattr(options, name, None)]
+
+
+class ServerStats(object):
+    """Number of requests and their latency for a conversion server"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.time = 0.0
+        self.max_time = 0.0
+
+    def add(self, elapsed, failed=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(failed)
+            self.time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(requests=self.requests, errors=self.errors,
+                        mean_ms=1000 * self.time / (self.requests or 1),
+                        max_ms=1000 * self.max_time,
+                        graphviz_calls=base.layout_stats.calls,
+                        graphviz_ms=1000 * base.layout_stats.time)
+
+
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+    """Handle conversion requests
+
+    POST /convert takes a JSON object with the command line arguments in
+    args and the graph in dotdata. The response is a JSON object with the
+    LaTeX code in output, or an error message in error, and the time used
+    in ms. GET /stats returns the statistics for the server.
+    """
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'local'
+
+    def log_request(self, code='-', size='-'):
+        # Requests are logged with their latency in do_POST
+        pass
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.stats.as_dict())
+        else:
+            self.send_json(404, dict(error='Not found'))
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self.send_json(404, dict(error='Not found'))
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            code, result = self.server.convert(request['args'], request['dotdata'],
+                                               request.get('template'))
+        except (ValueError, KeyError, TypeError) as err:
+            code, result = 400, dict(error='Invalid request: %s' % err)
+        elapsed = time.perf_counter() - start
+        result['ms'] = elapsed * 1000
+        self.server.stats.add(elapsed, code != 200)
+        self.send_json(code, result)
+        self.log_message('convert %d %.1f ms', code, elapsed * 1000)
+
+
+class ConversionServerMixin(object):
+    """Conversion logic shared by the TCP and Unix socket servers"""
+
+    daemon_threads = True
+
+    def init_conversion(self):
+        self.stats = ServerStats()
+        self.options_parser = create_options_parser()
+        self._parser_lock = threading.Lock()
+
+    def convert(self, args, dotdata, template=None):
+        """Convert dotdata with the command line arguments args
+
+        template is the contents of the template file, which is read by the
+        client. Returns an HTTP status code and the result as a dictionary.
+        """
+        try:
+            with self._parser_lock:
+                options = self.options_parser.parse_args(list(args))
+                extraoptions = d2toptions_re.findall(dotdata)
+                if extraoptions:
+                    graphoptions = self.options_parser.parse_args(extraoptions[0].split())
+                else:
+                    graphoptions = None
+        except SystemExit:
+            return 400, dict(error='Invalid arguments: %s' % ' '.join(args))
+        unsupported = unsupported_options(options) + unsupported_options(
+            graphoptions, UNSUPPORTED_OPTIONS + SERVER_OPTIONS)
+        if unsupported:
+            return 400, dict(error='Not supported by the server: %s' % ' '.join(unsupported))
+        if input_re.search(dotdata):
+            return 400, dict(error='Not supported by the server: \\input')
+        if template:
+            options.template = template
+        # Files are read and written by the client
+        options.inputfile = options.outputfile = options.outputdir = None
+        options.batch = options.manifest = options.watch = options.serve = options.server = None
+        options.runtests = options.cache = False
+        try:
+            return 200, dict(output=main(True, dotdata, options))
+        except dotparsing.ParseException as err:
+            return 400, dict(error='Parse error: %s' % err)
+        except SystemExit:
+            return 500, dict(error='Conversion failed')
+        except Exception as err:
+            return 500, dict(error='%s: %s' % (err.__class__.__name__, err))
+
+
+class TCPConversionServer(ConversionServerMixin, socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    pass
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixConversionServer(ConversionServerMixin, socketserver.ThreadingMixIn,
+                               socketserver.UnixStreamServer):
+        def server_bind(self):
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+            socketserver.UnixStreamServer.server_bind(self)
+            self.server_name = 'localhost'
+            self.server_port = 0
+
+
+def create_server(address):
+    """Create a conversion server listening on address
+
+    The server does not authenticate its clients, so TCP servers only
+    listen on loopback addresses.
+    """
+    kind, server_address = parse_address(address)
+    if kind == 'tcp':
+        if not is_loopback(server_address[0]):
+            raise ValueError('The server only listens on localhost, not on %s'
+                             % server_address[0])
+        server = TCPConversionServer(server_address, ConversionHandler)
+    elif hasattr(socket, 'AF_UNIX'):
+        server = UnixConversionServer(server_address, ConversionHandler)
+    else:
+        raise ValueError('Unix sockets are not supported on this platform. Use host:port')
+    server.init_conversion()
+    return server
+
+
+def serve(address):
+    """Run a conversion server on address until interrupted"""
+    try:
+        server = create_server(address)
+    except (ValueError, OSError) as err:
+        log.error('Could not start the dot2tex server on %s: %s', address, err)
+        return 1
+    # Build the grammar and locate Graphviz before the first request
+    with dotparsing.parser_pool.parser():
+        pass
+    dotparsing.get_graphviz()
+    sys.stderr.write('dot2tex server listening on %s\n' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+    return 0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(address, method, path, data=None, timeout=None):
+    """Send a request to the server at address and return the JSON response"""
+    kind, server_address = parse_address(address)
+    if kind == 'tcp':
+        conn = http.client.HTTPConnection(*server_address, timeout=timeout)
+    else:
+        conn = UnixHTTPConnection(server_address, timeout=timeout)
+    try:
+        body = json.dumps(data).encode('utf8') if data is not None else None
+        conn.request(method, path, body, {'Content-Type': 'application/json'})
+        return json.loads(conn.getresponse().read().decode('utf8'))
+    finally:
+        conn.close()
+
+
+def strip_server_args(argv, options=('--server',), flags=()):
+    """Remove the --server option from the command line arguments argv
+
+    Other options with a value, and flags without one, can be removed too.
+    """
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif arg not in flags and not arg.startswith(tuple(o + '=' for o in options)):
+            args.append(arg)
+    return args
+
+
+def run_client(address, argv):
+    """Convert a graph with the server at address
+
+    argv are the usual command line arguments. The input is read and the
+    output written by the client, everything else is done by the server.
+    Returns the exit code for dot2tex.
+    """
+    options = create_options_parser().parse_args(argv)
+    unsupported = [option for option in unsupported_options(options)
+                   if option not in ('--template', '--debug')]
+    if unsupported:
+        log.error('Not supported with --server: %s', ' '.join(unsupported))
+        return 1
+    if options.inputfile is None:
+        dotdata = sys.stdin.read()
+    else:
+        if options.outputfile is not None and not options.force \
+                and output_is_newer(options.inputfile, options.outputfile):
+            print('skip: input file older than output file.')
+            return 0
+        try:
+            dotdata = "".join(load_dot_file(options.inputfile))
+        except IOError:
+            log.error('Failed to load file %s', options.inputfile)
+            return 1
+    # Files are read relative to the directory of the client, not the server
+    m = input_re.search(dotdata)
+    if m:
+        filename = m.group('filename')
+        log.info('Found \\input{%s}', filename)
+        try:
+            dotdata = "".join(load_dot_file(filename))
+        except IOError:
+            log.error('Failed to load \\input{%s}', filename)
+            return 1
+    template = None
+    if options.templatefile:
+        try:
+            with open(options.templatefile) as f:
+                template = f.read()
+        except IOError:
+            log.warning('Failed to read the template file %s', options.templatefile)
+    args = strip_server_args(argv, ('--server', '--template'), ('--debug',))
+    try:
+        result = request(address, 'POST', '/convert',
+                         dict(args=args, dotdata=dotdata, template=template))
+    except (OSError, http.client.HTTPException) as err:
+        log.error('Could not connect to the dot2tex server at %s: %s', address, err)
+        return 1
+    if 'error' in result:
+        log.error(result['error'])
+        return 1
+    log.debug('Converted by the server in %.1f ms', result['ms'])
+    if options.outputfile:
+        with open(options.outputfile, 'w') as f:
+            f.write(result['output'])
+    else:
+        print(result['output'])
+    return 0
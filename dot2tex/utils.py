@@ -1,3 +1,5 @@
+from itertools import chain
+
 from . import dotparsing
 
 # Inch to bp conversion factor
@@ -92,6 +94,59 @@ def smart_float(number):
         return number_as_string
 
 
+def fixed_float(number, precision):
+    """Format number with at most precision decimals
+
+    Trailing zeros are removed.
+
+    Examples:
+    >>> fixed_float(123.456789, 2)
+    '123.46'
+    >>> fixed_float(27.0, 2)
+    '27'
+    """
+    number_as_string = "%.*f" % (precision, float(number))
+    if precision > 0:
+        number_as_string = number_as_string.rstrip('0').rstrip('.')
+    if number_as_string == '-0':
+        return '0'
+    return number_as_string
+
+
+def format_points(points, template='(%sbp,%sbp)', precision=None):
+    """Return template % (x, y) for each point, with formatted coordinates
+
+    The coordinates are formatted like smart_float, or like fixed_float if
+    precision is given. All of them are formatted by a single string
+    formatting operation, which is much faster than formatting each
+    coordinate when there are many points. The template must not contain
+    newlines.
+
+    Examples:
+    >>> format_points([(1, 2.5), (3e-05, 4)])
+    ['(1.0bp,2.5bp)', '(0.0000bp,4.0bp)']
+    >>> format_points([(1, 2.5), (3e-05, 4)], precision=2)
+    ['(1bp,2.5bp)', '(0bp,4bp)']
+    """
+    coords = tuple(map(float, chain.from_iterable(points)))
+    if precision is not None:
+        # Every number has exactly precision decimals, so at most precision
+        # zeros are removed from the end of each line
+        numbers = ("\n%%.%df" % precision) * len(coords) % coords + "\n"
+        for i in range(precision):
+            numbers = numbers.replace('0\n', '\n')
+        numbers = numbers.replace('.\n', '\n')
+        coords = numbers.split('\n')[1:-1]
+        if '\n-0\n' in numbers:
+            coords = ['0' if c == '-0' else c for c in coords]
+        coords = tuple(coords)
+    block = ((template + '\n') * len(points)) % coords
+    if precision is None and 'e' in block:
+        # Fall back to smart_float for numbers like 1e-05
+        return [template % (smart_float(x), smart_float(y)) for x, y in points]
+    return block.split('\n')[:-1]
+
+
 def is_multiline_label(drawobject):
     # https://graphviz.gitlab.io/_pages/doc/info/attrs.html#k:escString
     if getattr(drawobject, "texlbl", None):
@@ -0,0 +1,57 @@
+"""
+Benchmark laying out many small graphs.
+
+Usage:
+    python bench_batch_layout.py [-n graphs] [-s size] [--prog dot]
+
+Lays out the same set of graphs with one Graphviz process per graph and with
+all the graphs piped to a single process using create_xdot_batch, and reports
+the time used by each. Requires Graphviz.
+"""
+
+import argparse
+import sys
+import time
+
+from dot2tex import base, dotparsing
+
+
+def small_graph(i, size):
+    """Return a small graph with size nodes"""
+    lines = ['digraph G%d {' % i]
+    for j in range(size - 1):
+        lines.append('\tn%d -> n%d [label="e%d"];' % (j, j + 1, j))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched Graphviz layout')
+    parser.add_argument('-n', '--graphs', type=int, default=200)
+    parser.add_argument('-s', '--size', type=int, default=10)
+    parser.add_argument('--prog', default='dot')
+    args = parser.parse_args()
+    if dotparsing.get_graphviz() is None:
+        print("Graphviz was not found")
+        return 1
+
+    graphs = [small_graph(i, args.size) for i in range(args.graphs)]
+
+    start = time.perf_counter()
+    single = [base.create_xdot(graph, args.prog) for graph in graphs]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = base.create_xdot_batch(graphs, args.prog)
+    batch_time = time.perf_counter() - start
+
+    if [layout.strip() for layout in single] != [layout.strip() for layout in batched]:
+        print("Warning: the batched layouts differ from the single layouts")
+    print("%d graphs with %d nodes" % (args.graphs, args.size))
+    print("one process per graph: %.0f ms" % (single_time * 1000))
+    print("one process in total:  %.0f ms (%.1fx)"
+          % (batch_time * 1000, single_time / (batch_time or 1e-9)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Benchmark conversion of graphs with many colored elements.
+
+Usage:
+    python bench_colors.py [-n nodes] [-c colors] [-f format] [-r repeat]
+
+Converts a synthetic xdot graph where every node and edge uses one of
+a few RGB colors, and reports the best time used by the conversion, not
+counting the parsing of the graph, and the number of \\definecolor
+commands in the output.
+"""
+
+import argparse
+import sys
+import time
+
+from dot2tex import dotparsing
+
+from bench_splines import converters
+
+
+def synthetic_xdot(nodes, colors):
+    """Return xdot data for a chain of nodes using colors RGB colors"""
+    palette = ["#%02x%02x%02x" % (i * 37 % 256, i * 91 % 256, i * 53 % 256)
+               for i in range(colors)]
+    lines = ['digraph G {',
+             '\tgraph [bb="0,0,%d,54"];' % (nodes * 72),
+             '\tnode [label="\\N", style=filled];']
+    for i in range(nodes):
+        color = palette[i % colors]
+        fillcolor = palette[(i + 1) % colors]
+        lines.append('\tn%d [color="%s", fillcolor="%s", height=0.5, pos="%d,27", width=0.75, '
+                     '_draw_="c 7 -%s C 7 -%s E %d 27 27 18 "];'
+                     % (i, color, fillcolor, i * 72 + 27, color, fillcolor, i * 72 + 27))
+    for i in range(nodes - 1):
+        color = palette[i % colors]
+        x = i * 72 + 54
+        lines.append('\tn%d -> n%d [color="%s", pos="e,%d,27 %d,27 %d,27 %d,27 %d,27", '
+                     '_draw_="c 7 -%s B 4 %d 27 %d 27 %d 27 %d 27 ", '
+                     '_hdraw_="S 5 -solid c 7 -%s C 7 -%s P 3 %d 30 %d 27 %d 24 "];'
+                     % (i, i + 1, color, x + 18, x, x + 4, x + 8, x + 10, color,
+                        x, x + 4, x + 8, x + 10, color, color, x + 8, x + 18, x + 8))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conversion of colored graphs')
+    parser.add_argument('-n', '--nodes', type=int, default=5000)
+    parser.add_argument('-c', '--colors', type=int, default=8)
+    parser.add_argument('-f', '--format', default='pgf', choices=sorted(converters))
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_xdot(args.nodes, args.colors)
+    best = None
+    for i in range(args.repeat):
+        graph = dotparsing.parse_xdot_data(data)
+        start = time.perf_counter()
+        output = converters[args.format](dict(figonly=True)).convert(graph)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("%d nodes, %d colors, format %s" % (args.nodes, args.colors, args.format))
+    print("conversion: %.0f ms" % (best * 1000))
+    print("output: %d chars, %d \\definecolor" % (len(output), output.count('\\definecolor')))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Count the drawstrings parsed when converting a graph.
+
+Usage:
+    python bench_drawops.py [-n nodes] [-f format] [--duplicate]
+
+Converts a synthetic xdot graph with labeled edges and reports the number
+of calls to parse_drawstring per edge and the time used by the conversion,
+not counting the parsing of the graph. Run it on different versions of
+dot2tex to compare them.
+"""
+
+import argparse
+import sys
+import time
+
+from dot2tex import base, dotparsing
+from dot2tex.pgfformat import Dot2PGFConv, Dot2TikZConv
+from dot2tex.pstricksformat import Dot2PSTricksConv
+
+converters = {'pgf': Dot2PGFConv, 'tikz': Dot2TikZConv, 'pstricks': Dot2PSTricksConv}
+
+
+def synthetic_xdot(n):
+    """Return xdot data for a chain of n nodes with labeled edges"""
+    lines = ['digraph G {',
+             '\tgraph [bb="0,0,%d,%d"];' % (n * 10, n * 10),
+             '\tnode [label="\\N"];']
+    for i in range(n):
+        lines.append('\tn%d [height=0.5, pos="%d,%d", width=0.75, '
+                     '_draw_="c 7 -#000000 e %d %d 27 18 ", '
+                     '_ldraw_="F 14 11 -Times-Roman c 7 -#000000 T %d %d 0 7 1 -a "];'
+                     % (i, i * 10, i * 10, i * 10, i * 10, i * 10, i * 10))
+    for i in range(n - 1):
+        lines.append('\tn%d -> n%d [label=e%d, lp="%d,%d", pos="e,%d,%d %d,%d %d,%d %d,%d %d,%d", '
+                     '_draw_="c 7 -#000000 B 4 %d %d %d %d %d %d %d %d ", '
+                     '_hdraw_="S 5 -solid c 7 -#000000 C 7 -#000000 P 3 %d %d %d %d %d %d ", '
+                     '_ldraw_="F 14 11 -Times-Roman c 7 -#000000 T %d %d 0 14 2 -e%d "];'
+                     % ((i, i + 1, i, i * 10, i * 10 + 5) + (i * 10, i * 10 + 5) * 12
+                        + (i * 10, i * 10 + 5, i % 10)))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count drawstrings parsed per edge')
+    parser.add_argument('-n', '--nodes', type=int, default=2000)
+    parser.add_argument('-f', '--format', default='pgf', choices=sorted(converters))
+    parser.add_argument('--duplicate', action='store_true')
+    args = parser.parse_args()
+
+    data = synthetic_xdot(args.nodes)
+    edges = args.nodes - 1
+    options = dict(duplicate=args.duplicate, figonly=True)
+
+    graph = dotparsing.parse_xdot_data(data)
+    start = time.perf_counter()
+    converters[args.format](dict(options)).convert(graph)
+    elapsed = time.perf_counter() - start
+
+    calls = []
+    parse_drawstring = base.parse_drawstring
+
+    def counting_parse_drawstring(drawstring):
+        calls.append(drawstring)
+        return parse_drawstring(drawstring)
+
+    base.parse_drawstring = counting_parse_drawstring
+    try:
+        converters[args.format](dict(options)).convert(dotparsing.parse_xdot_data(data))
+    finally:
+        base.parse_drawstring = parse_drawstring
+
+    print("%d nodes, %d edges, format %s%s"
+          % (args.nodes, edges, args.format, ', duplicate' if args.duplicate else ''))
+    print("parse_drawstring calls: %d (%.2f per edge, edges and nodes counted)"
+          % (len(calls), len(calls) / float(edges)))
+    print("conversion: %.0f ms" % (elapsed * 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
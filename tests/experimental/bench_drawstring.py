@@ -0,0 +1,64 @@
+"""
+Benchmark parsing of xdot drawstrings.
+
+Usage:
+    python bench_drawstring.py [-n size] [-r repeat]
+
+Times parse_drawstring on drawstrings of increasing length: a single B-spline
+with many control points, like the ones Graphviz produces for long edges, and
+many short draw operations, like the graph drawstring for a graph with many
+clusters. Run it on different versions of dot2tex to compare them.
+"""
+
+import argparse
+import sys
+import time
+
+from dot2tex.base import parse_drawstring
+
+
+def spline_drawstring(points):
+    """Return an xdot drawstring for an edge with a spline of points points"""
+    coords = " ".join("%.2f %.2f" % (i * 1.5, (i % 7) * 3.25) for i in range(points))
+    return ("S 5 -solid c 7 -#000000 B %d %s F 14 11 -Times-Roman "
+            "T 10 20 0 35 5 -label " % (points, coords))
+
+
+def many_ops_drawstring(ops):
+    """Return an xdot drawstring with ops polygons and labels"""
+    parts = []
+    for i in range(ops):
+        parts.append("c 7 -#%06x p 4 %d 0 %d 10 %d 10 %d 0 F 14 11 -Times-Roman "
+                     "T %d 5 0 21 3 -c%d " % (i, i, i, i + 1, i + 1, i, i % 10))
+    return "".join(parts)
+
+
+def best_time(drawstring, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        parse_drawstring(drawstring)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark drawstring parsing')
+    parser.add_argument('-n', '--size', type=int, default=4096,
+                        help='Largest number of points and operations')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, make_drawstring in [('points', spline_drawstring),
+                                  ('operations', many_ops_drawstring)]:
+        size = 4
+        while size <= args.size:
+            drawstring = make_drawstring(size)
+            print("%6d %-10s %8d chars: %8.2f ms"
+                  % (size, name, len(drawstring), best_time(drawstring, args.repeat) * 1000))
+            size *= 4
+
+
+if __name__ == '__main__':
+    sys.exit(main())
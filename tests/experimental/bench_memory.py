@@ -0,0 +1,80 @@
+"""
+Measure the memory used by parsed graphs.
+
+Usage:
+    python bench_memory.py [-n nodes] [file.dot|file.xdot ...]
+
+Without files a synthetic graph similar to the xdot output from Graphviz is
+used. Reports the number of bytes allocated per node and edge. Run it on
+different versions of dot2tex to compare them.
+"""
+
+import argparse
+import gc
+import sys
+import tracemalloc
+
+from dot2tex import dotparsing
+
+
+def synthetic_xdot(n):
+    """Return xdot-like data for a chain of n nodes"""
+    lines = ['digraph G {',
+             '\tgraph [bb="0,0,%d,%d"];' % (n * 10, n * 10),
+             '\tnode [label="\\N", shape=ellipse, color=black, fontsize=14];',
+             '\tedge [color=gray, arrowhead=normal];']
+    for i in range(n):
+        lines.append('\tn%d [height=0.5, pos="%d,%d", width=0.75, '
+                     '_draw_="c 7 -#000000 e %d %d 27 18 ", '
+                     '_ldraw_="F 14 11 -Times-Roman c 7 -#000000 T %d %d 0 7 1 -a "];'
+                     % (i, i * 10, i * 10, i * 10, i * 10, i * 10, i * 10))
+    for i in range(n - 1):
+        lines.append('\tn%d -> n%d [pos="e,%d,%d %d,%d %d,%d %d,%d", '
+                     '_draw_="c 7 -#000000 B 4 %d %d %d %d %d %d %d %d "];'
+                     % ((i, i + 1) + (i * 10, i * 10 + 5) * 8))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = func(*args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory used by parsed graphs')
+    parser.add_argument('-n', '--nodes', type=int, default=20000)
+    parser.add_argument('--columnar', action='store_true',
+                        help='Also measure the columnar store for xdot data')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    if args.files:
+        datasets = []
+        for filename in args.files:
+            with open(filename, 'rb') as f:
+                datasets.append((filename, f.read().decode('utf8', 'replace')))
+    else:
+        datasets = [('synthetic-%d' % args.nodes, synthetic_xdot(args.nodes))]
+
+    reader = dotparsing.RecursiveDotParser()
+    for name, data in datasets:
+        graph, size = measure(reader.parse_dot_data, data)
+        elements = len(list(graph.allnodes)) + len(list(graph.alledges))
+        print("%s: %d elements, %.1f MB, %.0f bytes per element"
+              % (name, elements, size / 1e6, size / float(elements or 1)))
+        if args.columnar:
+            (graph, store), size = measure(dotparsing.read_xdot_columns, data)
+            elements = len(store.nodes) + len(store.edges)
+            print("%s (columnar): %d elements, %.1f MB, %.0f bytes per element"
+                  % (name, elements, size / 1e6, size / float(elements or 1)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Measure the memory used for the output of a conversion.
+
+Usage:
+    python bench_output.py [-n edges] [-p points] [-f format]
+
+Converts the synthetic graph from bench_splines.py to a complete document
+and reports the size of the output, and the peak memory allocated during
+the conversion as measured by tracemalloc. The graph is converted once
+before the measurement, so the parsed graph and the decoded positions
+and draw operations cached on it are not counted.
+
+The output is both returned as a string and written to a file, if the
+version of dot2tex supports it. Peak memory close to the output size means
+that about one copy of the output is kept in memory.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dot2tex import dotparsing
+
+from bench_splines import converters, synthetic_xdot
+
+
+def measure(data, format, outfile=None):
+    """Return (output size, peak memory, time) for a conversion of data"""
+    graph = dotparsing.parse_xdot_data(data)
+    # Fill the caches of decoded positions and draw operations first
+    converters[format]({}).convert(graph)
+    conv = converters[format]({})
+    tracemalloc.start()
+    start = time.perf_counter()
+    if outfile is None:
+        size = len(conv.convert(graph))
+    else:
+        conv.convert(graph, outfile=outfile)
+        size = os.path.getsize(outfile)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory used for the output')
+    parser.add_argument('-n', '--edges', type=int, default=500)
+    parser.add_argument('-p', '--points', type=int, default=400)
+    parser.add_argument('-f', '--format', default='pgf', choices=sorted(converters))
+    args = parser.parse_args()
+
+    data = synthetic_xdot(args.edges, args.points)
+    fd, filename = tempfile.mkstemp(suffix='.tex')
+    os.close(fd)
+    try:
+        for name, outfile in [('string', None), ('file', filename)]:
+            try:
+                size, peak, elapsed = measure(data, args.format, outfile)
+            except TypeError:
+                print("%-6s not supported" % name)
+                continue
+            print("%-6s output %6.1f MB, peak memory %6.1f MB (%.1f copies), %6.0f ms"
+                  % (name, size / 1e6, peak / 1e6, peak / float(size), elapsed * 1000))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+Benchmark the dot parser engines on xdot data generated from the examples.
+
+Usage:
+    python bench_parsing.py [-n repeat] [file.dot|file.xdot ...]
+
+Plain dot files are run through Graphviz first. Requires Graphviz.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+from os.path import join, abspath, basename, dirname, normpath
+
+from dot2tex import base, dotparsing
+
+EXAMPLES_DIR = normpath(abspath(join(dirname(__file__), "../../examples/")))
+
+
+def load_xdot(filename):
+    with open(filename, 'rb') as f:
+        data = f.read().decode('utf8', 'replace')
+    if filename.endswith('.xdot'):
+        return data
+    xdotdata = base.create_xdot(data)
+    if not xdotdata:
+        return None
+    return xdotdata.decode('utf8', 'replace')
+
+
+def timeit(func, data, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func(data)
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dot parsers')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+    files = args.files or sorted(glob.glob(join(EXAMPLES_DIR, '*.dot')))
+
+    engines = [
+        ('pyparsing', dotparsing.DotDataParser().parse_dot_data),
+        ('recursive', dotparsing.RecursiveDotParser().parse_dot_data),
+        ('xdot', dotparsing.XDotReader().parse_dot_data),
+    ]
+    print("%-24s %8s %s" % ('file', 'kB', " ".join("%12s" % e[0] for e in engines)))
+    totals = [0.0] * len(engines)
+    for filename in files:
+        data = load_xdot(filename)
+        if data is None:
+            print("%-24s failed to create xdot data" % basename(filename))
+            continue
+        reference = None
+        times = []
+        for i, (name, func) in enumerate(engines):
+            try:
+                graph = str(func(data))
+            except Exception as err:
+                times.append(None)
+                continue
+            if reference is None:
+                reference = graph
+            elif graph != reference:
+                print("%s: %s output differs" % (basename(filename), name))
+            t = timeit(func, data, args.repeat)
+            totals[i] += t
+            times.append(t)
+        print("%-24s %8.1f %s" % (basename(filename), len(data) / 1024.0,
+                                  " ".join("%10.2fms" % (t * 1000) if t is not None else "%12s" % '-'
+                                           for t in times)))
+    print("%-24s %8s %s" % ('total', '', " ".join("%10.2fms" % (t * 1000) for t in totals)))
+    for i, (name, func) in enumerate(engines[1:], 1):
+        if totals[0] and totals[i]:
+            print("%s speedup: %.1fx" % (name, totals[0] / totals[i]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Compare output size and LaTeX time for different coordinate precisions.
+
+Usage:
+    python bench_precision.py [-n edges] [-p points] [-f format] [--nolatex]
+
+Converts the synthetic graph from bench_splines.py with the default
+precision and with --precision 0 to 3, and reports the size of the output
+and the time used by pdflatex to compile it. pdflatex is skipped if it is
+not installed or --nolatex is given.
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+from dot2tex import dotparsing
+from dot2tex.base import run_latex
+
+from bench_splines import converters, synthetic_xdot
+
+
+def latex_time(code, format):
+    """Return the time used by pdflatex to compile code"""
+    command = 'pdflatex' if format != 'pstricks' else 'latex'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(tmpdir + '/graph.tex', 'w') as f:
+            f.write(code)
+        start = time.perf_counter()
+        run_latex([command, '-interaction=nonstopmode', 'graph.tex'], tmpdir)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare coordinate precisions')
+    parser.add_argument('-n', '--edges', type=int, default=500)
+    parser.add_argument('-p', '--points', type=int, default=100)
+    parser.add_argument('-f', '--format', default='pgf', choices=sorted(converters))
+    parser.add_argument('--nolatex', action='store_true')
+    args = parser.parse_args()
+
+    data = synthetic_xdot(args.edges, args.points)
+    command = 'pdflatex' if args.format != 'pstricks' else 'latex'
+    uselatex = not args.nolatex and shutil.which(command)
+    if not uselatex:
+        print("%s not used" % command)
+    for precision in [None, 3, 2, 1, 0]:
+        graph = dotparsing.parse_xdot_data(data)
+        start = time.perf_counter()
+        code = converters[args.format](dict(precision=precision)).convert(graph)
+        elapsed = time.perf_counter() - start
+        line = ("precision %-7s %9d bytes, conversion %6.0f ms"
+                % (precision, len(code.encode('utf-8')), elapsed * 1000))
+        if uselatex:
+            line += ", %s %6.0f ms" % (command, latex_time(code, args.format) * 1000)
+        print(line)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
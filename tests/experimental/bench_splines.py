@@ -0,0 +1,76 @@
+"""
+Benchmark conversion of graphs with long splines.
+
+Usage:
+    python bench_splines.py [-n edges] [-p points] [-f format] [-r repeat]
+
+Converts a synthetic xdot graph where every edge is a B-spline with many
+control points and reports the best time used by the conversion, not
+counting the parsing of the graph, together with a checksum of the output.
+Run it on different versions of dot2tex, or with and without NumPy
+installed, to compare them.
+"""
+
+import argparse
+import hashlib
+import sys
+import time
+
+from dot2tex import dotparsing
+from dot2tex.pgfformat import Dot2PGFConv, Dot2TikZConv
+from dot2tex.pstricksformat import Dot2PSTricksConv
+
+converters = {'pgf': Dot2PGFConv, 'tikz': Dot2TikZConv, 'pstricks': Dot2PSTricksConv}
+
+
+def spline_points(i, points):
+    """Return points control points for edge i"""
+    return ["%.2f,%.3f" % (j * 1.5 + i, (j % 7) * 3.25 + i * 0.125) for j in range(points)]
+
+
+def synthetic_xdot(edges, points):
+    """Return xdot data for a graph with edges edges of points control points"""
+    lines = ['digraph G {',
+             '\tgraph [bb="0,0,%d,%d"];' % (points * 2 + edges, edges + 30),
+             '\tnode [label="\\N"];']
+    for i in range(edges + 1):
+        lines.append('\tn%d [height=0.5, pos="%d,%d", width=0.75, '
+                     '_draw_="c 7 -#000000 e %d %d 27 18 "];' % (i, i, i, i, i))
+    for i in range(edges):
+        coords = spline_points(i, points)
+        lines.append('\tn%d -> n%d [pos="e,%s %s", _draw_="c 7 -#000000 B %d %s ", '
+                     '_hdraw_="S 5 -solid c 7 -#000000 C 7 -#000000 P 3 %s "];'
+                     % (i, i + 1, coords[-1], " ".join(coords), points,
+                        " ".join(c.replace(',', ' ') for c in coords),
+                        " ".join(c.replace(',', ' ') for c in coords[-3:])))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conversion of long splines')
+    parser.add_argument('-n', '--edges', type=int, default=500)
+    parser.add_argument('-p', '--points', type=int, default=400)
+    parser.add_argument('-f', '--format', default='pgf', choices=sorted(converters))
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--duplicate', action='store_true')
+    args = parser.parse_args()
+
+    data = synthetic_xdot(args.edges, args.points)
+    options = dict(duplicate=args.duplicate, figonly=True)
+    best = None
+    for i in range(args.repeat):
+        graph = dotparsing.parse_xdot_data(data)
+        start = time.perf_counter()
+        output = converters[args.format](dict(options)).convert(graph)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("%d edges, %d points per edge, format %s%s"
+          % (args.edges, args.points, args.format, ', duplicate' if args.duplicate else ''))
+    print("conversion: %.0f ms" % (best * 1000))
+    print("output: %d chars, md5 %s" % (len(output), hashlib.md5(output.encode('utf-8')).hexdigest()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
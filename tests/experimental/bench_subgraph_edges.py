@@ -0,0 +1,86 @@
+"""
+Benchmark edge statements with subgraphs as endpoints.
+
+Usage:
+    python bench_subgraph_edges.py [-n repeat] [-w width]
+
+Builds graphs where wide subgraphs fan into single nodes, single nodes fan
+out into subgraphs and subgraphs are connected to nested subgraphs. The data is tokenized
+once with the recursive parser and the time used for building the graph from
+the statements is reported. The pyparsing grammar is left out since its
+parsing time dominates on these graphs. Does not require Graphviz. Run it on
+different versions of dot2tex to compare them.
+"""
+
+import argparse
+import sys
+import time
+
+from dot2tex import dotparsing
+
+
+def fan_in_out(width):
+    """Return a graph where every node in a subgraph connects to a hub"""
+    nodes = " ".join("n%d" % i for i in range(width))
+    lines = ['digraph G {']
+    for i in range(width // 10):
+        lines.append('\t{%s} -> hub%d -> {%s} [color=red];' % (nodes, i, nodes))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def cross(width):
+    """Return a graph with a chain of subgraph to subgraph edges"""
+    groups = ["{%s}" % " ".join("g%d_%d" % (j, i) for i in range(width // 10))
+              for j in range(10)]
+    return "digraph G {\n\t%s [style=dashed];\n}" % " -> ".join(groups)
+
+
+def nested(width):
+    """Return a graph with deeply nested subgraphs as edge endpoints"""
+    depth = width // 10
+    body = " ".join("d%d" % i for i in range(10))
+    for i in range(depth):
+        body = "subgraph s%d { x%d %s }" % (i, i, body)
+    lines = ['digraph G {', '\t%s' % body]
+    for i in range(depth):
+        lines.append('\tsrc%d -> {%s};' % (i, body.replace('subgraph s', 'subgraph t%d_' % i)))
+    lines.append('}')
+    return "\n".join(lines)
+
+
+def parse_statements(data):
+    parser = dotparsing.RecursiveDotParser()
+    parser.data = data
+    parser.tokens = dotparsing.tokenize_dot(data)
+    parser.pos = 0
+    return parser, parser._parse_graph()
+
+
+def timeit(func, data, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func(data)
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark subgraph edge statements')
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-w', '--width', type=int, default=200)
+    args = parser.parse_args()
+
+    print("%-12s %8s %12s" % ('graph', 'edges', 'build'))
+    for name, make in [('fan', fan_in_out), ('cross', cross), ('nested', nested)]:
+        parser, stmts = parse_statements(make(args.width))
+        t = timeit(parser.build_top_graph, stmts, args.repeat)
+        edges = len(list(parser.graph.alledges))
+        print("%-12s %8d %10.2fms" % (name, edges, t * 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 from pyparsing import ParseException
 
 import dot2tex
 import re
-from dot2tex.utils import smart_float, is_multiline_label
+from dot2tex.utils import smart_float, fixed_float, format_points, is_multiline_label
 
 testgraph = """
 digraph G {
@@ -15,6 +25,56 @@ digraph G {
 """
 
 
+json_testgraph_xdot = r"""
+digraph G {
+    graph [bb="0,0,62,108", xdotversion=1.7];
+    node [label="\N"];
+    a [height=0.5, pos="27,90", width=0.75,
+       _draw_="c 7 -#000000 e 27 90 27 18 ",
+       _ldraw_="F 14 11 -Times-Roman c 7 -#000000 T 27 86.3 0 7 1 -a "];
+    b [height=0.5, pos="27,18", width=0.75,
+       _draw_="c 7 -#000000 e 27 18 27 18 ",
+       _ldraw_="F 14 11 -Times-Roman c 7 -#000000 T 27 14.3 0 7 1 -b "];
+    a -> b [label=x, lp="30.5,54", pos="e,27,36.104 27,71.697 27,63.983 27,54.712 27,46.112",
+       _draw_="c 7 -#000000 B 4 27 71.7 27 63.98 27 54.71 27 46.11 ",
+       _hdraw_="S 5 -solid c 7 -#000000 C 7 -#000000 P 3 30.5 46.1 27 36.1 23.5 46.1 ",
+       _ldraw_="F 14 11 -Times-Roman c 7 -#000000 T 30.5 50.3 0 7 1 -x "];
+}
+"""
+
+json_testgraph = {
+    "name": "G", "directed": True, "strict": False, "bb": "0,0,62,108", "xdotversion": "1.7",
+    "_subgraph_cnt": 0,
+    "objects": [
+        {"_gvid": 0, "name": "a", "height": "0.5", "label": "\\N", "pos": "27,90", "width": "0.75",
+         "_draw_": [{"op": "c", "grad": "none", "color": "#000000"},
+                    {"op": "e", "rect": [27, 90, 27, 18]}],
+         "_ldraw_": [{"op": "F", "size": 14, "face": "Times-Roman"},
+                     {"op": "c", "grad": "none", "color": "#000000"},
+                     {"op": "T", "pt": [27, 86.3], "align": "c", "width": 7, "text": "a"}]},
+        {"_gvid": 1, "name": "b", "height": "0.5", "label": "\\N", "pos": "27,18", "width": "0.75",
+         "_draw_": [{"op": "c", "grad": "none", "color": "#000000"},
+                    {"op": "e", "rect": [27, 18, 27, 18]}],
+         "_ldraw_": [{"op": "F", "size": 14, "face": "Times-Roman"},
+                     {"op": "c", "grad": "none", "color": "#000000"},
+                     {"op": "T", "pt": [27, 14.3], "align": "c", "width": 7, "text": "b"}]},
+    ],
+    "edges": [
+        {"_gvid": 0, "tail": 0, "head": 1, "label": "x", "lp": "30.5,54",
+         "pos": "e,27,36.104 27,71.697 27,63.983 27,54.712 27,46.112",
+         "_draw_": [{"op": "c", "grad": "none", "color": "#000000"},
+                    {"op": "B", "points": [[27, 71.7], [27, 63.98], [27, 54.71], [27, 46.11]]}],
+         "_hdraw_": [{"op": "S", "style": "solid"},
+                     {"op": "c", "grad": "none", "color": "#000000"},
+                     {"op": "C", "grad": "none", "color": "#000000"},
+                     {"op": "P", "points": [[30.5, 46.1], [27, 36.1], [23.5, 46.1]]}],
+         "_ldraw_": [{"op": "F", "size": 14, "face": "Times-Roman"},
+                     {"op": "c", "grad": "none", "color": "#000000"},
+                     {"op": "T", "pt": [30.5, 50.3], "align": "c", "width": 7, "text": "x"}]},
+    ]
+}
+
+
 class mobj(object):
     def __init__(self, d):
         self.__dict__ = d
@@ -233,6 +293,480 @@ class GraphvizInterfaceTests(unittest.TestCase):
         # xdot_data = create_xdot(testgraph, prog="dummy")
         self.assertRaises(NameError, create_xdot, testgraph, prog="dummy")
 
+    @unittest.skipIf(sys.platform == 'win32', 'Needs an executable script')
+    def test_pipe(self):
+        """Graphs are piped to the program, which is run without a shell"""
+        from dot2tex import base, dotparsing
+        tmpdir = tempfile.mkdtemp()
+        fake_dot = os.path.join(tmpdir, 'fake dot')
+        with open(fake_dot, 'w') as f:
+            # echoes stdin with the arguments and fills up the stderr pipe
+            f.write("#!%s\nimport sys\n"
+                    "data = sys.stdin.read()\n"
+                    "sys.stderr.write('Warning: x\\n' * 20000)\n"
+                    "sys.stdout.write(' '.join(sys.argv[1:]) + '\\n' + data)\n" % sys.executable)
+        os.chmod(fake_dot, 0o755)
+        graph = dotparsing.DotDataParser().parse_dot_data(testgraph)
+        try:
+            tools = dotparsing.GraphvizTools({'dot': fake_dot})
+            with mock.patch('dot2tex.dotparsing.get_graphviz', return_value=tools):
+                data = base.create_xdot(graph, options='-y "-Gx=a b"')
+                self.assertEqual(data.decode('utf8'), '-Txdot -y -Gx=a b\n' + str(graph))
+                data = base.run_graphviz([fake_dot], [testgraph, graph])[0]
+                self.assertEqual(data.decode('utf8'), '\n' + testgraph + '\n' + str(graph))
+                data = base.create_xdot(testgraph, output_format='json')
+                self.assertEqual(data.decode('utf8'), '-Tjson\n' + testgraph)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(base.layout_stats.last['bytes_in'], len(testgraph.encode('utf8')))
+        self.assertEqual(base.layout_stats.last['bytes_out'], len(data))
+
+
+class LayoutCacheTest(unittest.TestCase):
+    def setUp(self):
+        from dot2tex import dotparsing
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        tools = dotparsing.GraphvizTools({'dot': 'dot', 'neato': 'neato'}, version=(2, 43, 0))
+        patcher = mock.patch('dot2tex.dotparsing.get_graphviz', return_value=tools)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create_xdot(self):
+        from dot2tex import base, dotparsing
+        cache = base.LayoutCache(self.tmpdir)
+        with mock.patch('dot2tex.base.run_graphviz', return_value=(b'layout', b'')) as run:
+            self.assertEqual(base.create_xdot(testgraph, cache=cache), b'layout')
+            self.assertEqual(base.create_xdot(testgraph, cache=cache), b'layout')
+            graph = dotparsing.DotDataParser().parse_dot_data(testgraph)
+            base.create_xdot(graph, cache=cache)
+            base.create_xdot(graph, cache=cache)
+            base.create_xdot(testgraph, prog='neato', cache=cache)
+        self.assertEqual(run.call_count, 3)
+        self.assertEqual(cache.stats(), dict(hits=2, misses=3, evictions=0))
+
+    def test_errors_not_cached(self):
+        from dot2tex import base
+        cache = base.LayoutCache(self.tmpdir)
+        with mock.patch('dot2tex.base.run_graphviz', return_value=(b'', b'Error: syntax')):
+            base.create_xdot(testgraph, cache=cache)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_eviction(self):
+        from dot2tex import base
+        cache = base.LayoutCache(self.tmpdir, max_size=35)
+        for i in range(3):
+            cache.put('key%d' % i, b'x' * 10)
+            path = os.path.join(self.tmpdir, 'key%d.layout' % i)
+            os.utime(path, (i, i))
+        self.assertEqual(cache.get('key0'), b'x' * 10)
+        cache.put('key3', b'x' * 10)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['key0.layout', 'key2.layout', 'key3.layout'])
+        self.assertEqual(cache.stats(), dict(hits=1, misses=0, evictions=1))
+
+    def test_option(self):
+        with mock.patch('dot2tex.base.create_xdot', return_value=json_testgraph_xdot) as create_xdot:
+            dot2tex.dot2tex(testgraph, layoutcache=self.tmpdir, layoutcachesize=1)
+        cache = create_xdot.call_args[1]['cache']
+        self.assertEqual(cache.directory, os.path.abspath(self.tmpdir))
+        self.assertEqual(cache.max_size, 1024 * 1024)
+
+
+class BatchLayoutTest(unittest.TestCase):
+    def setUp(self):
+        from dot2tex import dotparsing
+        tools = dotparsing.GraphvizTools({'dot': 'dot'}, version=(2, 43, 0))
+        patcher = mock.patch('dot2tex.dotparsing.get_graphviz', return_value=tools)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.output = (json_testgraph_xdot + json_testgraph_xdot.replace('digraph G', 'digraph H')).encode('utf8')
+
+    def test_split_layouts(self):
+        from dot2tex import base
+        layouts = base.split_layouts(self.output)
+        self.assertEqual(len(layouts), 2)
+        self.assertIn(b'digraph H', layouts[1])
+        self.assertEqual(base.split_layouts(b'{"name": "G"}\n{"name": "H"}\n', 'json'),
+                         [b'{"name": "G"}', b'{"name": "H"}'])
+
+    def test_create_xdot_batch(self):
+        from dot2tex import base
+        with mock.patch('dot2tex.base.run_graphviz', return_value=(self.output, b'')) as run:
+            layouts = base.create_xdot_batch([testgraph, testgraph.replace('digraph G', 'digraph H')])
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(run.call_args[0][0], ['dot', '-Txdot'])
+        self.assertEqual(layouts, base.split_layouts(self.output))
+
+    def test_fallback(self):
+        """Graphs are laid out one at a time when the output can not be split"""
+        from dot2tex import base
+        with mock.patch('dot2tex.base.run_graphviz', return_value=(self.output, b'')), \
+                mock.patch('dot2tex.base.create_xdot', return_value=b'layout') as create_xdot:
+            layouts = base.create_xdot_batch([testgraph] * 3)
+        self.assertEqual(create_xdot.call_count, 3)
+        self.assertEqual(layouts, [b'layout'] * 3)
+
+    def test_fallback_errors_not_cached(self):
+        from dot2tex import base
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = base.LayoutCache(tmpdir)
+        graphs = [testgraph, testgraph.replace('digraph G', 'digraph H')]
+        results = [(b'', b'Error: syntax'), (b'partial', b'Error: syntax'), (b'layout', b'')]
+        with mock.patch('dot2tex.base.run_graphviz', side_effect=results):
+            layouts = base.create_xdot_batch(graphs, cache=cache)
+        self.assertEqual(layouts, [b'partial', b'layout'])
+        self.assertEqual(len(os.listdir(tmpdir)), 1)
+        self.assertEqual(base.create_xdot(graphs[1], cache=cache), b'layout')
+        self.assertIsNone(cache.get(cache.make_key(graphs[0], 'dot', '', 'xdot', (2, 43, 0))))
+
+    def test_convert_graphs(self):
+        data = testgraph + "\n" + testgraph.replace('digraph G', 'digraph H')
+        with mock.patch('dot2tex.base.run_graphviz', return_value=(self.output, b'')) as run:
+            codes = list(dot2tex.dot2tex_graphs(io.StringIO(data), format='tikz', figonly=True))
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(codes[0], dot2tex.dot2tex(json_testgraph_xdot, format='tikz', figonly=True))
+        self.assertEqual(len(codes), 2)
+
+
+class GraphvizLibraryTest(unittest.TestCase):
+    def make_library(self, render_result=0):
+        import ctypes
+        from dot2tex import base
+        gvc = mock.Mock()
+        cgraph = mock.Mock()
+        gvc.gvcVersion.return_value = b'2.43.0'
+        gvc.gvLayout.return_value = 0
+        buf = ctypes.create_string_buffer(b'layout data')
+
+        def render(context, graph, fmt, result, length):
+            result._obj.value = ctypes.addressof(buf)
+            length._obj.value = 6
+            return render_result
+
+        gvc.gvRenderData.side_effect = render
+        return base.GraphvizLibrary(gvc, cgraph)
+
+    def test_layout(self):
+        library = self.make_library()
+        self.assertEqual(library.version, (2, 43, 0))
+        self.assertEqual(library.layout(testgraph, 'neato', 'json'), b'layout')
+        gvc = library.gvc
+        self.assertEqual(gvc.gvLayout.call_args[0][2], b'neato')
+        self.assertEqual(gvc.gvRenderData.call_args[0][2], b'json')
+        library.cgraph.agmemread.assert_called_once_with(testgraph.encode('utf8'))
+        self.assertEqual(gvc.gvFreeRenderData.call_count, 1)
+        self.assertEqual(gvc.gvFreeLayout.call_count, 1)
+        self.assertEqual(library.cgraph.agclose.call_count, 1)
+
+    def test_failure(self):
+        library = self.make_library(render_result=-1)
+        self.assertIsNone(library.layout(testgraph))
+        self.assertEqual(library.cgraph.agclose.call_count, 1)
+        library.cgraph.agmemread.return_value = None
+        self.assertIsNone(library.layout('digraph {'))
+
+    def test_create_xdot_fallback(self):
+        """The Graphviz programs are used when the library can not be used"""
+        from dot2tex import base, dotparsing
+        tools = dotparsing.GraphvizTools({'dot': 'dot'}, version=(2, 43, 0))
+        library = mock.Mock()
+        library.layout.return_value = b'library'
+        with mock.patch('dot2tex.dotparsing.get_graphviz', return_value=tools), \
+                mock.patch('dot2tex.base.run_graphviz', return_value=(b'process', b'')):
+            with mock.patch('dot2tex.base.get_graphviz_library', return_value=library):
+                self.assertEqual(base.create_xdot(testgraph, backend='library'), b'library')
+                self.assertEqual(base.create_xdot(testgraph, options='-y', backend='library'), b'process')
+                self.assertEqual(base.create_xdot(testgraph), b'process')
+                library.layout.return_value = None
+                self.assertEqual(base.create_xdot(testgraph, backend='library'), b'process')
+            with mock.patch('dot2tex.base.get_graphviz_library', return_value=None):
+                self.assertEqual(base.create_xdot(testgraph, backend='library'), b'process')
+
+    def test_option(self):
+        with mock.patch('dot2tex.base.create_xdot', return_value=json_testgraph_xdot) as create_xdot:
+            dot2tex.dot2tex(testgraph, layoutbackend='library')
+        self.assertEqual(create_xdot.call_args[1]['backend'], 'library')
+
+    def test_installed_library(self):
+        from dot2tex import base
+        library = base.get_graphviz_library()
+        if library is None:
+            self.skipTest('Needs the Graphviz library')
+        self.assertIn(b'_draw_', library.layout(testgraph))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'Needs an executable script')
+class AsyncConvertTest(unittest.TestCase):
+    def setUp(self):
+        from dot2tex import dotparsing
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'layout.xdot'), 'w') as f:
+            f.write(json_testgraph_xdot)
+        fake_dot = os.path.join(self.tmpdir, 'dot')
+        with open(fake_dot, 'w') as f:
+            # writes its pid, sleeps if told to and prints the layout
+            f.write("#!%s\nimport os, sys, time\n"
+                    "sys.stdin.read()\n"
+                    "d = os.path.dirname(sys.argv[0])\n"
+                    "open(os.path.join(d, 'pid'), 'w').write(str(os.getpid()))\n"
+                    "if os.path.exists(os.path.join(d, 'slow')): time.sleep(30)\n"
+                    "sys.stdout.write(open(os.path.join(d, 'layout.xdot')).read())\n" % sys.executable)
+        os.chmod(fake_dot, 0o755)
+        tools = dotparsing.GraphvizTools({'dot': fake_dot}, version=(2, 43, 0))
+        patcher = mock.patch('dot2tex.dotparsing.get_graphviz', return_value=tools)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_convert(self):
+        async def convert_all():
+            return await asyncio.gather(*[dot2tex.dot2tex_async(testgraph, format='tikz', figonly=True)
+                                          for i in range(4)])
+
+        codes = self.loop.run_until_complete(convert_all())
+        self.assertEqual(codes, [dot2tex.dot2tex(json_testgraph_xdot, format='tikz', figonly=True)] * 4)
+
+    def test_timeout(self):
+        open(os.path.join(self.tmpdir, 'slow'), 'w').close()
+        start = time.time()
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(dot2tex.dot2tex_async(testgraph, timeout=1))
+        self.loop.run_until_complete(asyncio.sleep(0.5))
+        self.assertLess(time.time() - start, 10)
+        with open(os.path.join(self.tmpdir, 'pid')) as f:
+            pid = int(f.read())
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+
+class BatchModeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.inputfiles = []
+        for name in ('a.xdot', 'b.xdot', 'c.xdot'):
+            self.inputfiles.append(os.path.join(self.tmpdir, name))
+            with open(self.inputfiles[-1], 'w') as f:
+                f.write(json_testgraph_xdot)
+        self.outputdir = os.path.join(self.tmpdir, 'out')
+
+    def run_batch(self, *args):
+        from dot2tex.dot2tex import create_options_parser, run_batch
+        options = create_options_parser().parse_args(list(args) + ['--outputdir', self.outputdir])
+        return run_batch(options)
+
+    def test_batch(self):
+        self.assertEqual(self.run_batch('-j', '2', '-f', 'tikz', '--batch', *self.inputfiles), 0)
+        self.assertEqual(sorted(os.listdir(self.outputdir)), ['a.tex', 'b.tex', 'c.tex'])
+        with open(os.path.join(self.outputdir, 'b.tex')) as f:
+            self.assertEqual(f.read(), dot2tex.dot2tex(json_testgraph_xdot, format='tikz'))
+
+    def test_manifest(self):
+        manifest = os.path.join(self.tmpdir, 'figures.txt')
+        with open(manifest, 'w') as f:
+            f.write('# figures\na.xdot\n\nc.xdot\n')
+        self.assertEqual(self.run_batch('-j', '1', '--manifest', manifest), 0)
+        self.assertEqual(sorted(os.listdir(self.outputdir)), ['a.tex', 'c.tex'])
+
+    def test_failures(self):
+        badfile = os.path.join(self.tmpdir, 'bad.dot')
+        with open(badfile, 'w') as f:
+            f.write('digraph G { a -> ')
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            self.assertEqual(self.run_batch('-j', '1', '--batch', badfile, *self.inputfiles), 1)
+        self.assertIn('1 of 4 files failed', stderr.getvalue())
+        self.assertIn(badfile, stderr.getvalue())
+        self.assertEqual(len(os.listdir(self.outputdir)), 3)
+
+    def test_skip_newer(self):
+        self.assertEqual(self.run_batch('-j', '1', '--batch', *self.inputfiles), 0)
+        outputfile = os.path.join(self.outputdir, 'a.tex')
+        with open(outputfile, 'w') as f:
+            f.write('unchanged')
+        os.utime(self.inputfiles[0], (0, 0))
+        self.assertEqual(self.run_batch('-j', '1', '--batch', *self.inputfiles), 0)
+        with open(outputfile) as f:
+            self.assertEqual(f.read(), 'unchanged')
+        self.assertEqual(self.run_batch('-j', '1', '--force', '--batch', *self.inputfiles), 0)
+        with open(outputfile) as f:
+            self.assertNotEqual(f.read(), 'unchanged')
+
+
+class ServerTest(unittest.TestCase):
+    def start_server(self, address):
+        from dot2tex import server
+        srv = server.create_server(address)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(srv.server_close)
+        self.addCleanup(srv.shutdown)
+        if isinstance(srv.server_address, tuple):
+            return ':%d' % srv.server_address[1]
+        return srv.server_address
+
+    def check_server(self, address):
+        from dot2tex import server
+        result = server.request(address, 'POST', '/convert',
+                                dict(args=['-f', 'tikz', '--figonly'], dotdata=json_testgraph_xdot))
+        self.assertEqual(result['output'], dot2tex.dot2tex(json_testgraph_xdot, format='tikz', figonly=True))
+        result = server.request(address, 'POST', '/convert', dict(args=[], dotdata='digraph G { a -> '))
+        self.assertIn('Parse error', result['error'])
+        result = server.request(address, 'POST', '/convert', dict(args=['--nosuchoption'], dotdata=''))
+        self.assertIn('Invalid arguments', result['error'])
+        stats = server.request(address, 'GET', '/stats')
+        self.assertEqual((stats['requests'], stats['errors']), (3, 2))
+
+    def test_tcp(self):
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.check_server(self.start_server('127.0.0.1:0'))
+
+    @unittest.skipIf(sys.platform == 'win32', 'Needs Unix sockets')
+    def test_unix_socket(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.check_server(self.start_server(os.path.join(tmpdir, 'dot2tex.sock')))
+
+    def test_client(self):
+        from dot2tex import server
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        inputfile = os.path.join(tmpdir, 'graph.xdot')
+        outputfile = os.path.join(tmpdir, 'graph.tex')
+        with open(inputfile, 'w') as f:
+            f.write(json_testgraph_xdot)
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            address = self.start_server('127.0.0.1:0')
+            argv = ['--server', address, '-f', 'tikz', inputfile, '-o', outputfile]
+            self.assertEqual(server.strip_server_args(argv), argv[2:])
+            self.assertEqual(server.run_client(address, argv), 0)
+        with open(outputfile) as f:
+            self.assertEqual(f.read(), dot2tex.dot2tex(json_testgraph_xdot, format='tikz'))
+
+    def test_client_files(self):
+        from dot2tex import server
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        includedfile = os.path.join(tmpdir, 'included.xdot')
+        with open(includedfile, 'w') as f:
+            f.write(json_testgraph_xdot)
+        inputfile = os.path.join(tmpdir, 'graph.dot')
+        with open(inputfile, 'w') as f:
+            f.write('\\input{%s}\n' % includedfile)
+        templatefile = os.path.join(tmpdir, 'template.tex')
+        with open(templatefile, 'w') as f:
+            f.write('% my template\n<<figcode>>\n')
+        outputfile = os.path.join(tmpdir, 'graph.tex')
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            address = self.start_server('127.0.0.1:0')
+            argv = ['--server', address, '-f', 'tikz', '--template', templatefile, '--debug',
+                    inputfile, '-o', outputfile]
+            self.assertEqual(server.run_client(address, argv), 0)
+        with open(outputfile) as f:
+            code = f.read()
+        self.assertTrue(code.startswith('% my template'))
+        self.assertIn('\\node (a)', code)
+
+    def test_unsupported_options(self):
+        from dot2tex import server
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            address = self.start_server('127.0.0.1:0')
+            for args in [['--progoptions=-o/tmp/graph.out'], ['--layoutcache', 'cache'],
+                         ['--template', 'template.tex'], ['--debug']]:
+                result = server.request(address, 'POST', '/convert',
+                                        dict(args=args, dotdata=json_testgraph_xdot))
+                self.assertEqual(result['error'], 'Not supported by the server: %s' % args[0].split('=')[0])
+            dotdata = json_testgraph_xdot.replace(
+                'digraph G {', 'digraph G {\n d2toptions = "--progoptions=-o/tmp/graph.out";', 1)
+            result = server.request(address, 'POST', '/convert', dict(args=[], dotdata=dotdata))
+            self.assertIn('--progoptions', result['error'])
+            tmpdir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmpdir)
+            outputfile = os.path.join(tmpdir, 'graph.tex')
+            for option in ['-o %s' % outputfile, '--batch %s' % outputfile, '--cache']:
+                dotdata = json_testgraph_xdot.replace(
+                    'digraph G {', 'digraph G {\n d2toptions = "%s";' % option, 1)
+                result = server.request(address, 'POST', '/convert', dict(args=[], dotdata=dotdata))
+                self.assertIn('Not supported by the server', result['error'])
+            self.assertFalse(os.path.exists(outputfile))
+            result = server.request(address, 'POST', '/convert',
+                                    dict(args=[], dotdata='\\input{graph.dot}\n'))
+            self.assertIn('\\input', result['error'])
+            self.assertEqual(server.run_client(address, ['--server', address, '--layoutcache',
+                                                         'cache', 'graph.dot']), 1)
+
+    def test_loopback(self):
+        from dot2tex import server
+        self.assertTrue(server.is_loopback('localhost'))
+        self.assertTrue(server.is_loopback('127.0.0.1'))
+        self.assertFalse(server.is_loopback('0.0.0.0'))
+        self.assertFalse(server.is_loopback('example.com'))
+        self.assertRaises(ValueError, server.create_server, '0.0.0.0:0')
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertEqual(server.serve('0.0.0.0:0'), 1)
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        from dot2tex.dot2tex import create_options_parser
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.included = os.path.join(self.tmpdir, 'included.xdot')
+        self.write('included.xdot', json_testgraph_xdot, 1000)
+        self.write('a.dot', json_testgraph_xdot, 1000)
+        self.write('b.gv', '\\input{%s}\n' % self.included, 1000)
+        self.write('notes.txt', '', 1000)
+        self.options = create_options_parser().parse_args(['-f', 'tikz', '--watch', self.tmpdir])
+        patcher = mock.patch('sys.stdout', new_callable=io.StringIO)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, data, mtime):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(data)
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def converted(self, watcher, now):
+        return sorted(os.path.basename(f) for f in watcher.poll(now))
+
+    def test_watch(self):
+        from dot2tex.dot2tex import DotFileWatcher
+        watcher = DotFileWatcher(self.tmpdir, self.options, debounce=0.3)
+        self.assertEqual(self.converted(watcher, 100), [])
+        self.assertEqual(self.converted(watcher, 100.5), ['a.dot', 'b.gv'])
+        with open(os.path.join(self.tmpdir, 'a.tex')) as f:
+            self.assertEqual(f.read(), dot2tex.dot2tex(json_testgraph_xdot, format='tikz'))
+        self.assertEqual(self.converted(watcher, 101), [])
+
+        # rapid saves are converted once
+        self.write('a.dot', json_testgraph_xdot, 2000)
+        self.assertEqual(self.converted(watcher, 102), [])
+        self.write('a.dot', json_testgraph_xdot, 2001)
+        self.assertEqual(self.converted(watcher, 102.2), [])
+        self.assertEqual(self.converted(watcher, 102.4), [])
+        self.assertEqual(self.converted(watcher, 102.6), ['a.dot'])
+
+        # changes to \input files are followed
+        self.write('included.xdot', json_testgraph_xdot, 3000)
+        self.assertEqual(self.converted(watcher, 103), [])
+        self.assertEqual(self.converted(watcher, 103.5), ['b.gv'])
+
+    def test_up_to_date(self):
+        from dot2tex.dot2tex import DotFileWatcher
+        self.write('a.tex', '', 5000)
+        self.write('b.tex', '', 5000)
+        watcher = DotFileWatcher(self.tmpdir, self.options)
+        self.assertEqual(self.converted(watcher, 100), [])
+        self.assertEqual(self.converted(watcher, 101), [])
+        self.write('included.xdot', json_testgraph_xdot, 6000)
+        watcher.poll(102)
+        self.assertEqual(self.converted(watcher, 103), ['b.gv'])
+
 
 class AutosizeTests(unittest.TestCase):
     def test__dim_extraction(self):
@@ -393,6 +927,81 @@ class TestBugs(unittest.TestCase):
         #'digraph { a->b [pos="e,1973.5,1067.3 1048.5,\\\r\n\\\n1243.5 1613.9,1127.1 1973.3,\\\r\n1072.6"];}' # too short, doesn't work for some reason
         code = dot2tex.dot2tex(graph)
 
+class JSONLayoutTest(unittest.TestCase):
+    def convert_json(self, **kwargs):
+        with mock.patch('dot2tex.base.create_xdot', return_value=json.dumps(json_testgraph)) as create_xdot:
+            code = dot2tex.dot2tex("digraph G {a -> b [label=x];}", layoutformat='json', **kwargs)
+        self.assertEqual(create_xdot.call_args[1]['output_format'], 'json')
+        return code
+
+    def test_same_as_xdot(self):
+        for output_format in ['pgf', 'pstricks', 'tikz']:
+            code = self.convert_json(format=output_format)
+            self.assertEqual(code, dot2tex.dot2tex(json_testgraph_xdot, format=output_format))
+
+    def test_duplicate(self):
+        code = self.convert_json(format='pgf', duplicate=True)
+        self.assertEqual(code, dot2tex.dot2tex(json_testgraph_xdot, format='pgf', duplicate=True))
+
+class ColumnarTest(unittest.TestCase):
+    def test_same_as_default(self):
+        for output_format in ['pgf', 'pstricks', 'tikz']:
+            code = dot2tex.dot2tex(json_testgraph_xdot, format=output_format, columnar=True)
+            self.assertEqual(code, dot2tex.dot2tex(json_testgraph_xdot, format=output_format))
+
+    def test_layout(self):
+        with mock.patch('dot2tex.base.create_xdot', return_value=json_testgraph_xdot):
+            code = dot2tex.dot2tex("digraph G {a -> b [label=x];}", format='tikz', columnar=True)
+        self.assertEqual(code, dot2tex.dot2tex(json_testgraph_xdot, format='tikz'))
+
+
+class ConvertGraphsTest(unittest.TestCase):
+    def test_multiple_graphs(self):
+        data = json_testgraph_xdot + "\n" + json_testgraph_xdot.replace("digraph G", "digraph H")
+        codes = list(dot2tex.dot2tex_graphs(io.StringIO(data), format='tikz', figonly=True))
+        self.assertEqual(len(codes), 2)
+        self.assertEqual(codes[0], dot2tex.dot2tex(json_testgraph_xdot, format='tikz', figonly=True))
+
+
+class DrawstringTest(unittest.TestCase):
+    def test_operations(self):
+        cmdlist, stat = dot2tex.base.parse_drawstring(
+            "c 7 -#ff0000 B 4 1 2 3 4 5 6 7 8 F 14 11 -Times-Roman T 10 20 0 35 5 -a b c e 1 2 3 4 ")
+        self.assertEqual(cmdlist, [('c', '#ff0000'),
+                                   ('B', ((1.0, 2.0), (3.0, 4.0), (5.0, 6.0), (7.0, 8.0))),
+                                   ('F', 14.0, 'Times-Roman'),
+                                   ('T', 10.0, 20.0, 0, 35.0, 'a b c', ''),
+                                   ('e', 1.0, 2.0, 3.0, 4.0)])
+        self.assertEqual(stat['B'], 1)
+
+    def test_many_operations(self):
+        cmdlist, stat = dot2tex.base.parse_drawstring("p 2 0 0 1 1 " * 5000)
+        self.assertEqual(len(cmdlist), 5000)
+        self.assertEqual(cmdlist[-1], ('p', ((0.0, 0.0), (1.0, 1.0))))
+
+    def test_negative_count(self):
+        cmdlist, stat = dot2tex.base.parse_drawstring("B -1 x c 1 -a")
+        self.assertEqual(cmdlist, [('c', 'a')])
+
+    def test_parsed_once(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(json_testgraph_xdot)
+        edge = list(graph.alledges)[0]
+        with mock.patch('dot2tex.base.parse_drawstring', wraps=dot2tex.base.parse_drawstring) as parse:
+            ops = dot2tex.base.get_drawattr_ops(edge, '_ldraw_')
+            self.assertIs(dot2tex.base.get_drawattr_ops(edge, '_ldraw_'), ops)
+            self.assertEqual(parse.call_count, 1)
+            edge.attr['_ldraw_'] = "F 14 11 -Times-Roman c 7 -#000000 T 10 20 0 7 1 -y "
+            self.assertEqual(dot2tex.base.get_drawattr_ops(edge, '_ldraw_')[0][-1][5], 'y')
+            self.assertEqual(parse.call_count, 2)
+
+    def test_cached_ops_unchanged(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(json_testgraph_xdot)
+        codes = [dot2tex.pstricksformat.Dot2PSTricksConv({'alignstr': 't'}).convert(graph)
+                 for i in range(2)]
+        self.assertEqual(codes[0], codes[1])
+        self.assertEqual(codes[0].count('\\rput[t]'), 3)
+
+
 class TestNumberFormatting(unittest.TestCase):
     def test_numbers(self):
         self.assertEqual("2.0", smart_float(2))
@@ -404,6 +1013,167 @@ class TestNumberFormatting(unittest.TestCase):
         self.assertEqual("2.1", smart_float(2.100))
         self.assertEqual("10000000000000000.0000", smart_float(1e16))
 
+    def test_points(self):
+        points = [(2, 2.100), (1e-4, -2.11119), (1e16, 1e-5)]
+        expected = ["(%sbp,%sbp)" % (smart_float(x), smart_float(y)) for x, y in points]
+        self.assertEqual(format_points(points), expected)
+        self.assertEqual(format_points(points[:2]), expected[:2])
+        self.assertEqual(format_points(points[:2], '%s %s'), ['2.0 2.1', '0.0001 -2.11119'])
+        self.assertEqual(format_points([]), [])
+
+    def test_precision(self):
+        self.assertEqual("123.46", fixed_float(123.456789, 2))
+        self.assertEqual("27", fixed_float(27.0, 2))
+        self.assertEqual("100", fixed_float(100.004, 2))
+        self.assertEqual("0", fixed_float(-0.001, 2))
+        self.assertEqual("124", fixed_float(123.5, 0))
+        points = [(123.456789, 27.0), (100.004, -0.001), (-1.5, 1e-05)]
+        for precision in range(4):
+            expected = ["(%sbp,%sbp)" % (fixed_float(x, precision), fixed_float(y, precision))
+                        for x, y in points]
+            self.assertEqual(format_points(points, precision=precision), expected)
+
+
+class PrecisionTest(unittest.TestCase):
+    def test_precision(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(json_testgraph_xdot)
+        for conv in [dot2tex.pgfformat.Dot2PGFConv, dot2tex.pgfformat.Dot2TikZConv,
+                     dot2tex.pstricksformat.Dot2PSTricksConv]:
+            for options in [{}, {'duplicate': True}]:
+                code = conv(dict(options)).convert(graph)
+                self.assertTrue(re.search(r'\.\d\d+bp', code))
+                code1 = conv(dict(options, precision=1)).convert(graph)
+                self.assertFalse(re.search(r'\.\d\d+bp', code1))
+                self.assertTrue(re.search(r'\.\dbp', code1))
+                self.assertLess(len(code1), len(code))
+            code0 = conv({'precision': 0}).convert(graph)
+            self.assertFalse(re.search(r'\.\d+bp', code0))
+
+    def test_option(self):
+        from dot2tex.dot2tex import create_options_parser
+        parser = create_options_parser()
+        self.assertEqual(parser.parse_args(['--precision', '2']).precision, 2)
+        self.assertIsNone(parser.parse_args([]).precision)
+
+
+colors_testgraph_xdot = r"""digraph G {
+    graph [bb="0,0,126,108"];
+    node [label="\N", style=filled];
+    a [color="#ff0000", fillcolor="#00ff00", height=0.5, pos="27,90", width=0.75,
+       _draw_="c 7 -#ff0000 C 7 -#00ff00 E 27 90 27 18 "];
+    b [color="#FF0000", fillcolor="#00ff00", height=0.5, pos="99,90", width=0.75,
+       _draw_="c 7 -#FF0000 C 7 -#00ff00 E 99 90 27 18 "];
+    c [color="0.5 0.5 0.5", height=0.5, pos="27,18", width=0.75,
+       _draw_="c 11 -0.5 0.5 0.5 C 7 -#00ff00 E 27 18 27 18 "];
+    a -> c [color="#ff0000", pos="e,27,36.104 27,71.697 27,63.983 27,54.712 27,46.112",
+            _draw_="c 7 -#ff0000 B 4 27 71.7 27 63.98 27 54.71 27 46.11 ",
+            _hdraw_="S 5 -solid c 7 -#ff0000 C 7 -#ff0000 P 3 30.5 46.1 27 36.1 23.5 46.1 "];
+}
+"""
+
+
+class ColorPaletteTest(unittest.TestCase):
+    def test_palette(self):
+        conv = dot2tex.pgfformat.Dot2PGFConv({})
+        palette = dot2tex.base.ColorPalette(lambda color: conv.convert_color(color, True))
+        self.assertEqual(palette.get('#ff0000'), ('d2tcol1', '1'))
+        self.assertEqual(palette.get('black'), ('black', None))
+        self.assertEqual(palette.get('0.5 0.5 0.5'), ('d2tcol2', None))
+        # The same color in a different notation gets the same name
+        self.assertEqual(palette.get('#FF0000'), ('d2tcol1', '1'))
+        self.assertEqual(palette.definitions, [('d2tcol1', '{rgb}{1.0,0.0,0.0}'),
+                                               ('d2tcol2', '{hsb}{0.5,0.5,0.5}')])
+
+    def test_definitions(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(colors_testgraph_xdot)
+        for conv in [dot2tex.pgfformat.Dot2PGFConv, dot2tex.pgfformat.Dot2TikZConv]:
+            for options in [{}, {'duplicate': True}]:
+                code = conv(dict(options, figonly=True)).convert(graph)
+                definitions = re.findall(r'\\definecolor\{(\w+)\}', code)
+                self.assertEqual(sorted(definitions), ['d2tcol1', 'd2tcol2', 'd2tcol3'])
+                # All colors are defined before they are used
+                lines = code.splitlines()
+                defined = [i for i, line in enumerate(lines) if '\\definecolor' in line]
+                used = [i for i, line in enumerate(lines)
+                        if 'd2tcol' in line and i not in defined]
+                self.assertLess(max(defined), min(used))
+                for name in ['{strokecol}', '{fillcol}', '{newcol}', '{strokecolor}', '{fillcolor}']:
+                    self.assertNotIn(name, code)
+
+
+    def test_opacity_warning(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(
+            colors_testgraph_xdot.replace('color="#ff0000", fillcolor', 'color="#ff000080", fillcolor'))
+        with self.assertLogs('dot2tex', level='WARNING') as logs:
+            dot2tex.pgfformat.Dot2TikZConv({}).convert(graph)
+        self.assertIn("('{rgb}{1.0,0.0,0.0}', 0.5)", logs.output[0])
+
+
+class OutputStreamTest(unittest.TestCase):
+    converters = [dot2tex.pgfformat.Dot2PGFConv, dot2tex.pgfformat.Dot2TikZConv,
+                  dot2tex.pstricksformat.Dot2PSTricksConv]
+
+    def test_outfile(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(json_testgraph_xdot)
+        for conv in self.converters:
+            for options in [{}, {'figonly': True}, {'codeonly': True}, {'duplicate': True}]:
+                code = conv(dict(options)).convert(graph)
+                f = io.StringIO()
+                self.assertIsNone(conv(dict(options)).convert(graph, outfile=f))
+                self.assertEqual(f.getvalue(), code)
+
+    def test_template(self):
+        graph = dot2tex.dotparsing.parse_xdot_data(json_testgraph_xdot)
+        conv = dot2tex.pgfformat.Dot2TikZConv({'template': '<<figcode>>|<<drawcommands>>|<<textencoding>>'})
+        code = conv.convert(graph)
+        self.assertEqual(code, "%s|%s|utf8" % (conv.body.strip(), conv.body.strip()))
+        self.assertIn('\\node (a)', code)
+        self.assertGreater(len(conv.chunks), 1)
+
+    def test_filename(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outputfile = os.path.join(tmpdir, 'graph.tex')
+            conv = dot2tex.pgfformat.Dot2PGFConv({})
+            self.assertRaises(ParseException, conv.convert, 'digraph { a -> ', outfile=outputfile)
+            self.assertFalse(os.path.exists(outputfile))
+            conv = dot2tex.pgfformat.Dot2PGFConv({})
+            conv.convert(json_testgraph_xdot, outfile=outputfile)
+            with open(outputfile) as f:
+                self.assertEqual(f.read(), dot2tex.dot2tex(json_testgraph_xdot, format='pgf'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_failed_output(self):
+        def pieces():
+            yield 'new'
+            raise ValueError('failed')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outputfile = os.path.join(tmpdir, 'graph.tex')
+        with open(outputfile, 'w') as f:
+            f.write('old')
+        self.assertRaises(ValueError, dot2tex.base.write_pieces, outputfile, pieces())
+        with open(outputfile) as f:
+            self.assertEqual(f.read(), 'old')
+
+    def test_preproc_graph(self):
+        graph = dot2tex.base.parse_dot_data('digraph G { a -> b }')
+        conv = dot2tex.pgfformat.Dot2PGFConv({'autosize': True})
+        f = io.StringIO()
+        with mock.patch.object(conv, 'do_preview_preproc', return_value=graph):
+            self.assertIsNone(conv.convert('digraph G { a -> b }', outfile=f))
+        self.assertEqual(f.getvalue(), dot2tex.base.preproc_graphcode(graph))
+        self.assertIn('a -> b', f.getvalue())
+
+    def test_body(self):
+        conv = dot2tex.pgfformat.Dot2PGFConv({'template': '<<drawcommands>>'})
+        conv.write(' a\n')
+        conv.body += 'b \n'
+        self.assertEqual(conv.body, ' a\nb \n')
+        self.assertEqual(''.join(conv.iter_body()), 'a\nb')
+
 
 class PGF210CompatibilityTest(unittest.TestCase):
     def test_pgf210option(self):
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
 import dot2tex.dotparsing as dotp
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class DotNodeTest(unittest.TestCase):
     def test_create(self):
@@ -102,6 +112,61 @@ class DotSubgraphsTest(unittest.TestCase):
         self.assertEqual(len(s), 2)
         self.assertEqual(len(g), 4)
 
+    def test_get_all_nodes(self):
+        g = dotp.DotGraph()
+        s = g.add_subgraph('subG')
+        s.add_node('a')
+        self.assertEqual(g.get_all_nodes(), ['a'])
+        t = s.add_subgraph('subH')
+        t.add_node('b')
+        g.add_node('c')
+        self.assertEqual(s.get_all_nodes(), ['b', 'a'])
+        self.assertEqual(g.get_all_nodes(), ['b', 'a', 'c'])
+        s.delete_node('a')
+        self.assertEqual(g.get_all_nodes(), ['b', 'c'])
+
+    def test_add_edges(self):
+        g = dotp.DotGraph(strict=False, directed=True)
+        edges = g.add_edges(['a', 'b'], ['c', 'a'], color='red')
+        self.assertEqual([(e.src.name, e.dst.name) for e in edges],
+                         [('a', 'c'), ('a', 'a'), ('b', 'c'), ('b', 'a')])
+        self.assertEqual(list(g._nodes), ['a', 'c', 'b'])
+        self.assertEqual(edges[0].attr['color'], 'red')
+        edges[0].attr['color'] = 'blue'
+        self.assertEqual(edges[1].attr['color'], 'red')
+
+    def test_subgraph_edges(self):
+        g = dotp.DotDataParser().parse_dot_data('digraph { {a b} -> {c subgraph s {d}} -> e [color=red]; }')
+        edges = [(e.src.name, e.dst.name) for e in g.alledges]
+        self.assertEqual(sorted(edges), [('a', 'c'), ('a', 'd'), ('b', 'c'), ('b', 'd'),
+                                         ('c', 'e'), ('d', 'e')])
+        self.assertTrue(all(e.attr['color'] == 'red' for e in g.alledges))
+
+
+class DotGraphWriteTest(unittest.TestCase):
+    def test_write(self):
+        g = dotp.DotDataParser().parse_dot_data(xdot_testgraph)
+        fp = io.StringIO()
+        g.write(fp)
+        self.assertEqual(fp.getvalue(), str(g))
+        self.assertTrue(fp.getvalue().startswith('digraph G{'))
+
+    def test_write_built_graph(self):
+        g = dotp.DotGraph('G', strict=False, directed=True)
+        s = g.add_subgraph('cluster_0', label='x y')
+        s.add_edge('a', 'b')
+        g.add_node('node', color='red')
+        fp = io.StringIO()
+        g.write(fp)
+        self.assertEqual(fp.getvalue(), str(g))
+        self.assertTrue('graph [label="x y"];' in fp.getvalue())
+        self.assertTrue('"node"[color=red];' in fp.getvalue())
+
+    def test_quote_table(self):
+        self.assertEqual(dotp.quote_if_necessary('a b'), '"a b"')
+        self.assertEqual(dotp.quote_if_necessary('a b'), '"a b"')
+        self.assertEqual(dotp.quote_if_necessary('<<b>x</b>>'), '<b>x</b>')
+        self.assertEqual(dotp.quote_if_necessary(1.5), 1.5)
 
 class DotDefaultAttrTest(unittest.TestCase):
     """Test default attributes"""
@@ -141,6 +206,341 @@ class DotDefaultAttrTest(unittest.TestCase):
         nn = g.add_node(2)
         self.assertFalse('style' in nn.attr)
 
+    def test_shared_defaults(self):
+        g = dotp.DotGraph()
+        g.add_default_node_attr(color="red", shape="box")
+        na = g.add_node('a', color="blue")
+        nb = g.add_node('b')
+        self.assertTrue(na.attr.defaults is nb.attr.defaults)
+        self.assertEqual(dict(na.attr), {'color': 'blue', 'shape': 'box'})
+        self.assertEqual(list(na.attr), ['color', 'shape'])
+        g.add_default_node_attr(color="green")
+        nc = g.add_node('c')
+        self.assertEqual(nb.attr['color'], 'red')
+        self.assertEqual(nc.attr['color'], 'green')
+        del nb.attr['shape']
+        self.assertEqual(dict(nb.attr), {'color': 'red'})
+        self.assertEqual(na.attr['shape'], 'box')
+
+    def test_shared_edge_defaults(self):
+        g = dotp.DotGraph()
+        g.add_default_edge_attr(color="red")
+        s = g.add_subgraph('S')
+        e1 = g.add_edge('a', 'b', label='x')
+        e2 = s.add_edge('b', 'c')
+        self.assertTrue(e1.attr.defaults is e2.attr.defaults)
+        self.assertEqual(list(e1.attr.items()), [('color', 'red'), ('label', 'x')])
+        self.assertTrue(e1.src is g.get_node('a'))
+        self.assertTrue(e2.src is e1.dst)
+
+
+class DotGeometryTest(unittest.TestCase):
+    def test_decode(self):
+        self.assertEqual(dotp.decode_point("27,90.5"), (27.0, 90.5))
+        self.assertEqual(dotp.decode_point("27,90,1"), None)
+        self.assertEqual(dotp.decode_rect("0,0,62,108"), (0.0, 0.0, 62.0, 108.0))
+        self.assertEqual(dotp.decode_spline("s,1,2 e,3,4 5,6 7,\\\r\n8;9,10  11,12"),
+                         [((1.0, 2.0), (3.0, 4.0), [(5.0, 6.0), (7.0, 8.0)]),
+                          (None, None, [(9.0, 10.0), (11.0, 12.0)])])
+        self.assertEqual(dotp.decode_spline("e,3,4 1e-05,-6;"),
+                         [(None, (3.0, 4.0), [(1e-05, -6.0)]), (None, None, [])])
+
+    def test_cached(self):
+        g = dotp.DotGraph(bb="0,0,10,20")
+        node = g.add_node('a', pos="1,2", lp="3,4")
+        edge = g.add_edge('a', 'b', pos="e,1,2 3,4 5,6 7,8 9,10")
+        self.assertTrue(node.get_point() is node.get_point())
+        self.assertEqual(node.get_point('lp'), (3.0, 4.0))
+        self.assertEqual(node.get_point('xlp'), None)
+        self.assertTrue(edge.get_spline() is edge.get_spline())
+        self.assertEqual(g.get_rect(), (0.0, 0.0, 10.0, 20.0))
+        node.attr['pos'] = "5,6"
+        self.assertEqual(node.get_point(), (5.0, 6.0))
+
+
+class RecursiveParserTest(unittest.TestCase):
+    """Test that the recursive-descent parser matches the pyparsing parser"""
+
+    def parse_both(self, data):
+        g1 = dotp.DotDataParser().parse_dot_data(data)
+        g2 = dotp.RecursiveDotParser().parse_dot_data(data)
+        return g1, g2
+
+    def test_tokenize(self):
+        tokens = dotp.tokenize_dot('a -> "b c" [w=-1.5] // comment\n<<b>x</b>>')
+        self.assertEqual([t[:2] for t in tokens],
+                         [(dotp.TOK_ID, 'a'), (dotp.TOK_EDGEOP, '->'),
+                          (dotp.TOK_STRING, 'b c'), (dotp.TOK_PUNCT, '['),
+                          (dotp.TOK_ID, 'w'), (dotp.TOK_PUNCT, '='),
+                          (dotp.TOK_ID, '-1.5'), (dotp.TOK_PUNCT, ']'),
+                          (dotp.TOK_HTML, '<<<b>x</b>>>'), (dotp.TOK_EOF, '')])
+
+    def test_ports_and_subgraphs(self):
+        data = """strict digraph G {
+            node [shape=box];
+            a:p:n -> b:q [label="x" + "y"];
+            {c d} -> e -> {f};
+            subgraph cluster_1 {graph [color=red]; rank=same; g h}
+        }"""
+        g1, g2 = self.parse_both(data)
+        self.assertEqual(str(g1), str(g2))
+        edge = list(g2.alledges)[0]
+        self.assertEqual(edge.src_port, ':p:n')
+        self.assertEqual(edge.attr['label'], 'xy')
+
+    def test_parse_error(self):
+        parser = dotp.RecursiveDotParser()
+        self.assertRaises(dotp.ParseException, parser.parse_dot_data, 'digraph {a -> }')
+
+    def test_testgraphs(self):
+        files = glob.glob(os.path.join(BASE_DIR, 'testgraphs', '*.dot'))
+        files += glob.glob(os.path.join(BASE_DIR, '..', 'examples', '*.dot'))
+        for filename in files:
+            with open(filename, 'rb') as f:
+                data = f.read().decode('utf8', 'replace')
+            try:
+                g1 = dotp.DotDataParser().parse_dot_data(data)
+            except dotp.ParseException:
+                continue
+            g2 = dotp.RecursiveDotParser().parse_dot_data(data)
+            self.assertEqual(str(g1), str(g2), filename)
+
+
+class DotParserPoolTest(unittest.TestCase):
+    def test_reuse(self):
+        pool = dotp.DotParserPool()
+        g1 = pool.parse_dot_data('digraph {a -> b}')
+        g2 = pool.parse_dot_data('digraph {c -> d}')
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(len(g1), 2)
+        self.assertEqual(set(n.name for n in g2.allnodes), set(['c', 'd']))
+
+    def test_engines(self):
+        pool = dotp.DotParserPool()
+        with pool.parser('recursive') as parser:
+            self.assertTrue(isinstance(parser, dotp.RecursiveDotParser))
+        self.assertRaises(NameError, pool.acquire, 'unknown')
+
+    def test_parse_error_releases_parser(self):
+        pool = dotp.DotParserPool()
+        self.assertRaises(dotp.ParseException, pool.parse_dot_data, 'digraph {a -> }')
+        pool.parse_dot_data('digraph {a -> b}')
+        self.assertEqual(pool.created, 1)
+
+
+xdot_testgraph = r"""digraph G {
+	graph [bb="0,0,134,188",
+		xdotversion=1.7
+	];
+	node [label="\N"];
+	subgraph cluster_0 {
+		graph [bb="8,8,78,180",
+			label=<x>
+		];
+		a	[_draw_="c 7 -#000000 e 43 154 27 18 ",
+			height=0.5,
+			pos="43,154",
+			width=0.75];
+		"b c"	[height=0.5,
+			pos="43,82",
+			width=0.75];
+		a -> "b c"	[pos="e,43,100.1 43,135.7 43,127.98 43,118.71 43,110.11"];
+	}
+	d:p:n -> a:s	[label="x\"y",
+		lp="1,\
+2"];
+	rank=same;
+}
+"""
+
+
+class XDotReaderTest(unittest.TestCase):
+    def test_same_as_pyparsing(self):
+        g1 = dotp.DotDataParser().parse_dot_data(xdot_testgraph)
+        g2 = dotp.XDotReader().parse_dot_data(xdot_testgraph)
+        self.assertEqual(str(g1), str(g2))
+        edge = list(g2.alledges)[-1]
+        self.assertEqual(edge.src_port, ':p:n')
+        self.assertEqual(edge.attr['lp'], '1,2')
+
+    def test_mismatch(self):
+        reader = dotp.XDotReader()
+        self.assertRaises(dotp.XDotFormatError, reader.parse_dot_data,
+                          'digraph { a -> b -> c; }')
+        self.assertRaises(dotp.XDotFormatError, reader.parse_dot_data,
+                          'digraph { /* comment */ a; }')
+
+    def test_fallback(self):
+        g = dotp.parse_xdot_data('digraph { a -> b -> c; }')
+        self.assertEqual(len(list(g.alledges)), 2)
+
+
+class DotColumnsTest(unittest.TestCase):
+    def test_same_as_xdotreader(self):
+        g1 = dotp.XDotReader().parse_dot_data(xdot_testgraph)
+        g2, store = dotp.read_xdot_columns(xdot_testgraph)
+        nodes1 = list(g1.allnodes)
+        self.assertEqual([n.name for n in store.nodes], [n.name for n in nodes1])
+        for n1, n2 in zip(nodes1, store.nodes):
+            self.assertEqual(n2.get_point(), n1.get_point())
+            self.assertEqual(n2.attr.get('width'), n1.attr.get('width'))
+        edges1 = list(g1.alledges)
+        edges2 = [(e.src.name, e.dst.name, e.src_port, e.dst_port, e.get_spline())
+                  for e in store.edges]
+        self.assertEqual(edges2, [(e.src.name, e.dst.name, e.src_port, e.dst_port,
+                                   e.get_spline()) for e in edges1])
+        labels = [e.attr.get('label') for e in store.edges]
+        self.assertEqual(labels, [e.attr.get('label') for e in edges1])
+        self.assertEqual(g2.attr['bb'], g1.attr['bb'])
+
+    def test_from_graph(self):
+        g = dotp.XDotReader().parse_dot_data(xdot_testgraph)
+        store = dotp.DotColumns.from_graph(g)
+        self.assertEqual(len(store.nodes), len(list(g.allnodes)))
+        self.assertEqual(len(store.edges), len(list(g.alledges)))
+        draw = [bool(n.draw_records) for n in store.nodes]
+        self.assertEqual(draw, [bool(n.draw_records) for n in g.allnodes])
+
+    def test_edge_grouping(self):
+        store = dotp.DotColumns(directed=True)
+        store.add_edge('a', 'b')
+        store.add_edge('b', 'c')
+        store.add_edge('a', 'b', label='2')
+        self.assertEqual([(e.src.name, e.dst.name) for e in store.edges],
+                         [('a', 'b'), ('a', 'b'), ('b', 'c')])
+
+    def test_strict(self):
+        store = dotp.DotColumns(directed=True, strict=True)
+        store.add_edge('a', 'b')
+        store.add_edge('a', 'b')
+        self.assertEqual(len(store.edges), 1)
+
+
+multi_testgraph = """/* first { */ digraph A { a -> b [label="}{\\"}"]; c [label=<x}>]; // }
+}
+# second {
+graph B { x -- y; subgraph { z } }
+// tail {
+"""
+
+
+class SplitGraphsTest(unittest.TestCase):
+    def test_split(self):
+        expected = list(dotp.split_dot_graphs(io.StringIO(multi_testgraph)))
+        self.assertEqual(len(expected), 2)
+        self.assertEqual("".join(expected) + "\n// tail {\n", multi_testgraph)
+        for chunk_size in [1, 2, 3, 7]:
+            graphs = list(dotp.split_dot_graphs(io.StringIO(multi_testgraph), chunk_size))
+            self.assertEqual(graphs, expected)
+            graphs = list(dotp.split_dot_graphs(io.BytesIO(multi_testgraph.encode('utf8')), chunk_size))
+            self.assertEqual(graphs, expected)
+
+    def test_iter_graphs(self):
+        graphs = dotp.iter_dot_graphs(io.StringIO(multi_testgraph), chunk_size=5)
+        self.assertEqual([(g.name, g.directed) for g in graphs], [('A', True), ('B', False)])
+
+    def test_unterminated(self):
+        graphs = dotp.iter_dot_graphs(io.StringIO('graph { a } graph { b'))
+        self.assertEqual(next(graphs).name, '')
+        self.assertRaises(dotp.ParseException, next, graphs)
+
+
+fake_dot_script = """#!%s
+import sys
+with open(__file__ + '.log', 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == '-V':
+    sys.stderr.write('dot - graphviz version 2.43.0 (0)\\n')
+else:
+    sys.stderr.write('Format: "?" not recognized. Use one of: canon dot json xdot\\n')
+"""
+
+
+@unittest.skipIf(sys.platform == 'win32', 'Needs an executable script')
+class GraphvizToolsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dot = os.path.join(self.tmpdir, 'dot')
+        with open(self.dot, 'w') as f:
+            f.write(fake_dot_script % sys.executable)
+        os.chmod(self.dot, 0o755)
+        self.cache_file = os.path.join(self.tmpdir, 'graphviz.json')
+        patcher = mock.patch.dict(os.environ, {'PATH': self.tmpdir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def runs(self):
+        with open(self.dot + '.log') as f:
+            return f.read().split()
+
+    def test_probe(self):
+        tools = dotp.get_graphviz()
+        self.assertEqual(tools.progs, {'dot': self.dot})
+        self.assertTrue(dotp.get_graphviz() is tools)
+        self.assertEqual(tools.version, (2, 43, 0))
+        self.assertEqual(tools.formats, frozenset(['canon', 'dot', 'json', 'xdot']))
+        self.assertEqual(tools.best_layout_format(), 'json')
+        self.assertEqual(tools.version, (2, 43, 0))
+        self.assertEqual(self.runs(), ['-V', '-T?'])
+
+    def test_cache_file(self):
+        tools = dotp.get_graphviz(self.cache_file)
+        self.assertEqual(tools.version, (2, 43, 0))
+        tools = dotp.GraphvizTools.load(self.cache_file)
+        self.assertEqual(tools.progs, {'dot': self.dot})
+        self.assertEqual(tools.version, (2, 43, 0))
+        self.assertEqual(self.runs(), ['-V'])
+        # a changed program invalidates the cache
+        os.utime(self.dot, (0, 0))
+        self.assertEqual(dotp.GraphvizTools.load(self.cache_file), None)
+
+
+json_testgraph = {
+    "name": "G", "directed": True, "strict": False, "bb": "0,0,100,100",
+    "_draw_": [{"op": "c", "grad": "none", "color": "white"}],
+    "_subgraph_cnt": 2,
+    "objects": [
+        {"_gvid": 0, "name": "clusterA", "bb": "1,1,50,50", "subgraphs": [1], "nodes": [0, 1], "edges": [0]},
+        {"_gvid": 1, "name": "clusterB", "bb": "2,2,40,40", "nodes": [1]},
+        {"_gvid": 0, "name": "a", "pos": "10,10", "width": 0.75},
+        {"_gvid": 1, "name": "b", "pos": "20,20"},
+        {"_gvid": 2, "name": "c", "pos": "30,30"},
+    ],
+    "edges": [
+        {"_gvid": 0, "tail": 0, "head": 1, "tailport": "p:n", "pos": "10,10 20,20"},
+        {"_gvid": 1, "tail": 1, "head": 2, "pos": "20,20 30,30"},
+    ]
+}
+
+
+class GraphFromJSONTest(unittest.TestCase):
+    def test_graph(self):
+        g = dotp.graph_from_json(json_testgraph)
+        self.assertTrue(g.directed)
+        self.assertEqual(g.attr['bb'], '0,0,100,100')
+        self.assertFalse('_draw_' in g.attr)
+        self.assertEqual(g.draw_records['_draw_'][0]['color'], 'white')
+        self.assertEqual(sorted(n.name for n in g.allnodes), ['a', 'b', 'c'])
+        self.assertEqual(g.get_node('a').attr['width'], '0.75')
+
+    def test_subgraphs(self):
+        g = dotp.graph_from_json(json_testgraph)
+        self.assertEqual([s.name for s in g.allgraphs], ['G', 'clusterA', 'clusterB'])
+        cluster_a = g.subgraphs[0]
+        self.assertEqual(list(cluster_a.subgraphs[0].nodes)[0].name, 'b')
+        self.assertEqual([n.name for n in cluster_a.nodes], ['a', 'b'])
+        self.assertEqual([n.name for n in g.nodes], ['c', 'b'])
+
+    def test_edges(self):
+        g = dotp.graph_from_json(json.dumps(json_testgraph))
+        edges = list(g.alledges)
+        self.assertEqual(len(edges), 2)
+        self.assertEqual((edges[0].src.name, edges[0].dst.name), ('a', 'b'))
+        self.assertEqual(edges[0].src_port, ':p:n')
+        self.assertEqual(edges[1].src_port, '')
+        self.assertEqual(edges[1].attr['pos'], '20,20 30,30')
+
 
 ##
 ##